@@ -36,12 +36,30 @@ def get_file_handler():
     return file_handler
 
 
+LOG_LEVEL = logging.INFO
+"""Level of the BlackBlox loggers. Debug messages are only written if set to logging.DEBUG
+(e.g. with set_log_level). For details of each calculation, see bb_trace."""
+
+LOGGER_NAMES = set()
+
+
 def get_logger(logger_name):
     logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(LOG_LEVEL)
 
-    # logger.addHandler(get_console_handler()) #uncomment to output log to console
-    logger.addHandler(get_file_handler())
+    if logger_name not in LOGGER_NAMES:  # avoids duplicate handlers if called again for the same logger
+        # logger.addHandler(get_console_handler()) #uncomment to output log to console
+        logger.addHandler(get_file_handler())
+        LOGGER_NAMES.add(logger_name)
     logger.propagate = False
 
     return logger
+
+
+def set_log_level(level):
+    """Sets the level of all BlackBlox loggers (e.g. logging.DEBUG or 'DEBUG')
+    """
+    global LOG_LEVEL
+    LOG_LEVEL = level
+    for logger_name in LOGGER_NAMES:
+        logging.getLogger(logger_name).setLevel(level)
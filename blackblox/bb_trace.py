@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+""" Calculation trace
+
+This module records the calculations performed while balancing unit processes,
+as a lighter-weight alternative to debug logging when diagnosing imbalances.
+
+When tracing is disabled (the default), the only cost to balancing is a check
+of trace.enabled for each calculation. When enabled, each calculation's unit
+process, scenario, calc_df row, calculation type, substances, quantities and
+variable are written to a preallocated array (with substance names and other
+strings stored as integer codes), which grows as needed and can be exported
+as a DataFrame, CSV or JSON.
+
+Note that while tracing is enabled, unit processes recalculate every balance
+rather than scaling cached balances, so that every calculation is recorded.
+
+Recording is thread-safe, and each calculation records the name of the thread
+that performed it, so traces of factories balanced in a thread pool can be
+separated. Calculations performed in worker processes (workers > 1 with the
+default process mode) are recorded in those processes and are lost, so trace
+with workers=1 or mode='thread'.
+
+Module Outline:
+
+- import statements
+- module variable: enabled (bool)
+- module variable: lock (threading.Lock)
+- function: enable
+- function: disable
+- function: clear
+- function: code
+- function: record
+- function: to_df
+- function: dump_csv
+- function: dump_json
+
+"""
+import threading
+
+import numpy as np
+import pandas as pan
+
+
+enabled = False
+"""bool: whether calculations are currently being recorded"""
+
+lock = threading.Lock()
+"""threading.Lock: guards the buffer and strings list while recording"""
+
+TRACE_DTYPE = np.dtype([
+    ('thread', np.int32),
+    ('unit', np.int32),
+    ('scenario', np.int32),
+    ('row', np.int32),
+    ('calc_type', np.int32),
+    ('known', np.int32),
+    ('known_io', np.int32),
+    ('known_qty', np.float64),
+    ('unknown', np.int32),
+    ('unknown_io', np.int32),
+    ('unknown_qty', np.float64),
+    ('var', np.float64),
+    ('invert', np.bool_),
+])
+"""Fields recorded for each calculation. String fields are stored as codes of the strings list."""
+
+STRING_FIELDS = ['thread', 'unit', 'scenario', 'calc_type', 'known', 'known_io', 'unknown', 'unknown_io']
+
+buffer = np.zeros(0, dtype=TRACE_DTYPE)
+length = 0
+strings = []
+string_codes = dict()
+
+
+def enable(capacity=4096, reset=True):
+    """Starts recording calculations.
+
+    Args:
+        capacity (int): number of calculations to preallocate space for.
+            The buffer is doubled in size whenever it is full.
+            (Defaults to 4096)
+        reset (bool): if True, discards any previously recorded calculations.
+            (Defaults to True)
+    """
+    global enabled, buffer
+
+    if reset is True:
+        clear()
+    with lock:
+        if len(buffer) < capacity:
+            buffer = np.resize(buffer, capacity)
+    enabled = True
+
+
+def disable():
+    """Stops recording calculations. Recorded calculations are kept until cleared."""
+    global enabled
+    enabled = False
+
+
+def clear():
+    """Discards all recorded calculations."""
+    global length
+    with lock:
+        length = 0
+        strings.clear()
+        string_codes.clear()
+
+
+def code(string):
+    """returns the integer code of a string, adding it to the strings list if new
+
+    Callers must hold lock.
+    """
+    string = str(string)
+    if string not in string_codes:
+        string_codes[string] = len(strings)
+        strings.append(string)
+    return string_codes[string]
+
+
+def record(unit, scenario, row, calc_type, known, known_io, known_qty, unknown, unknown_io, unknown_qty,
+           var=None, invert=False):
+    """Records a single calculation. Only called when tracing is enabled.
+
+    Quantities and variables that are not numbers (or that are arrays, e.g. from
+    UnitProcess.balance_many) are recorded as NaN.
+    """
+    global buffer, length
+
+    values = (as_float(known_qty), as_float(unknown_qty), as_float(var))
+
+    with lock:
+        if length >= len(buffer):
+            buffer = np.resize(buffer, max(2 * len(buffer), 64))
+
+        buffer[length] = (code(threading.current_thread().name), code(unit), code(scenario), row, code(calc_type),
+                          code(known), code(known_io), values[0],
+                          code(unknown), code(unknown_io), values[1],
+                          values[2], bool(invert))
+        length += 1
+
+
+def as_float(value):
+    """returns value as a float, or NaN if it is not a single number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def to_df():
+    """Returns the recorded calculations as a DataFrame, one row per calculation in the order performed."""
+    with lock:
+        records = buffer[:length].copy()
+        names = list(strings)
+    df = pan.DataFrame(records)
+    for field in STRING_FIELDS:
+        df[field] = [names[c] for c in records[field]]
+    return df
+
+
+def dump_csv(filepath):
+    """Writes the recorded calculations to a CSV file."""
+    to_df().to_csv(filepath, index=False)
+
+
+def dump_json(filepath):
+    """Writes the recorded calculations to a JSON file, as a list of records."""
+    to_df().to_json(filepath, orient='records', indent=1)
@@ -3,8 +3,8 @@
 
 This module contains the functions used to perform the mass and energy balances
 in the unit processes. The calculation type specified by the user in their 
-calculation files must be of one of the type specified here, as noted in calc_dict, 
-or one defined by the user in custom_lookup.py
+calculation files must be of one of the type specified here, as noted in calcs_dict, 
+or one added by the user using register_calculator.
 
 Note 1: The "invert" option throughout the calculation is used to allow the unit 
 processes to balance regardless of whether the quantity of the "known" or "unknown"
@@ -20,6 +20,14 @@ Module Outline:
 - function: no_nan
 - function: div_no_zero
 
+- class: Dual
+- function: grad_of
+
+- function: molar_mass
+- function: load_molar_masses
+- function: save_molar_masses
+- function: preload_molar_masses
+
 - function: Ratio
 - function: Remainder
 - function: ReturnValue
@@ -28,14 +36,23 @@ Module Outline:
 - function: Addition
 - function: lookup_ratio
 - function: Combustion
+- function: fuel_emission_columns
 - function: check_balance
+- function: register_calculator
+- function: update_calc_lists
 
+- module variable: molar_masses
 - module variable: calcs_dict
 - module variable: twoQty_calc_list 
 - module variable: lookup_var_calc_list
+- module variable: linear_calc_list
+- module variable: array_calc_list
+- module variable: side_effect_calc_list
 
 """
 from collections import defaultdict
+import json
+import logging
 from math import isnan
 
 import numpy as np
@@ -43,6 +60,7 @@ from molmass import Formula
 
 from blackblox.dataconfig import bbcfg
 import blackblox.io_functions as iof
+import blackblox.flows as flows
 from blackblox.bb_log import get_logger
 import blackblox.frames_default as fd
 
@@ -56,11 +74,20 @@ def check_qty(qty, fraction=False):
     """Checks that a quantity is a number, > 0, and optionally < 1.
 
     Args:
-        qty (float or int): number to check
+        qty (float, int or ndarray): number (or array of numbers) to check
         fraction (bool): whether the number should be between 0 and 1
             (Defaults to False.)
     """
 
+    if isinstance(qty, np.ndarray):  # one quantity per scenario
+        if not np.issubdtype(qty.dtype, np.number):
+            raise ValueError(f'quantities should be ints or floats. Currently: {qty.dtype}')
+        if (np.round(qty, bbcfg.float_tol) < 0).any():
+            raise ValueError(f'quantities should be > 0. Currently: {qty}')
+        if fraction is True and (qty > 1).any():
+            raise ValueError(f'quantities should be between 0 and 1. Currently: {qty}')
+        return
+
     if not isinstance(qty, (float, int, complex, np.integer, np.floating)):
         raise ValueError(f'quantity should be an int or float. Currently: {type(qty)}')
 
@@ -80,8 +107,12 @@ def no_nan(number):
 
     Returns:
         If the number is a nan, returns 0. Else returns the input number.
+        Arrays are returned with their nan elements set to 0.
     """
 
+    if isinstance(number, np.ndarray):
+        return np.where(np.isnan(number), 0, number)
+
     if number is not None:
         if type(number) not in [str, bool]:
             if isnan(number):
@@ -103,8 +134,14 @@ def div_no_zero(qty1, qty2):
 
     Returns: 
         If either qty1 or qty2 is 0 or NaN, returns 0. Else returns the quotient.
+        If either is an array, the same is applied elementwise.
     """
 
+    if isinstance(qty1, np.ndarray) or isinstance(qty2, np.ndarray):
+        qty1, qty2 = np.broadcast_arrays(np.asarray(qty1, dtype=float), np.asarray(qty2, dtype=float))
+        zero = (qty1 == 0) | (qty2 == 0) | np.isnan(qty1) | np.isnan(qty2)
+        return np.divide(qty1, qty2, out=np.zeros(qty1.shape), where=~zero)
+
     if 0 in [qty1, qty2]:
         return 0
     elif isnan(qty1) or isnan(qty2):
@@ -113,7 +150,207 @@ def div_no_zero(qty1, qty2):
         return qty1 / qty2
 
 
+# DERIVATIVES
+
+class Dual(float):
+    """A quantity that carries its derivatives with respect to selected variables.
+
+    Behaves as a float (its value) in comparisons, checks and output, while
+    arithmetic with other quantities also propagates the gradient (forward-mode
+    automatic differentiation). Used by UnitProcess.get_var for variables
+    selected for derivatives, so that the flows calculated from them carry their
+    derivatives through unit process, chain and factory balances.
+
+    Args:
+        value (float): the value of the quantity
+        grad (ndarray): the derivatives of the quantity with respect to each
+            selected variable
+
+    Attributes:
+        grad (ndarray): the derivatives of the quantity
+    """
+    __slots__ = ('grad',)
+    __array_ufunc__ = None  # so that numpy scalars defer to Dual arithmetic
+
+    def __new__(cls, value, grad):
+        dual = float.__new__(cls, value)
+        dual.grad = grad
+        return dual
+
+    @classmethod
+    def seed(cls, value, index, size):
+        """returns value as a Dual whose derivative is 1 for the variable at index (of size variables)"""
+        grad = np.zeros(size)
+        grad[index] = 1.0
+        return cls(value, grad)
+
+    def __reduce__(self):
+        return Dual, (float(self), self.grad)
+
+    def __repr__(self):
+        return f"Dual({float(self)!r}, grad={self.grad!r})"
+
+    def __add__(self, other):
+        if not isinstance(other, (int, float, np.number)):
+            return NotImplemented
+        return Dual(float(self) + float(other), self.grad + grad_of(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if not isinstance(other, (int, float, np.number)):
+            return NotImplemented
+        return Dual(float(self) - float(other), self.grad - grad_of(other))
+
+    def __rsub__(self, other):
+        if not isinstance(other, (int, float, np.number)):
+            return NotImplemented
+        return Dual(float(other) - float(self), grad_of(other) - self.grad)
+
+    def __mul__(self, other):
+        if not isinstance(other, (int, float, np.number)):
+            return NotImplemented
+        return Dual(float(self) * float(other), self.grad * float(other) + float(self) * grad_of(other))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if not isinstance(other, (int, float, np.number)):
+            return NotImplemented
+        value = float(self) / float(other)
+        return Dual(value, (self.grad - value * grad_of(other)) / float(other))
+
+    def __rtruediv__(self, other):
+        if not isinstance(other, (int, float, np.number)):
+            return NotImplemented
+        value = float(other) / float(self)
+        return Dual(value, (grad_of(other) - value * self.grad) / float(self))
+
+    def __pow__(self, exponent):
+        if not isinstance(exponent, (int, float, np.number)) or isinstance(exponent, Dual):
+            return NotImplemented
+        return Dual(float(self) ** exponent, exponent * float(self) ** (exponent - 1) * self.grad)
+
+    def __neg__(self):
+        return Dual(-float(self), -self.grad)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return -self if self < 0 else self
+
+    def __round__(self, ndigits=None):
+        if ndigits is None:
+            return round(float(self))
+        return Dual(round(float(self), ndigits), self.grad)
+
+
+def grad_of(qty):
+    """returns the gradient of a Dual quantity, or 0 for any other quantity"""
+    return qty.grad if isinstance(qty, Dual) else 0.0
+
+
+# MOLAR MASS FUNCTIONS
+
+molar_masses = dict()
+"""Molar masses of chemical formulas, keyed by formula.
+
+Shared by all unit processes, so that each formula is only parsed once.
+Filled by molar_mass as formulas are used, or in advance by 
+load_molar_masses or preload_molar_masses.
+"""
+
+
+def molar_mass(formula):
+    """Returns the molar mass of a chemical formula, parsing it only on first use
+
+    Args:
+        formula (str): the chemical formula (e.g. 'CaCO3')
+
+    Returns:
+        float: the molar mass of the formula (g/mol)
+    """
+    if formula not in molar_masses:
+        molar_masses[formula] = Formula(formula).mass
+    return molar_masses[formula]
+
+
+def load_molar_masses(filepath):
+    """Adds the molar masses saved by save_molar_masses to molar_masses
+
+    Args:
+        filepath (str/Path): the JSON file of molar masses. If it does not exist,
+            nothing is loaded.
+
+    Returns:
+        int: the number of molar masses loaded
+    """
+    try:
+        with open(filepath) as f:
+            loaded = json.load(f)
+    except FileNotFoundError:
+        logger.info(f"no molar mass file found at {filepath}")
+        return 0
+
+    molar_masses.update(loaded)
+    logger.info(f"{len(loaded)} molar masses loaded from {filepath}")
+    return len(loaded)
+
+
+def save_molar_masses(filepath):
+    """Saves molar_masses to a JSON file, to be reloaded with load_molar_masses
+
+    Args:
+        filepath (str/Path): the JSON file to write
+    """
+    with open(filepath, 'w') as f:
+        json.dump(molar_masses, f, indent=1, sort_keys=True)
+    logger.info(f"{len(molar_masses)} molar masses saved to {filepath}")
+
+
+def preload_molar_masses(units_df=None):
+    """Calculates the molar masses of all formulas used in molar mass ratio
+    calculations in the calculation tables of a unit process library.
+
+    Lookup substances (whose formula depends on the scenario) are skipped, 
+    as are names that are not valid chemical formulas.
+
+    Args:
+        units_df (DataFrame): Unit process library dataframe
+            (Defaults to fd.df_unit_library)
+
+    Returns:
+        int: the number of molar masses known after preloading
+    """
+    fd.initialize()
+    units_df = units_df if units_df is not None else fd.df_unit_library
+
+    for u_id in units_df.index:
+        c_sheet = iof.check_for_col(units_df, bbcfg.columns.calc_sheetname, u_id)
+        calc_df = iof.make_df(units_df.at[u_id, bbcfg.columns.calc_filepath], sheet=c_sheet, index=None)
+
+        for i in calc_df.index:
+            if type(calc_df.at[i, bbcfg.columns.known]) is not str:
+                continue
+            if 'molmass' not in iof.clean_str(calc_df.at[i, bbcfg.columns.calc_type]):
+                continue
+            for substance in [calc_df.at[i, bbcfg.columns.known], calc_df.at[i, bbcfg.columns.unknown]]:
+                formula = substance.split(bbcfg.ignore_sep)[0]
+                if formula in fd.lookup_var_dict or formula in molar_masses:
+                    continue
+                try:
+                    molar_mass(formula)
+                except Exception:
+                    logger.debug(f"{formula} ({u_id}) is not a chemical formula")
+
+    logger.info(f"{len(molar_masses)} molar masses preloaded")
+    return len(molar_masses)
+
+
 # CALCULATION FUNCTIONS
+# quantities (qty, qty2) and numeric variables (var) may be floats or numpy arrays
+# (e.g. one element per scenario or sample), which are calculated elementwise.
 
 # noinspection PyUnusedLocal
 def Ratio(qty, var, invert=False, **kwargs):
@@ -138,7 +375,7 @@ def Ratio(qty, var, invert=False, **kwargs):
             1.6666666666666665
     """
 
-    logger.debug("using qty: {}, ratio: {}, invert: {}".format(qty, var, invert))
+    logger.debug("using qty: %s, ratio: %s, invert: %s", qty, var, invert)
 
     check_qty(qty)
     check_qty(var)
@@ -176,7 +413,7 @@ def Remainder(qty, var, invert=False, **kwargs):
         7.142857142857143
     """
 
-    logger.debug("using qty: {}, ratio: {}, invert: {}".format(qty, var, invert))
+    logger.debug("using qty: %s, ratio: %s, invert: %s", qty, var, invert)
 
     check_qty(qty)
     check_qty(var, fraction=True)
@@ -221,7 +458,7 @@ def MolMassRatio(known_substance, qty, unknown_substance, var=1.0, invert=False,
         known_substance (str): The chemical formula of the substance of known quantity, 
         qty: The quantity of the known substance
         unknown_substance (str): The chemical formula of the substance of unknown quantity.
-        var (float): The number of mols of the unknpwn substance per mol of known substance
+        var (float or ndarray): The number of mols of the unknpwn substance per mol of known substance
             (Defaults to 1.0)
 
     Returns:
@@ -236,16 +473,16 @@ def MolMassRatio(known_substance, qty, unknown_substance, var=1.0, invert=False,
         8.81341527344784
         
     """
-    logger.debug("using {} of {} to determine qty of {}".format(qty, known_substance, unknown_substance))
+    logger.debug("using %s of %s to determine qty of %s", qty, known_substance, unknown_substance)
 
-    if var is None or var in bbcfg.no_var:
+    if var is None or (not isinstance(var, np.ndarray) and var in bbcfg.no_var):
         var = 1.0
 
     if invert is True:
         var = 1 / var
 
     check_qty(qty)
-    return qty * (Formula(unknown_substance).mass / Formula(known_substance).mass) * var
+    return qty * (molar_mass(unknown_substance) / molar_mass(known_substance)) * var
 
 
 # noinspection PyUnusedLocal
@@ -259,8 +496,8 @@ def Subtraction(qty, qty2, invert=False, **kwargs):
     Returns the minuend = qty + qty2
 
     Args:
-        qty (float): The quantity of a known substance
-        qty2 (float): The quantity of another known substance
+        qty (float or ndarray): The quantity of a known substance
+        qty2 (float or ndarray): The quantity of another known substance
         invert: If True, adds rathers the values rather than subtracts them.
             (Defaults to False)
 
@@ -268,7 +505,7 @@ def Subtraction(qty, qty2, invert=False, **kwargs):
         float: The quantity of a third substance. 
 
     """
-    logger.debug("using qty: {}, qty2: {}, invert: {}".format(qty, qty2, invert))
+    logger.debug("using qty: %s, qty2: %s, invert: %s", qty, qty2, invert)
 
     check_qty(qty)
     check_qty(qty2)
@@ -294,8 +531,8 @@ def Addition(qty, qty2, invert=False, **kwargs):
 
 
     Args:
-        qty (float): The quantity of a known substance
-        qty2 (float): The quantity of another known substance
+        qty (float or ndarray): The quantity of a known substance
+        qty2 (float or ndarray): The quantity of another known substance
         invert: If True, subtracts rathers the values rather than adds them.
             (Defaults to False)
 
@@ -303,7 +540,7 @@ def Addition(qty, qty2, invert=False, **kwargs):
         float: The quantity of a third substance
 
     """
-    logger.debug("using qty: {}, qty2: {}, invert: {}".format(qty, qty2, invert))
+    logger.debug("using qty: %s, qty2: %s, invert: %s", qty, qty2, invert)
 
     check_qty(qty)
     check_qty(qty2)
@@ -332,17 +569,17 @@ def lookup_ratio(known_substance, qty, unknown_substance, var=None, lookup_df=No
 
     Args:
         known_substance (str): name of the known quantity
-        qty (float): quantity of known substance
+        qty (float or ndarray): quantity of known substance
         unknown_substance (str): name of the unknown quantity
         var (str): The relevant column in the lookup dataframe
         lookup_df (DataFrame): dataframe with lookup data
             (defaults to fd.df_fuels dataframe)
     Returns:
-        float
+        float (or ndarray, if qty is an array)
 
     """
     lookup_df = lookup_df if lookup_df is not None else fd.df_fuels
-    logger.debug(f"using dataframe {lookup_df.columns}, {qty} of {known_substance} and {var} for {unknown_substance}")
+    logger.debug("using dataframe %s, %s of %s and %s for %s", lookup_df.columns, qty, known_substance, var, unknown_substance)
 
     check_qty(qty)
 
@@ -362,7 +599,7 @@ def lookup_ratio(known_substance, qty, unknown_substance, var=None, lookup_df=No
         substance = iof.no_suf(unknown_substance)
         return_qty = div_no_zero(qty, lookup_df.at[substance, var.lower()])
 
-        logger.debug(f"{return_qty} of {unknown_substance} derived from {qty} of {known_substance} using {var} ratio")
+        logger.debug("%s of %s derived from %s of %s using %s ratio", return_qty, unknown_substance, qty, known_substance, var)
 
     check_qty(return_qty)
     return return_qty
@@ -378,18 +615,18 @@ def Combustion(known_substance, qty, unknown_substance, var=1.0,
         Args:
         known_substance (str): name of the known quantity, either 
             a fuel named in fuels_df or the name of the related energy flow
-        qty (float): quantity of known substance
+        qty (float or ndarray): quantity of known substance
         unknown_substance (str): name of the unknown quantity, either
             a fuel named in fuels_df or the name of the related energy flow
-        var (float): the combustion efficiency (Between 0 and 1).
+        var (float or ndarray): the combustion efficiency (Between 0 and 1).
             (Defaults to 1)
         emissions_list (list[str]): List of emissions to calculate, if emission
             factors are available in the fuel dataframe
             (Defaults to bbcfg.emissions)
-        emissions_dict (defaultdict or bool): If provided, the dictionary where 
+        emissions_dict (defaultdict, FlowVector or bool): If provided, the dictionary where 
             calculated emission quantities will be written. 
             (Defaults to False)
-        inflows_dict (defaultdict or bool): If provided, the dictionary where the
+        inflows_dict (defaultdict, FlowVector or bool): If provided, the dictionary where the
             calculated oxygen required for combustion will be written.
             (Defaults to False)
         fuels_df (dataframe): Dataframe containing the fuel name as index ('fuel_type'), 
@@ -403,6 +640,7 @@ def Combustion(known_substance, qty, unknown_substance, var=1.0,
         
     Returns:
         float: The quantity of the unkown substance (fuel or energy)
+        (or an ndarray, if qty or var are arrays)
 
     Note:
         Only one of known and unknown substances can be in the dataframe index.
@@ -426,20 +664,22 @@ def Combustion(known_substance, qty, unknown_substance, var=1.0,
 
     """
 
-    fuels_df = fuels_df if fuels_df is not None else fd.df_fuels
+    fuel_table = fd.get_fuel_table(fuels_df)
+    known_fuel = iof.no_suf(known_substance)
+    unknown_fuel = iof.no_suf(unknown_substance)
 
-    logger.debug(f"using {qty} of {known_substance} and efficiency of {var} to calculate {unknown_substance}")
-    logger.debug(f"using dataframe with columns {fuels_df.columns}")
+    logger.debug("using %s of %s and efficiency of %s to calculate %s", qty, known_substance, var, unknown_substance)
+    logger.debug("using fuel table with columns %s", list(fuel_table['columns']))
 
-    if iof.no_suf(known_substance) not in fuels_df.index and iof.no_suf(unknown_substance) not in fuels_df.index:
+    if known_fuel not in fuel_table['index'] and unknown_fuel not in fuel_table['index']:
         raise Exception("Neither {} nor {} is a known fuel type".format(known_substance, unknown_substance))
 
-    if iof.no_suf(known_substance) in fuels_df.index and iof.no_suf(unknown_substance) in fuels_df.index:
+    if known_fuel in fuel_table['index'] and unknown_fuel in fuel_table['index']:
         raise Exception("Both {} and {} are known fuel types.".format(known_substance, unknown_substance))
 
     check_qty(qty)
 
-    if var is None or var in bbcfg.no_var:
+    if var is None or (not isinstance(var, np.ndarray) and var in bbcfg.no_var):
         combust_eff = 1.0
     else:
         combust_eff = var
@@ -450,52 +690,82 @@ def Combustion(known_substance, qty, unknown_substance, var=1.0,
     else:
         HV = 'hhv'
 
-    if iof.no_suf(known_substance) in fuels_df.index:
-        fuel_type = iof.no_suf(known_substance)
+    if known_fuel in fuel_table['index']:
+        fuel_type = known_fuel
+        fuel_row = fuel_table['values'][fuel_table['index'][fuel_type]]
         fuel_qty = qty
-        energy_qty = qty * (fuels_df.at[fuel_type, HV.lower()])  # total energy in fuel
+        energy_qty = qty * fuel_row[fuel_table['columns'][HV]]  # total energy in fuel
         return_qty = energy_qty * combust_eff  # useful energy after combustion
-        logger.debug(
-            f"energy qty ({fuel_type}) calculated at {energy_qty}, of which {return_qty} useful (Eff: {combust_eff}")
+        logger.debug("energy qty (%s) calculated at %s, of which %s useful (Eff: %s)",
+                     fuel_type, energy_qty, return_qty, combust_eff)
 
     else:
-        fuel_type = iof.no_suf(unknown_substance)
+        fuel_type = unknown_fuel
+        fuel_row = fuel_table['values'][fuel_table['index'][fuel_type]]
+        if isinstance(combust_eff, np.ndarray):
+            if (combust_eff == 0).any():
+                raise ZeroDivisionError(f'combustion efficiency of 0 for {fuel_type}: {combust_eff}')
         energy_qty = qty * (1 / combust_eff)  # total energy in fuel
-        fuel_qty = div_no_zero(energy_qty, fuels_df.at[fuel_type, HV.lower()])
+        fuel_qty = div_no_zero(energy_qty, fuel_row[fuel_table['columns'][HV]])
         return_qty = fuel_qty
-        logger.debug(f"fuel qty ({fuel_type}) calculated at {return_qty}")
+        logger.debug("fuel qty (%s) calculated at %s", fuel_type, return_qty)
 
-    combustion_emissions = dict()
-    for emission in emissions_list:
-        if emission.lower() in fuels_df:
-            combustion_emissions[f'{emission}'] = (fuels_df.at[fuel_type, emission.lower()]) * fuel_qty
-        else:
-            logger.warning(f'{emission} not found for {fuel_type}.')
+    emissions, emission_cols = fuel_emission_columns(fuel_table, emissions_list)
+    emission_factors = fuel_row[emission_cols]
+    if isinstance(fuel_qty, Dual):  # derivatives are only carried by Dual arithmetic
+        emission_qtys = [factor * fuel_qty for factor in emission_factors.tolist()]
+    else:  # one row of emission quantities per emission
+        emission_qtys = np.multiply.outer(emission_factors, fuel_qty)
+    combustion_emissions = dict(zip(emissions, emission_qtys))
 
-    if type(emissions_dict) == defaultdict:
+    if isinstance(emissions_dict, (defaultdict, flows.FlowVector)):
         # only writes balancing inflow O2 and energy if emissions and waste heat will be added to emission dict.
-        if type(inflows_dict) == defaultdict:
+        if isinstance(inflows_dict, (defaultdict, flows.FlowVector)):
             # closes mass balance
             inflows_dict[f'O2{bbcfg.ignore_sep}combustion'] += sum(combustion_emissions.values()) - fuel_qty
-            logger.debug(f"{sum(combustion_emissions.values()) - fuel_qty} of O2 added to inflow dict")
+            logger.debug("%s of O2 added to inflow dict", sum(combustion_emissions.values()) - fuel_qty)
 
             if write_energy_in is True:
                 inflows_dict[f'energy in combusted {fuel_type}'] += energy_qty
-                logger.debug(f"{energy_qty} of inflow energy added to inflow dict")
+                logger.debug("%s of inflow energy added to inflow dict", energy_qty)
 
         combustion_emissions['waste heat'] = energy_qty * (1 - combust_eff)
 
         for emission in combustion_emissions:
             emissions_dict[emission] += combustion_emissions[emission]
 
-    logger.debug("Emission Data Calculated:")
-    for emission in combustion_emissions:
-        logger.debug(f"{emission}: {combustion_emissions[emission]}")
+    logger.debug("Emission Data Calculated: %s", combustion_emissions)
 
     check_qty(return_qty)
     return return_qty
 
 
+def fuel_emission_columns(fuel_table, emissions_list):
+    """Returns the emissions in emissions_list that have emission factors in the fuel table,
+    and their column numbers. Cached in the fuel table, so that a warning is logged only
+    once for each emission without emission factors.
+
+    Args:
+        fuel_table (dict): compiled fuels dataframe (see frames_default.fuel_table)
+        emissions_list (list[str]): names of the emissions
+
+    Returns:
+        list[str]: emissions with emission factors in the fuel table
+        list[int]: the column numbers of those emissions in fuel_table['values']
+    """
+    key = tuple(emissions_list)
+    if key not in fuel_table['emissions']:
+        emissions, emission_cols = [], []
+        for emission in emissions_list:
+            if emission.lower() in fuel_table['columns']:
+                emissions.append(f'{emission}')
+                emission_cols.append(fuel_table['columns'][emission.lower()])
+            else:
+                logger.warning(f'{emission} not found in fuels data.')
+        fuel_table['emissions'][key] = (emissions, emission_cols)
+    return fuel_table['emissions'][key]
+
+
 def check_balance(inflow_dict, outflow_dict, raise_imbalance=True,
                   ignore_flows=[], only_these_flows=False, round_n=bbcfg.float_tol):
     """Checks whether inflow and outflow dictionaries sum to same total quantity
@@ -526,35 +796,25 @@ def check_balance(inflow_dict, outflow_dict, raise_imbalance=True,
 
     """
 
-    logger.info("checking whether dictionary value sums balance")
+    logger.debug("checking whether dictionary value sums balance")
 
     totals = [0, 0]
-    flows = [[], []]
+    counted = [[], []]
+    log_counted = logger.isEnabledFor(logging.DEBUG)
+    ignore_flows = tuple(ignore_flows)
+    if type(only_these_flows) is list:
+        only_these_flows = tuple(only_these_flows)
 
+    # flow classifications are cached by iof.has_affix
     for i, flow_dict in enumerate([inflow_dict, outflow_dict]):
-
         for substance, qty in flow_dict.items():
-            substance = iof.clean_str(substance)
-            ignore = False
-
-            if type(only_these_flows) is list:
-                logger.debug(f"Only including flows beginning/ending with {only_these_flows}")
-                ignore = True
-                for includable in only_these_flows:
-                    if substance.startswith(includable) or substance.endswith(includable):
-                        ignore = False
-
-            logger.debug(f"Ignoring flows beginning/ending with {ignore_flows}")
-            for ignorable in ignore_flows:
-                if substance.startswith(ignorable) or substance.endswith(ignorable):
-                    ignore = True
-
-            if ignore is True:
-                logger.debug(f'{substance} ({qty}) discarded')
-            if ignore is False:
-                logger.debug(f'{substance} ({qty}) included')
-                totals[i] += qty
-                flows[i].append(substance)
+            if type(only_these_flows) is tuple and not iof.has_affix(substance, only_these_flows):
+                continue
+            if iof.has_affix(substance, ignore_flows):
+                continue
+            totals[i] += qty
+            if log_counted:
+                counted[i].append(substance)
 
     total_in = round(totals[0], round_n)
     total_out = round(totals[1], round_n)
@@ -564,47 +824,137 @@ def check_balance(inflow_dict, outflow_dict, raise_imbalance=True,
             raise ValueError(f'IMBALANCED! Total In:  {total_in} v Total Out: {total_out}')
 
     else:
-        logger.debug(f"Total Inflow:  {totals[0]}")
-        logger.debug(f"Total Outflow: {totals[1]}")
-        logger.debug(f"Inflows:  {flows[0]}")
-        logger.debug(f"Outflows: {flows[1]}")
+        logger.debug("Total Inflow:  %s (%s)", totals[0], counted[0])
+        logger.debug("Total Outflow: %s (%s)", totals[1], counted[1])
 
     return total_in, total_out
 
 
-calcs_dict = {
-    'ratio': {'function': Ratio, 'kwargs': {}},
-    'remainder': {'function': Remainder, 'kwargs': {}},
-    'molmassratio': {'function': MolMassRatio, 'kwargs': {}},
-    'returnvalue': {'function': ReturnValue, 'kwargs': {}},
-    'subtraction': {'function': Subtraction, 'kwargs': {}},
-    'addition': {'function': Addition, 'kwargs': {}},
-    'energycontent-lhv': {'function': lookup_ratio, 'kwargs': {'var': 'lhv'}},
-    'energycontent-hhv': {'function': lookup_ratio, 'kwargs': {'var': 'hhv'}},
-    'energycontent': {'function': lookup_ratio, 'kwargs': {'var': 'lhv'}},
-    'combustion': {'function': Combustion, 'kwargs': {}},
-    'combustion-noenergyin': {'function': Combustion, 'kwargs': {'write_energy_in': False}},
-    'combustion-lhv': {'function': Combustion, 'kwargs': {'LHV': True}},
-    'combustion-lhv-noenergyin': {'function': Combustion, 'kwargs': {'LHV': True, 'write_energy_in': False}},
-    'combustion-hhv': {'function': Combustion, 'kwargs': {'LHV': False}},
-    'combustion-hhv-noenergyin': {'function': Combustion, 'kwargs': {'LHV': False, 'write_energy_in': False}},
-    'lookupratio': {'function': lookup_ratio, 'kwargs': {}},
-    'lookupratio-fuels': {'function': lookup_ratio, 'kwargs': {}},
-}
+# CALCULATOR REGISTRY
+calcs_dict = dict()
 """Names of calculation types available for the use in calculation tables.
 The keys in this dictionary should be all lowercase.
-Must be manually updated if additional calculators are added to this module. 
+
+Each entry is a dictionary with the calculator 'function', the 'kwargs' passed
+to it in addition to those provided by the unit process, and the capabilities
+declared when it was added using register_calculator ('n_qty', 'linear', 'array',
+'side_effects' and 'lookup_var').
 
 Used by the Unit Process class's balance function.
 
 """
 
-twoQty_calc_list = ['subtraction', 'addition']
+twoQty_calc_list = []
 """List of calculations that require two quantities to exist in the unit process flow dictionary.
+Derived from calcs_dict by register_calculator.
 
 Used by the Unit Process class's balance function.
 """
 
-lookup_var_calc_list = ['lookupratio', 'lookupratio-fuels', 'energycontent-lhv', 'energycontent', 'energycontent-hhv']
-"""List of calculations where the specified variable is for the lookup df, and not the unit process variable df
+lookup_var_calc_list = []
+"""List of calculations where the specified variable is for the lookup df, and not the unit process variable df.
+Derived from calcs_dict by register_calculator.
+"""
+
+linear_calc_list = []
+"""List of calculations whose result scales linearly with the known quantities.
+Derived from calcs_dict by register_calculator.
+
+Addition and subtraction are included since, within a unit process balance,
+both of their quantities scale with the product quantity.
+Used by the Unit Process class's balance function to decide whether a balance
+can be scaled from a cached balance on one unit of product.
+"""
+
+array_calc_list = []
+"""List of calculations whose functions accept numpy arrays of quantities and variables
+(one element per scenario). Derived from calcs_dict by register_calculator.
+
+Used by the Unit Process class's balance_many function. Other calculations are
+performed one scenario at a time.
+"""
+
+side_effect_calc_list = []
+"""List of calculations that also write flows to the emissions ('e') or co-inflows ('c')
+dictionaries of the unit process. Derived from calcs_dict by register_calculator.
 """
+
+
+def register_calculator(name, function, kwargs=None, n_qty=1, linear=False, array=False,
+                        side_effects=None, lookup_var=False):
+    """Adds a calculation type for use in calculation tables, or replaces an existing one.
+
+    Calculators that do not declare themselves linear or array-capable are always
+    calculated individually, for every scenario and product quantity, so custom
+    calculators are safe to add without declaring any capabilities.
+
+    Args:
+        name (str): name of the calculation type, as used in calculation tables.
+        function (function): the calculator function. It is called with keyword arguments
+            (qty, var, known_substance, unknown_substance, qty2, invert, emissions_dict,
+            inflows_dict, lookup_df, etc.), so it should accept **kwargs.
+        kwargs (dict): additional keyword arguments to pass to the function.
+            (Defaults to None)
+        n_qty (int): the number of known quantities required (1, or 2 if the
+            calculation also uses a second known substance, as with addition)
+            (Defaults to 1)
+        linear (bool): whether the result (and any side effect flows) scale linearly
+            with the known quantities, so that balances can be cached and scaled.
+            (Defaults to False)
+        array (bool): whether the function accepts numpy arrays for qty, qty2 and var.
+            (Defaults to False)
+        side_effects (list[str]): the flow dictionaries the function writes to besides
+            returning the unknown quantity ('e' for emissions_dict, 'c' for inflows_dict).
+            (Defaults to None)
+        lookup_var (bool): whether the variable specified in the calculation table is
+            the column of a lookup dataframe, rather than a unit process variable.
+            (Defaults to False)
+    """
+    if n_qty not in [1, 2]:
+        raise ValueError(f"{name}: calculators can use 1 or 2 known quantities, not {n_qty}")
+    side_effects = list(side_effects) if side_effects else []
+    for io in side_effects:
+        if io not in ['e', 'c']:
+            raise ValueError(f"{name}: {io} is not a flow dictionary calculators can write to ('e' or 'c')")
+
+    calcs_dict[name.lower()] = dict(
+        function=function,
+        kwargs=kwargs if kwargs else {},
+        n_qty=n_qty,
+        linear=linear,
+        array=array,
+        side_effects=side_effects,
+        lookup_var=lookup_var,
+    )
+    update_calc_lists()
+
+
+def update_calc_lists():
+    """Rebuilds the lists of calculation types from the capabilities in calcs_dict.
+    The lists are updated in place, so that references to them stay current.
+    """
+    twoQty_calc_list[:] = [c for c, entry in calcs_dict.items() if entry['n_qty'] == 2]
+    lookup_var_calc_list[:] = [c for c, entry in calcs_dict.items() if entry['lookup_var'] is True]
+    linear_calc_list[:] = [c for c, entry in calcs_dict.items() if entry['linear'] is True]
+    array_calc_list[:] = [c for c, entry in calcs_dict.items() if entry['array'] is True]
+    side_effect_calc_list[:] = [c for c, entry in calcs_dict.items() if entry['side_effects']]
+
+
+register_calculator('ratio', Ratio, linear=True, array=True)
+register_calculator('remainder', Remainder, linear=True, array=True)
+register_calculator('molmassratio', MolMassRatio, linear=True, array=True)
+register_calculator('returnvalue', ReturnValue, linear=True, array=True)
+register_calculator('subtraction', Subtraction, n_qty=2, linear=True, array=True)
+register_calculator('addition', Addition, n_qty=2, linear=True, array=True)
+register_calculator('energycontent-lhv', lookup_ratio, {'var': 'lhv'}, linear=True, array=True, lookup_var=True)
+register_calculator('energycontent-hhv', lookup_ratio, {'var': 'hhv'}, linear=True, array=True, lookup_var=True)
+register_calculator('energycontent', lookup_ratio, {'var': 'lhv'}, linear=True, array=True, lookup_var=True)
+for name, kwargs in [('combustion', {}),
+                     ('combustion-noenergyin', {'write_energy_in': False}),
+                     ('combustion-lhv', {'LHV': True}),
+                     ('combustion-lhv-noenergyin', {'LHV': True, 'write_energy_in': False}),
+                     ('combustion-hhv', {'LHV': False}),
+                     ('combustion-hhv-noenergyin', {'LHV': False, 'write_energy_in': False})]:
+    register_calculator(name, Combustion, kwargs, linear=True, array=True, side_effects=['e', 'c'])
+register_calculator('lookupratio', lookup_ratio, linear=True, array=True, lookup_var=True)
+register_calculator('lookupratio-fuels', lookup_ratio, linear=True, array=True, lookup_var=True)
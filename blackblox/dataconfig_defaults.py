@@ -62,6 +62,8 @@ day_str_default = datetime.now().strftime("%Y%m%d")
 time_str_default = datetime.now().strftime("%H%M")
 timestamp_str_default = day_str_default + 'T' + time_str_default
 
+balance_cache_size_default = 128
+
 
 # Diagram line styling
 diagram_default = DiagramConfig(
@@ -178,6 +180,7 @@ default = Config(
     connect_all=connect_all_default,
     all_factories=all_factories_default,
     timestamp_str=timestamp_str_default,
+    balance_cache_size=balance_cache_size_default,
     diagram=diagram_default,
     columns=columns_default,
     paths=paths_default,
@@ -325,6 +325,14 @@ class Config:
     timestamp_str: str
     """str: Timestamp used mainly as prefix for output directories and files, thus disambuigating multiple runs"""
 
+    balance_cache_size: int
+    """int: number of normalized (per unit of product) balances kept by each unit process,
+    and of chain and factory balances kept by each factory
+
+    Balances on any other product quantity are scaled from the cached balance.
+    Set to 0 to always recalculate the unit process (and chain and factory).
+    """
+
     diagram: DiagramConfig
     columns: ColumnConfig
     paths: PathConfig
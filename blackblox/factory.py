@@ -11,15 +11,36 @@ factory.
 Module Outline:
 
 - import statements and logger
+- class: Connection
 - class: Factory
     - class function: Balance
     - class function: Diagram
     - class function: Run_Scenarios
+    - class function: Run_Sensitivity
+    - class function: Balance_Derivatives
+    - class function: Technology_Matrix
+    - class function: Balance_Matrix
+    - class function: Override_Vars
+    - class function: Dependency_Graph
+    - class function: Downstream_Chains
+    - class function: Rebalance
     
     used in factory.Balance():
+    - class subfunction: balance_factory_chains
+    - class subfunction: balance_chains
+    - class subfunction: balance_chain
+    - class subfunction: balance_chain_step
+    - class subfunction: copy_chain_balance
+    - class subfunction: scale_chain_balance
+    - class subfunction: scale_chain_flows
+    - class subfunction: copy_factory_balance
+    - class subfunction: scale_factory_balance
+    - class subfunction: clear_chain_cache
+    - class subfunction: compile_connections
     - class subfunction: check_origin_product
     - class subfunction: check_product_qty
     - class subfunction: check_for_value
+    - class subfunction: check_for_fraction
     - class subfunction: check_for_recycle_fractions
     - class subfunction: check_for_lookup
     - class subfunction: connect_recycle_flow
@@ -29,18 +50,24 @@ Module Outline:
     - class subfunction: factory_to_excel
 """
 import platform
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from math import isnan
 
 import graphviz
+import numpy as np
 import pandas as pan
 from graphviz import Digraph
 
 import blackblox.calculators as calc
 from blackblox.dataconfig import bbcfg
 import blackblox.io_functions as iof
+import blackblox.flows as flows
+import blackblox.parallel as parallel
 import blackblox.processchain as cha
+import blackblox.techmatrix as tm
+import blackblox.unitprocess as uni
 from blackblox.bb_log import get_logger
+import blackblox.bb_trace as trace
 import blackblox.frames_default as fd
 
 
@@ -52,6 +79,60 @@ if platform.system() == 'Windows':
 logger = get_logger("Factory")
 
 
+class Connection:
+    """A connection between two chains of a factory, compiled from one row of 
+    the factory's connections table (see Factory.compile_connections), so that 
+    the row is only parsed once rather than on every balance.
+
+    Attributes:
+        origin_chain (ProductChain): the chain the connected product comes from
+        origin_unit (UnitProcess/bool): the unit process the product comes from,
+            or False if it comes from all of the origin chain's unit processes
+        origin_product (str): the connected product, as written in the table
+            (lookup variables are substituted when balancing)
+        origin_io (str): the flow type of the product at its origin ('i' or 'o')
+        connect_all (bool): whether the product comes from all of the origin
+            chain's unit processes (its chain totals)
+        dest_chain (ProductChain): the chain the product is connected to
+        dest_unit (UnitProcess/bool): the unit process the product is connected
+            to, or False if it is a final inflow or outflow of the destination chain
+        dest_product (str/bool): the name of the product in the destination chain,
+            or False if it has the same name as at its origin
+        dest_io (str): the flow type of the product at its destination ('i' or 'o')
+        recycle (bool): whether the product replaces a flow of the destination
+            unit process, rather than balancing the destination chain
+        replace (str/None): the flow replaced by a recycled product
+        purge_fraction (float): the fraction of a recycled product that is purged
+        max_replace_fraction (float): the maximum fraction of the replaced flow
+            that the recycled product can replace
+    """
+    __slots__ = ('origin_chain', 'origin_unit', 'origin_product', 'origin_io', 'connect_all',
+                 'dest_chain', 'dest_unit', 'dest_product', 'dest_io',
+                 'recycle', 'replace', 'purge_fraction', 'max_replace_fraction')
+
+    def __init__(self, origin_chain, origin_unit, origin_product, origin_io, connect_all,
+                 dest_chain, dest_unit, dest_product, dest_io,
+                 recycle=False, replace=None, purge_fraction=0.0, max_replace_fraction=1.0):
+        self.origin_chain = origin_chain
+        self.origin_unit = origin_unit
+        self.origin_product = origin_product
+        self.origin_io = origin_io
+        self.connect_all = connect_all
+        self.dest_chain = dest_chain
+        self.dest_unit = dest_unit
+        self.dest_product = dest_product
+        self.dest_io = dest_io
+        self.recycle = recycle
+        self.replace = replace
+        self.purge_fraction = purge_fraction
+        self.max_replace_fraction = max_replace_fraction
+
+    def __repr__(self):
+        return (f"Connection({self.origin_chain.name}: {self.origin_product} ({self.origin_io}) -> "
+                f"{self.dest_chain.name}: {self.dest_product or self.origin_product} ({self.dest_io})"
+                f"{', recycled' if self.recycle else ''})")
+
+
 class Factory:
     """Factories link together multiple ProductChains.
 
@@ -78,6 +159,10 @@ class Factory:
             data.
             Defaults to None.
         name (str, optional): The name of the factory. Defaults to False.
+        unit_pool (dict/None): pool of UnitProcess objects to share with other
+            factories (see unitprocess.pooled_unit_process). If None, each chain
+            creates its own UnitProcess objects.
+            Defaults to None.
    
     Attributes:
         name (str): Factory name
@@ -85,6 +170,8 @@ class Factory:
             location of their data.
         connections_df (data frame): Tabular data of the connections
             between the factory chains. (optional)
+        connections (list[Connection]): the connections of connections_df, 
+            compiled when connections_df is set.
         main_chain (str): the name of the factory's product chain, taken from
             the first row of chains_df.
         main_product (str): the name of the factory's main product, taken from 
@@ -93,6 +180,16 @@ class Factory:
             objects in the factory. Each chain name is an entry key, with a 
             value of a dictionary containing the process chain object, name,
             product, and whether that product is a chain inflow or outflow.  
+        chain_cache (OrderedDict): Least recently used cache of chain balances
+            on one unit of product, used by balance_chain.
+        chain_cache_stats (dict): number of chain balances scaled from the
+            cache ('hits') and balanced in full ('misses').
+        factory_cache (OrderedDict): Least recently used cache of factory balances,
+            used by balance_factory_chains.
+        factory_cache_stats (dict): number of factory balances scaled from the
+            cache ('hits') and balanced in full ('misses').
+        last_balance (dict/None): the arguments of the last balance of the factory 
+            and a copy of each chain balance in it, used by rebalance.
         **kwargs (dict): unused; allows for use of dictionaries with more variables
             than just used to define the class
     
@@ -102,7 +199,7 @@ class Factory:
     # noinspection PyUnusedLocal
     def __init__(self, chain_list_file, chain_list_sheet=None, connections_file=None,
                  connections_sheet=None, name=None, outdir=None,
-                 units_df=None, **kwargs):
+                 units_df=None, unit_pool=None, **kwargs):
 
         fd.initialize()
         units_df = units_df if units_df is not None else fd.df_unit_library
@@ -152,7 +249,8 @@ class Factory:
             self.chain_dict[name] = dict(chain=cha.ProductChain(chain_file,
                                          name=name,
                                          xls_sheet=chain_sheet,
-                                         units_df=units_df),
+                                         units_df=units_df,
+                                         unit_pool=unit_pool),
                                          name=name,
                                          product=c[bbcfg.columns.chain_product],
                                          i_o=iof.clean_str(c[bbcfg.columns.chain_io][0]))
@@ -169,15 +267,40 @@ class Factory:
 
         self.outdir = (outdir if outdir else bbcfg.paths.path_outdir) / f'{bbcfg.timestamp_str}__factory_{self.name}'
 
+        self.chain_cache = OrderedDict()  # chain balances on one unit of product (see balance_chain)
+        self.chain_cache_stats = dict(hits=0, misses=0)
+        self.factory_cache = OrderedDict()  # factory balances, scaled to any product_qty (see balance_factory_chains)
+        self.factory_cache_stats = dict(hits=0, misses=0)
+        self.last_balance = None  # retained for rebalance (see balance_chain_step)
+
         logger.info(f"{self.name.upper()}: Initalization successful")
 
+    @property
+    def connections_df(self):
+        return self._connections_df
+
+    @connections_df.setter
+    def connections_df(self, connections_df):
+        self._connections_df = connections_df
+        self.connections = self.compile_connections(connections_df)
+
+    def __getstate__(self):
+        # cached chain and factory balances are not copied (e.g. to worker processes)
+        state = self.__dict__.copy()
+        state['chain_cache'] = OrderedDict()
+        state['chain_cache_stats'] = dict(hits=0, misses=0)
+        state['factory_cache'] = OrderedDict()
+        state['factory_cache_stats'] = dict(hits=0, misses=0)
+        state['last_balance'] = None
+        return state
+
     def balance(self, scenario=None, 
                 product_qty=1.0, product=False, product_unit=False, product_io=False,
                 upstream_outflows=False, upstream_inflows=False,
                 downstream_outflows=False, downstream_inflows=False,
                 aggregate_flows=False, net_flows=False, 
                 write_to_console=False, write_to_xls=True, 
-                outdir=None, subdir=False, file_id=''):
+                outdir=None, subdir=False, file_id='', overrides=None, rebalance_chains=None, _overrides=None):
         """Calculates the mass balance of the factory using qty of main product
 
         Balances all UnitProcesses and Chains in the factory
@@ -210,6 +333,15 @@ class Factory:
             write_to_xls (bool): If True, outputs the balance results to an Excel 
                 workbook in bbcfg.paths.path_outdir.
                 (Defaults to True)
+            overrides (dict/None): variable values to use instead of those in the 
+                unit processes' var_df, for this balance only, keyed by 
+                (chain name, unit process ID, variable name). See override_vars.
+                (Defaults to None)
+            rebalance_chains (set/None): If a set of chain names, only those chains
+                are balanced again; the other chains reuse their balance from the
+                last balance of the factory, if balanced on the same quantity.
+                Used by rebalance.
+                (Defaults to None)
 
         Returns:
             dictionary of factory inflow substances and total quantities
@@ -217,183 +349,54 @@ class Factory:
 
               
         """
+        if overrides:
+            with self.override_vars(overrides):
+                return self.balance(scenario=scenario, product_qty=product_qty, product=product,
+                                    product_unit=product_unit, product_io=product_io,
+                                    upstream_outflows=upstream_outflows, upstream_inflows=upstream_inflows,
+                                    downstream_outflows=downstream_outflows, downstream_inflows=downstream_inflows,
+                                    aggregate_flows=aggregate_flows, net_flows=net_flows,
+                                    write_to_console=write_to_console, write_to_xls=write_to_xls,
+                                    outdir=outdir, subdir=subdir, file_id=file_id,
+                                    rebalance_chains=rebalance_chains, _overrides=overrides)
 
         logger.info(f"{self.name.upper()}: attempting to balance on {product_qty} of {self.chain_dict[self.main_chain]['product']}")
 
         scenario = scenario if scenario else bbcfg.scenario_default
 
-        # create flow dictionaries
-        io_dicts = {
-            'i': iof.nested_dicts(3, float),  # io_dicts['i'][chain][unit][substance] = float
-            'o': iof.nested_dicts(3, float),  # io_dicts['o'][chain][unit][substance] = float
-        }
-        chain_intermediates_dict = iof.nested_dicts(3, float)
-        intermediate_product_dict = defaultdict(
-            float)  # tracks intra-factory flows (to be subtracted from factory totals)
-        remaining_product_dict = iof.nested_dicts(4,
-                                                  float)  # tracks products used for recycle flows (dict[i_o][chain][unit][substance] = float)
-        internal_flows = []  # tracks intra-factory flows (origin/destination data)
+        # arguments and chain balances retained for rebalance
+        balance_kwargs = dict(scenario=scenario, product_qty=product_qty, product=product, product_unit=product_unit,
+                              product_io=product_io, upstream_outflows=upstream_outflows,
+                              upstream_inflows=upstream_inflows, downstream_outflows=downstream_outflows,
+                              downstream_inflows=downstream_inflows, aggregate_flows=aggregate_flows,
+                              net_flows=net_flows)
+        if _overrides:  # retained with the balance made within their override_vars context
+            balance_kwargs['overrides'] = _overrides
+        chain_balances = []
+        retained = self.last_balance['chain_balances'] if rebalance_chains is not None and self.last_balance else None
 
-        # balances main ProductChain
-        main = self.chain_dict[self.main_chain]
         if product is False:
-            product = main['product']
+            product = self.chain_dict[self.main_chain]['product']
 
-        (io_dicts['i'][main['name']],
-         io_dicts['o'][main['name']],
-         chain_intermediates_dict[main['name']],
-         main_chain_internal_flows) = main['chain'].balance(
-            product_qty,
-            product=product,
-            i_o=product_io,
-            unit_process=product_unit,
-            scenario=scenario
-        )
-
-        logger.debug(f"{self.name.upper()}: balanced main chain {main['name']} on {product_qty} of {product}")
-        internal_flows.extend(main_chain_internal_flows)  # keeps track of flows betwen units
-
-        # balances auxillary ProductChains
-        if self.connections_df is not None:
-            for dummy_index, row in self.connections_df.iterrows():
-
-                # reset variables
-                orig_product_io = iof.clean_str(row[bbcfg.columns.origin_io][0])
-                orig_product = row[bbcfg.columns.origin_product]
-                qty_remaining = 0
-
-                dest_unit = False
-                dest_unit_id = False
-                dest_product = False
-                dest_product_io = iof.clean_str(row[bbcfg.columns.dest_io][0])
-
-                i_tmp = None
-                o_tmp = None
-
-                # identify origin (existing) and destination (connecting) ProductChains
-                orig_chain = self.chain_dict[row[bbcfg.columns.origin_chain]]['chain']
-                if not io_dicts[orig_product_io][orig_chain.name]:
-                    raise KeyError(
-                        f"{[orig_chain.name]} has not been balanced yet. Please check the order of your connections.")
-
-                dest_chain = self.chain_dict[row[bbcfg.columns.dest_chain]]['chain']
-                if bbcfg.columns.dest_unit in row:
-                    if row[bbcfg.columns.dest_unit] in dest_chain.process_dict:
-                        dest_unit = dest_chain.process_dict[row[bbcfg.columns.dest_unit]]
-                        dest_unit_id = dest_unit.u_id
-
-                # if destination chain connects to all UnitProcesses in origin chain, 
-                # use totals flow values from origin chain, rather than individual UnitProcess data
-                if row[bbcfg.columns.origin_unit] == bbcfg.connect_all:
-                    qty = io_dicts[orig_product_io][orig_chain.name]['chain totals'][orig_product]
-                    orig_unit = False
-                    logger.debug(f"using {qty} of {orig_product} from all units in {orig_chain.name}")
-
-                else:
-                    orig_unit = orig_chain.process_dict[row[bbcfg.columns.origin_unit]]
-
-                    # processes substance name based on seperator and lookup key rules
-                    orig_product = self.check_origin_product(orig_product, orig_unit, scenario)
-
-                    # get product qty, checking to see if product has already been used elsewhere
-                    qty = self.check_product_qty(orig_product, orig_product_io, orig_chain.name,
-                                                 orig_unit.name, io_dicts, remaining_product_dict)
-
-                if round(qty, bbcfg.float_tol) < 0:
-                    raise ValueError(f"{qty} of {orig_product}  from {orig_unit.name} in {orig_chain.name} < 0.")
-
-                # For Recycle Connections
-                if self.check_for_value(bbcfg.columns.replace, row) is True:
-                    logger.debug(f"{self.name.upper()}: attempting to recycle {orig_product} from {orig_unit.name}")
-
-                    new_chain_in_dict, new_chain_out_dict, qty_remaining, replace_flow = self.connect_recycle_flow(qty,
-                                                                                                                   row,
-                                                                                                                   scenario,
-                                                                                                                   orig_chain,
-                                                                                                                   orig_unit,
-                                                                                                                   orig_product,
-                                                                                                                   dest_chain,
-                                                                                                                   dest_unit,
-                                                                                                                   dest_product_io,
-                                                                                                                   io_dicts,
-                                                                                                                   chain_intermediates_dict)
-
-                    io_dicts['i'][dest_chain.name] = new_chain_in_dict
-                    io_dicts['o'][dest_chain.name] = new_chain_out_dict
-                    remaining_product_dict[orig_product_io][orig_chain.name][orig_unit.name][
-                        orig_product] = qty_remaining
-
-                    logger.debug(
-                        f"{self.name.upper()}: {remaining_product_dict[orig_product_io][orig_chain.name][orig_unit.name][orig_product]} {orig_product} remaining for {orig_chain.name}-{orig_unit.name}")
-
-                # For Non-Recycle Connection
-                else:
-                    replace_flow = None
-
-                    # allow for "connect as" products
-                    dest_product = self.check_for_value(bbcfg.columns.dest_product, row, ifyes=row[bbcfg.columns.dest_product],
-                                                        ifno=orig_product)
-
-                    # balance auxillary chain based on qty of connecting product from already-calculated origin chain
-                    logger.debug(
-                        f"sending {qty} of {orig_product} to {dest_chain.name} as {dest_product} ({dest_product_io}-flow)")
-
-                    (i_tmp, o_tmp,
-                     chain_intermediates_dict[dest_chain.name],
-                     chain_internal_flows) = dest_chain.balance(product_qty=qty,
-                                                                product=dest_product,
-                                                                product_alt_name=orig_product,
-                                                                i_o=dest_product_io,
-                                                                unit_process=dest_unit_id,
-                                                                scenario=scenario, )
-
-                    internal_flows.extend(chain_internal_flows)
-
-                    # add chain inflow/outflow data to factory inflow/outflow dictionaries
-                    # if chain already exists, add flow values instead of replacing
-                    if io_dicts['i'][dest_chain.name] and io_dicts['o'][dest_chain.name]:
-                        for process_dict in i_tmp:
-                            for substance, i_qty in i_tmp[process_dict].items():
-                                io_dicts['i'][dest_chain.name][process_dict][substance] += i_qty
-                        for process_dict in o_tmp:
-                            for substance, o_qty in o_tmp[process_dict].items():
-                                io_dicts['o'][dest_chain.name][process_dict][substance] += o_qty
-                    else:
-                        io_dicts['i'][dest_chain.name] = i_tmp
-                        io_dicts['o'][dest_chain.name] = o_tmp
-
-                    logger.debug(
-                        f"{qty} of {orig_product} as product from {orig_chain.name} ({orig_product_io}) sent to to {dest_chain.name} ({dest_product_io})")
-
-                # FOR ALL CONNECTIONS
-                # add intra-chain product qty to intra-factory flow dictionary (to be deleted from factory total in/out)
-                intermediate_product_dict[orig_product] += (qty - qty_remaining)
-                logger.debug(f"{qty - qty_remaining} of {orig_product} added to intermediate_product_dict")
-
-                # update list of intra-factory flows for documentation output
-                internal_flows.append(
-                    self.describe_internal_flow(row, qty, qty_remaining, orig_chain, orig_unit, orig_product,
-                                                orig_product_io, dest_chain, dest_unit, dest_product, dest_product_io,
-                                                replace_flow))
+        io_dicts, intermediate_product_dict, internal_flows = self.balance_factory_chains(scenario,
+                                                                                          product_qty,
+                                                                                          product,
+                                                                                          product_unit,
+                                                                                          product_io,
+                                                                                          chain_balances,
+                                                                                          retained,
+                                                                                          rebalance_chains)
 
         # Calculate Factory-level inflows and outflows
+        # aggregate chain totals
         factory_totals = {
-            'i': defaultdict(float),
-            'o': defaultdict(float)
+            'i': flows.total(io_dicts['i'][chain]['chain totals'] for chain in io_dicts['i']),
+            'o': flows.total(io_dicts['o'][chain]['chain totals'] for chain in io_dicts['o'])
         }
 
-        # aggregate chain totals 
-        for chain in io_dicts['i']:
-            for inflow, qty in io_dicts['i'][chain]['chain totals'].items():
-                factory_totals['i'][inflow] += qty
-        for chain in io_dicts['o']:
-            for outflow, qty in io_dicts['o'][chain]['chain totals'].items():
-                factory_totals['o'][outflow] += qty
-
         # remove inter-chain flows
         for io_dict in factory_totals:
-            for product, qty in intermediate_product_dict.items():
-                factory_totals[io_dict][product] -= qty  # removes intermediate product quantities
+            factory_totals[io_dict].subtract(intermediate_product_dict)  # removes intermediate product quantities
 
         # add additional upstream/downstream flows for factory inflows and outflows, based on factory totals
         if type(upstream_outflows) is list or type(
@@ -433,6 +436,8 @@ class Factory:
             self.factory_to_excel(io_dicts, factory_totals, internal_flows,
                                   scenario, product_qty, aggregated_df, net_df, outdir, subdir, file_id)
 
+        self.last_balance = dict(kwargs=balance_kwargs, chain_balances=chain_balances)
+
         logger.debug(f"successfully balanced factory on {product_qty} of {self.chain_dict[self.main_chain]['product']}")
 
         return factory_totals['i'], factory_totals['o'], aggregated_df, net_df
@@ -581,7 +586,7 @@ class Factory:
                       product_qty=1.0, product=False, product_unit=False, product_io=False,
                       upstream_outflows=False, upstream_inflows=False, downstream_outflows=False,
                       downstream_inflows=False, aggregate_flows=False, net_flows=False, write_to_xls=True,
-                      factory_xls=True, outdir=None, file_id='', subdir='scenario factories'):
+                      factory_xls=True, outdir=None, file_id='', subdir='scenario factories', workers=1):
         """Balances the Factory using different sets of variable values.
         Creates a spreadsheet comparing inflows and outflows for the factory for each scenario.
 
@@ -592,6 +597,11 @@ class Factory:
                 process's var_df. 
             file_id (str): Additional text to add to filename.
                 (Defaults to an empty string)
+            workers (int): The number of processes to balance the scenarios in.
+                If greater than 1, the scenarios are balanced in a pool of worker 
+                processes, each with its own copy of the factory (see blackblox.parallel).
+                The results are the same as when balanced one after another.
+                (Defaults to 1)
 
             factory_xls: 
 
@@ -605,21 +615,27 @@ class Factory:
 
         scenario_dict = iof.nested_dicts(3)
 
+        balance_kwargs = dict(product_qty=product_qty,
+                              product=product,
+                              product_unit=product_unit,
+                              product_io=product_io,
+                              upstream_outflows=upstream_outflows,
+                              upstream_inflows=upstream_inflows,
+                              downstream_outflows=downstream_outflows,
+                              downstream_inflows=downstream_inflows,
+                              aggregate_flows=aggregate_flows,
+                              net_flows=net_flows,
+                              write_to_xls=factory_xls,
+                              outdir=outdir,
+                              subdir=subdir)
+
+        if workers > 1 and len(scenario_list) > 1:
+            results = parallel.balance_scenarios(self, scenario_list, workers, **balance_kwargs)
+        else:
+            results = {scenario: self.balance(scenario=scenario, **balance_kwargs) for scenario in scenario_list}
+
         for scenario in scenario_list:
-            f_in, f_out, agg_df, net_df = self.balance(product_qty=product_qty,
-                                                       product=product,
-                                                       product_unit=product_unit,
-                                                       product_io=product_io,
-                                                       scenario=scenario,
-                                                       upstream_outflows=upstream_outflows,
-                                                       upstream_inflows=upstream_inflows,
-                                                       downstream_outflows=downstream_outflows,
-                                                       downstream_inflows=downstream_inflows,
-                                                       aggregate_flows=aggregate_flows,
-                                                       net_flows=net_flows,
-                                                       write_to_xls=factory_xls,
-                                                       outdir=outdir,
-                                                       subdir=subdir)
+            f_in, f_out, agg_df, net_df = results[scenario]
 
             scenario_dict['i'][scenario] = f_in
             scenario_dict['o'][scenario] = f_out
@@ -706,7 +722,7 @@ class Factory:
                         upstream_outflows=False, upstream_inflows=False,
                         downstream_outflows=False, downstream_inflows=False, 
                         aggregate_flows=False, net_flows=False,
-                        individual_xls=False, outdir=None, id=''):
+                        individual_xls=False, outdir=None, id='', workers=1):
         """Balances the factory on the same quantity for a list of different scenarios.
         Outputs a file with total inflows and outflows for the factory for each scenario.
 
@@ -718,7 +734,12 @@ class Factory:
             variable_options
             fixed_vars
             id (str): optional file name prefix
+            workers (int): The number of processes to balance the variable options in
+                (see run_scenarios).
+                (Defaults to 1)
 
+        The variable values are set with override_vars, so the unit processes'
+        var_df are not changed.
 
         Returns:
             Dataframe of compared inflows
@@ -729,53 +750,47 @@ class Factory:
 
         scenario_dict = iof.nested_dicts(3)
 
-        units = []
-        original_var_dfs = []
-
         if type(unit_name) is list:
-            for i, unit in enumerate(unit_name):
-                units.append(self.chain_dict[chain_name[i]]['chain'].process_dict[unit])
-
+            units = list(zip(chain_name, unit_name))
         else:
-            units = [self.chain_dict[chain_name]['chain'].process_dict[unit_name]]
-
-        # change variables which will remain static between sensitivity runs
-        for unit in units:
-            original_var_dfs.append(unit.var_df.copy())
+            units = [(chain_name, unit_name)]
 
+        # variables which remain static between sensitivity runs
+        fixed_overrides = dict()
         if type(fixed_vars) is list:
             for fixedvar, fixedvalue in fixed_vars:
-                for unit in units:
-                    if scenario in unit.var_df.index: 
-                        unit.var_df.loc[scenario, fixedvar.lower()] = fixedvalue
-                        logger.debug(f"{variable} for {unit} ({scenario} set to {fixedvalue}) (fixed over all sensitivity analyses)")
-                    else:
-                        unit.var_df.loc[bbcfg.scenario_default, fixedvar.lower()] = fixedvalue
-                        logger.debug(f"{variable} for {unit} ({bbcfg.scenario_default} set to {fixedvalue}) (fixed over all sensitivity analyses)")
+                for chain, unit in units:
+                    fixed_overrides[(chain, unit, fixedvar)] = fixedvalue
+                    logger.debug(f"{fixedvar} for {unit} ({scenario}) set to {fixedvalue} (fixed over all sensitivity analyses)")
 
         # evaluate over varying variables
+        run_list = []
         for value in variable_options:
-            for unit in units:
-                if scenario in unit.var_df.index: 
-                    unit.var_df.loc[scenario, variable.lower()] = value
-                    logger.debug(f"{variable} for {unit.name} ({scenario}) set to {value})")
-                else:
-                    unit.var_df.loc[bbcfg.scenario_default, variable.lower()] = value
-                    logger.debug(f"{variable} for {unit.name} ({bbcfg.scenario_default}) set to {value})")
+            overrides = dict(fixed_overrides)
+            for chain, unit in units:
+                overrides[(chain, unit, variable)] = value
+                logger.debug(f"{variable} for {unit} ({scenario}) set to {value}")
+            run_list.append(dict(overrides=overrides, outdir=f"{outdir}/{value}"))
+
+        balance_kwargs = dict(product_qty=product_qty,
+                              product=product,
+                              product_unit=product_unit,
+                              product_io=product_io,
+                              scenario=scenario,
+                              upstream_outflows=upstream_outflows,
+                              upstream_inflows=upstream_inflows,
+                              downstream_outflows=downstream_outflows,
+                              downstream_inflows=downstream_inflows,
+                              aggregate_flows=aggregate_flows,
+                              net_flows=net_flows,
+                              write_to_xls=individual_xls)
+
+        if workers > 1 and len(run_list) > 1:
+            results = parallel.balance_runs(self, run_list, workers, **balance_kwargs)
+        else:
+            results = [self.balance(**run_kwargs, **balance_kwargs) for run_kwargs in run_list]
 
-            f_in, f_out, agg_df, net_df = self.balance(product_qty=product_qty,
-                                                       product=product,
-                                                       product_unit=product_unit,
-                                                       product_io=product_io,
-                                                       scenario=scenario,
-                                                       upstream_outflows=upstream_outflows,
-                                                       upstream_inflows=upstream_inflows,
-                                                       downstream_outflows=downstream_outflows,
-                                                       downstream_inflows=downstream_inflows,
-                                                       aggregate_flows=aggregate_flows,
-                                                       net_flows=net_flows,
-                                                       write_to_xls=individual_xls,
-                                                       outdir=f"{outdir}/{value}")
+        for value, (f_in, f_out, agg_df, net_df) in zip(variable_options, results):
 
             scenario_dict['i'][f'{scenario}_{unit_name}-{variable}_{value}'] = f_in
             scenario_dict['o'][f'{scenario}_{unit_name}-{variable}_{value}'] = f_out
@@ -843,16 +858,696 @@ class Factory:
                          outdir=outdir,
                          filename=f'{self.name}_{id}f_sens_{bbcfg.timestamp_str}')
 
-        for i, unit in enumerate(units):
-            unit.var_df = original_var_dfs[i].copy()
-
         return inflows_df, outflows_df, agg_flow_dfs[0], agg_flow_dfs[1], agg_flow_dfs[2]  # aggregated_dict
 
+    def balance_derivatives(self, variables, scenario=None, product_qty=1.0, product=False,
+                            product_unit=False, product_io=False, **kwargs):
+        """Balances the factory once, also calculating the derivatives of every factory
+        flow with respect to each of the selected unit process variables.
+
+        Quantities calculated from the selected variables carry their derivatives
+        (see calculators.Dual) through the unit process, chain and factory balances,
+        so that a single balance gives the same result as perturbing each variable
+        separately (as in run_sensitivity) for small changes in the variables.
+
+        Args:
+            variables (list[tuple]): the (chain name, unit process ID, variable name)
+                of each variable to calculate derivatives for
+            scenario, product_qty, product, product_unit, product_io: as in Factory.balance
+            **kwargs: other arguments passed to Factory.balance (files are not written)
+
+        Returns:
+            Series of factory inflow quantities
+            Series of factory outflow quantities
+            DataFrame of the derivatives of the inflows (rows) with respect to
+                each (chain, unit, variable) (columns)
+            DataFrame of the derivatives of the outflows (rows) with respect to
+                each (chain, unit, variable) (columns)
+        """
+        var_indices = defaultdict(dict)  # var_indices[unit][variable] = gradient position
+        for index, (chain_name, unit_id, variable) in enumerate(variables):
+            unit = self.chain_dict[chain_name]['chain'].process_dict[unit_id]
+            var_indices[unit][variable] = index
+
+        try:
+            for unit, unit_vars in var_indices.items():
+                unit.set_derivative_vars(unit_vars, size=len(variables))
+            kwargs['write_to_xls'] = False
+            f_in, f_out, agg_df, net_df = self.balance(scenario=scenario,
+                                                       product_qty=product_qty,
+                                                       product=product,
+                                                       product_unit=product_unit,
+                                                       product_io=product_io,
+                                                       **kwargs)
+        finally:
+            for unit in var_indices:
+                unit.set_derivative_vars(dict())
+
+        columns = pan.MultiIndex.from_tuples(variables, names=['chain', 'unit', 'variable'])
+        results = []
+        for flow_dict in [f_in, f_out]:
+            substances = sorted(flow_dict)
+            values = pan.Series([float(flow_dict[s]) for s in substances], index=substances, dtype=float)
+            jacobian = pan.DataFrame([calc.grad_of(flow_dict[s]) + np.zeros(len(variables)) for s in substances],
+                                     index=substances, columns=columns, dtype=float)
+            results.extend([values, jacobian])
+
+        return results[0], results[2], results[1], results[3]
+
+    def technology_matrix(self, scenario=None, product=False, product_unit=False, product_io=False):
+        """Builds and solves the technology matrix of the factory (see techmatrix.TechnologyMatrix)
+
+        Unlike Factory.balance, the connections are solved simultaneously rather than in the
+        order they are specified, so they can be in any order and can loop between chains.
+        The returned TechnologyMatrix can be used to balance the factory on any quantity of
+        product without rebalancing the chains.
+
+        Args:
+            scenario, product, product_unit, product_io: as in Factory.balance
+
+        Returns:
+            TechnologyMatrix
+        """
+        return tm.TechnologyMatrix(self, scenario=scenario, product=product, product_unit=product_unit,
+                                   product_io=product_io)
+
+    def balance_matrix(self, scenario=None, product_qty=1.0, product=False, product_unit=False, product_io=False):
+        """Calculates the factory inflows and outflows by solving the technology matrix of the
+        factory, rather than balancing each connection in turn as in Factory.balance.
+
+        Recycling connections are applied after the technology matrix is solved, in the
+        order they are specified (see techmatrix.TechnologyMatrix). Factories in which
+        other connections use flows that recycling changes must be balanced with 
+        Factory.balance.
+
+        Args:
+            scenario, product_qty, product, product_unit, product_io: as in Factory.balance
+
+        Returns:
+            FlowVector of factory inflow substances and total quantities
+            FlowVector of factory outflow substances and total quantities
+        """
+        return self.technology_matrix(scenario, product, product_unit, product_io).balance(product_qty)
+
+    def override_vars(self, overrides):
+        """Context manager that overrides the values of unit process variables, for
+        balances of the factory within the context in the current thread only.
+
+        The unit processes' var_df are not changed (or copied), so other threads 
+        can balance the factory at the same time with other (or no) overrides.
+        Balances cached with overridden values are kept separate from the others.
+
+        Args:
+            overrides (dict): the value of each overridden variable (in every
+                scenario), keyed by (chain name, unit process ID, variable name)
+
+        Example:
+            with factory.override_vars({('cement', 'demo_kiln', 'fuelType'): 'coal'}):
+                f_in, f_out, agg_df, net_df = factory.balance(write_to_xls=False)
+        """
+        unit_overrides = dict()
+        for (chain_name, unit_name, var), value in overrides.items():
+            unit_process = self.chain_dict[chain_name]['chain'].process_dict[unit_name]
+            unit_overrides[(unit_process, var)] = value
+        return uni.override_vars(unit_overrides)
+
+    def dependency_graph(self):
+        """Returns the chains connected downstream of each chain of the factory
+
+        A chain depends on another if any connection (including recycling 
+        connections) takes a flow from the other chain, so that it must be
+        balanced again whenever the other chain's balance changes.
+
+        Returns:
+            dictionary of chain name: set of the names of the chains connected 
+            to its flows
+        """
+        graph = {chain_name: set() for chain_name in self.chain_dict}
+        for connection in self.connections:
+            graph[connection.origin_chain.name].add(connection.dest_chain.name)
+        return graph
+
+    def downstream_chains(self, chain_names):
+        """Returns the set of the chains, and every chain that depends on them
+        (directly or through other chains) in the dependency graph
+        """
+        graph = self.dependency_graph()
+        downstream = set()
+        to_visit = list(chain_names)
+        while to_visit:
+            chain_name = to_visit.pop()
+            if chain_name not in downstream:
+                downstream.add(chain_name)
+                to_visit.extend(graph[chain_name])
+        return downstream
+
+    def rebalance(self, changed, write_to_console=False, write_to_xls=False, outdir=None, subdir=False,
+                  file_id=''):
+        """Balances the factory again, with the arguments of its last balance, after
+        a change in the variables of some of its unit processes.
+
+        Only the chains containing a changed unit process, and the chains 
+        downstream of them in the dependency graph, are balanced again. The 
+        other chains reuse their balance from the last balance, and the 
+        connections and factory totals are recalculated from the chain balances.
+
+        Args:
+            changed (iterable/dict): the (chain name, unit process ID, variable name)
+                of each changed variable. If a dictionary, each variable is first
+                set to its value in the dictionary (in the last balance's scenario)
+                using UnitProcess.set_var.
+            write_to_console, write_to_xls, outdir, subdir, file_id: as in Factory.balance
+                (write_to_xls defaults to False)
+
+        Returns:
+            as Factory.balance
+        """
+        if self.last_balance is None:
+            raise Exception(f"{self.name.upper()}: the factory must be balanced before it can be rebalanced")
+
+        kwargs = dict(self.last_balance['kwargs'])
+
+        changed_chains = set()
+        for chain_name, unit_name, var in changed:
+            unit_process = self.chain_dict[chain_name]['chain'].process_dict[unit_name]
+            if isinstance(changed, dict):
+                unit_process.set_var(var, changed[(chain_name, unit_name, var)], kwargs['scenario'])
+            changed_chains.update(name for name, c in self.chain_dict.items()
+                                  if unit_process in c['chain'].process_dict.values())
+
+        rebalance_chains = self.downstream_chains(changed_chains)
+        logger.debug(f"{self.name.upper()}: rebalancing {', '.join(sorted(rebalance_chains))}")
+
+        return self.balance(**kwargs, rebalance_chains=rebalance_chains, write_to_console=write_to_console,
+                            write_to_xls=write_to_xls, outdir=outdir, subdir=subdir, file_id=file_id)
+
     ###############################################################################
     # SUBFUNCTIONS
     ###############################################################################
 
     # BALANCE SUBFUNCTIONS
+    def balance_factory_chains(self, scenario, product_qty, product, product_unit, product_io, chain_balances,
+                               retained=None, rebalance_chains=None):
+        """balances the chains and connections of the factory (see balance_chains), scaling a
+            cached balance of the factory if possible. Used in self.balance() (above)
+
+        The first balance of the factory on each scenario and product is a full balance,
+        and is cached (up to bbcfg.balance_cache_size) if every calculation of every unit
+        process is linear and every recycled flow could be used in full (i.e. no recycle 
+        connection reached its maximum replace fraction). Later balances on any quantity
+        of the product scale the cached balance instead. Cached balances are keyed by the
+        balance arguments and the version of each unit process in the factory, so they 
+        are not reused once any unit process's var_df or calc_df changes.
+        Hits and misses are counted in self.factory_cache_stats.
+
+        Balances scaled from the cache add no chain balances to chain_balances, 
+        so a rebalance after them balances every chain again.
+
+        Returns:
+            flow dictionaries of every unit process and chain (io_dicts[i_o][chain][unit])
+            dictionary of intra-factory flows, to be subtracted from the factory totals
+            list of intra-factory flows (origin/destination data)
+        """
+        units = [process for chain in self.chain_dict.values() for process in chain['chain'].process_dict.values()]
+
+        if (bbcfg.balance_cache_size <= 0 or trace.enabled is True or isinstance(product_qty, calc.Dual)
+                or rebalance_chains is not None or any(process.derivative_vars for process in units)):
+            return self.balance_chains(scenario, product_qty, product, product_unit, product_io,
+                                       chain_balances, retained, rebalance_chains)[:3]
+
+        def cache_key():
+            return (scenario, product, product_unit, product_io,
+                    tuple((process.version, process.override_key()) for process in units))
+
+        key = cache_key()
+        with uni.cache_lock:
+            cached = key in self.factory_cache
+            if cached:
+                self.factory_cache.move_to_end(key)
+                factory_balance = self.factory_cache[key]
+                self.factory_cache_stats['hits' if factory_balance is not None else 'misses'] += 1
+
+        if cached and factory_balance is not None:
+            logger.debug(f"{self.name.upper()}: scaling cached balance to {product_qty} of {product}")
+            return self.scale_factory_balance(factory_balance, product_qty)
+
+        (io_dicts, intermediate_product_dict, internal_flows,
+         recycled_units, scalable) = self.balance_chains(scenario, product_qty, product, product_unit, product_io,
+                                                         chain_balances, retained, rebalance_chains)
+
+        if not cached:
+            linear = (scalable and product_qty != 0 and
+                      all(step['calc_type'] in calc.linear_calc_list
+                          for process in units for plan in process.calc_plans.values() for step in plan))
+            if linear:
+                factory_balance = self.copy_factory_balance(io_dicts, intermediate_product_dict, internal_flows,
+                                                            recycled_units, product_qty)
+            else:
+                factory_balance = None  # None if the factory balance cannot be scaled
+            key = cache_key()  # variables and calculations are loaded on first balance
+            with uni.cache_lock:
+                self.factory_cache[key] = factory_balance
+                while len(self.factory_cache) > bbcfg.balance_cache_size:
+                    self.factory_cache.popitem(last=False)
+                self.factory_cache_stats['misses'] += 1
+
+        return io_dicts, intermediate_product_dict, internal_flows
+
+    def balance_chains(self, scenario, product_qty, product, product_unit, product_io, chain_balances,
+                       retained=None, rebalance_chains=None):
+        """balances the main chain on the factory product, and the other chains on the
+            products of their connections, in the order of the connections.
+            Used in self.balance_factory_chains() (below)
+
+        Returns:
+            flow dictionaries of every unit process and chain (io_dicts[i_o][chain][unit])
+            dictionary of intra-factory flows, to be subtracted from the factory totals
+            list of intra-factory flows (origin/destination data)
+            set of the (chain, unit) of unit processes rebalanced by recycle connections
+            whether the balance is proportional to the product quantity
+        """
+        # create flow dictionaries
+        io_dicts = {
+            'i': iof.nested_dicts(3, float),  # io_dicts['i'][chain][unit][substance] = float
+            'o': iof.nested_dicts(3, float),  # io_dicts['o'][chain][unit][substance] = float
+        }
+        chain_intermediates_dict = iof.nested_dicts(3, float)
+        intermediate_product_dict = defaultdict(
+            float)  # tracks intra-factory flows (to be subtracted from factory totals)
+        remaining_product_dict = iof.nested_dicts(4,
+                                                  float)  # tracks products used for recycle flows (dict[i_o][chain][unit][substance] = float)
+        internal_flows = []  # tracks intra-factory flows (origin/destination data)
+        recycled_units = set()  # tracks units rebalanced by recycle connections (chain, unit)
+        scalable = True  # whether the balance is proportional to product_qty
+
+        # balances main ProductChain
+        main = self.chain_dict[self.main_chain]
+
+        (io_dicts['i'][main['name']],
+         io_dicts['o'][main['name']],
+         chain_intermediates_dict[main['name']],
+         main_chain_internal_flows) = self.balance_chain_step(
+            main['chain'],
+            product_qty,
+            chain_balances,
+            retained,
+            rebalance_chains,
+            product=product,
+            i_o=product_io,
+            unit_process=product_unit,
+            scenario=scenario
+        )
+
+        logger.debug(f"{self.name.upper()}: balanced main chain {main['name']} on {product_qty} of {product}")
+        internal_flows.extend(main_chain_internal_flows)  # keeps track of flows betwen units
+
+        # balances auxillary ProductChains
+        for connection in self.connections:
+
+            # reset variables
+            orig_product_io = connection.origin_io
+            orig_product = connection.origin_product
+            qty_remaining = 0
+
+            dest_unit = connection.dest_unit
+            dest_unit_id = dest_unit.u_id if dest_unit else False
+            dest_product = False
+            dest_product_io = connection.dest_io
+
+            i_tmp = None
+            o_tmp = None
+
+            # identify origin (existing) and destination (connecting) ProductChains
+            orig_chain = connection.origin_chain
+            if not io_dicts[orig_product_io][orig_chain.name]:
+                raise KeyError(
+                    f"{[orig_chain.name]} has not been balanced yet. Please check the order of your connections.")
+
+            dest_chain = connection.dest_chain
+
+            # if destination chain connects to all UnitProcesses in origin chain, 
+            # use totals flow values from origin chain, rather than individual UnitProcess data
+            if connection.connect_all is True:
+                qty = io_dicts[orig_product_io][orig_chain.name]['chain totals'][orig_product]
+                orig_unit = False
+                logger.debug(f"using {qty} of {orig_product} from all units in {orig_chain.name}")
+
+            else:
+                orig_unit = connection.origin_unit
+
+                # processes substance name based on seperator and lookup key rules
+                orig_product = self.check_origin_product(orig_product, orig_unit, scenario)
+
+                # get product qty, checking to see if product has already been used elsewhere
+                qty = self.check_product_qty(orig_product, orig_product_io, orig_chain.name,
+                                             orig_unit.name, io_dicts, remaining_product_dict)
+
+            if round(qty, bbcfg.float_tol) < 0:
+                raise ValueError(f"{qty} of {orig_product}  from {orig_unit.name} in {orig_chain.name} < 0.")
+
+            # For Recycle Connections
+            if connection.recycle is True:
+                logger.debug(f"{self.name.upper()}: attempting to recycle {orig_product} from {orig_unit.name}")
+
+                new_chain_in_dict, new_chain_out_dict, qty_remaining, replace_flow = self.connect_recycle_flow(qty,
+                                                                                                               connection,
+                                                                                                               scenario,
+                                                                                                               orig_chain,
+                                                                                                               orig_unit,
+                                                                                                               orig_product,
+                                                                                                               dest_chain,
+                                                                                                               dest_unit,
+                                                                                                               dest_product_io,
+                                                                                                               io_dicts,
+                                                                                                               chain_intermediates_dict)
+
+                io_dicts['i'][dest_chain.name] = new_chain_in_dict
+                io_dicts['o'][dest_chain.name] = new_chain_out_dict
+                remaining_product_dict[orig_product_io][orig_chain.name][orig_unit.name][
+                    orig_product] = qty_remaining
+                recycled_units.add((dest_chain.name, dest_unit.name))
+                if round(qty_remaining, bbcfg.float_tol) != 0:
+                    scalable = False  # not all of the recycled flow could replace the flow
+
+                logger.debug(
+                    f"{self.name.upper()}: {remaining_product_dict[orig_product_io][orig_chain.name][orig_unit.name][orig_product]} {orig_product} remaining for {orig_chain.name}-{orig_unit.name}")
+
+            # For Non-Recycle Connection
+            else:
+                replace_flow = None
+
+                # allow for "connect as" products
+                dest_product = connection.dest_product if connection.dest_product is not False else orig_product
+
+                # balance auxillary chain based on qty of connecting product from already-calculated origin chain
+                logger.debug(
+                    f"sending {qty} of {orig_product} to {dest_chain.name} as {dest_product} ({dest_product_io}-flow)")
+
+                (i_tmp, o_tmp,
+                 chain_intermediates_dict[dest_chain.name],
+                 chain_internal_flows) = self.balance_chain_step(dest_chain,
+                                                                 qty,
+                                                                 chain_balances,
+                                                                 retained,
+                                                                 rebalance_chains,
+                                                                 product=dest_product,
+                                                                 product_alt_name=orig_product,
+                                                                 i_o=dest_product_io,
+                                                                 unit_process=dest_unit_id,
+                                                                 scenario=scenario, )
+
+                internal_flows.extend(chain_internal_flows)
+
+                # add chain inflow/outflow data to factory inflow/outflow dictionaries
+                # if chain already exists, add flow values instead of replacing
+                if io_dicts['i'][dest_chain.name] and io_dicts['o'][dest_chain.name]:
+                    for process_dict in i_tmp:
+                        for substance, i_qty in i_tmp[process_dict].items():
+                            io_dicts['i'][dest_chain.name][process_dict][substance] += i_qty
+                    for process_dict in o_tmp:
+                        for substance, o_qty in o_tmp[process_dict].items():
+                            io_dicts['o'][dest_chain.name][process_dict][substance] += o_qty
+                else:
+                    io_dicts['i'][dest_chain.name] = i_tmp
+                    io_dicts['o'][dest_chain.name] = o_tmp
+
+                logger.debug(
+                    f"{qty} of {orig_product} as product from {orig_chain.name} ({orig_product_io}) sent to to {dest_chain.name} ({dest_product_io})")
+
+            # FOR ALL CONNECTIONS
+            # add intra-chain product qty to intra-factory flow dictionary (to be deleted from factory total in/out)
+            intermediate_product_dict[orig_product] += (qty - qty_remaining)
+            logger.debug(f"{qty - qty_remaining} of {orig_product} added to intermediate_product_dict")
+
+            # update list of intra-factory flows for documentation output
+            internal_flows.append(
+                self.describe_internal_flow(connection, qty, qty_remaining, orig_chain, orig_unit, orig_product,
+                                            orig_product_io, dest_chain, dest_unit, dest_product, dest_product_io,
+                                            replace_flow))
+
+        return io_dicts, intermediate_product_dict, internal_flows, recycled_units, scalable
+
+    def balance_chain(self, chain, product_qty, product=False, i_o=False, unit_process=False,
+                      product_alt_name=False, scenario=None):
+        """balances a ProductChain, scaling a cached balance on one unit of product if possible
+            Used in self.balance() (above)
+
+        Chain balances are cached (up to bbcfg.balance_cache_size) if every calculation
+        of every unit process in the chain is linear. Cached balances are keyed by the
+        balance arguments and the version of each unit process in the chain, so they
+        are not reused once any unit process's var_df or calc_df changes.
+        Hits and misses are counted in self.chain_cache_stats.
+
+        Returns:
+            as ProductChain.balance
+        """
+        scenario = scenario if scenario else bbcfg.scenario_default
+        kwargs = dict(product=product, i_o=i_o, unit_process=unit_process, product_alt_name=product_alt_name,
+                      scenario=scenario)
+        units = chain.process_dict.values()
+
+        if (bbcfg.balance_cache_size <= 0 or trace.enabled is True or isinstance(product_qty, calc.Dual)
+                or any(process.derivative_vars for process in units)):
+            return chain.balance(product_qty, **kwargs)
+
+        def cache_key():
+            return (chain.name, product, i_o, unit_process, product_alt_name, scenario,
+                    tuple((process.version, process.override_key()) for process in units))
+
+        key = cache_key()
+        with uni.cache_lock:
+            cached = key in self.chain_cache
+            if cached:
+                self.chain_cache.move_to_end(key)
+                normalized = self.chain_cache[key]
+                self.chain_cache_stats['hits' if normalized is not None else 'misses'] += 1
+
+        if not cached:
+            normalized = chain.balance(1.0, **kwargs)
+            linear = all(step['calc_type'] in calc.linear_calc_list
+                         for process in units for plan in process.calc_plans.values() for step in plan)
+            key = cache_key()  # variables and calculations are loaded on first balance
+            with uni.cache_lock:
+                self.chain_cache[key] = normalized if linear else None  # None if the chain cannot be scaled
+                while len(self.chain_cache) > bbcfg.balance_cache_size:
+                    self.chain_cache.popitem(last=False)
+                self.chain_cache_stats['misses'] += 1
+            if linear:
+                return self.scale_chain_balance(chain, normalized, product_qty)
+            normalized = None
+
+        if normalized is None:
+            return chain.balance(product_qty, **kwargs)
+
+        return self.scale_chain_balance(chain, normalized, product_qty)
+
+    def balance_chain_step(self, chain, product_qty, chain_balances, retained=None, rebalance_chains=None,
+                           **kwargs):
+        """balances a chain (see balance_chain) as the next step of a factory balance,
+            and adds a copy of the chain balance to chain_balances, to be retained for rebalance.
+            Used in self.balance() (above)
+
+        If rebalance_chains is a set of chain names that does not include the chain, and 
+        the same step of the last balance (in retained) balanced the chain with the same 
+        arguments and overridden variable values, a copy of the retained chain balance is
+        returned instead.
+        Balances carrying derivatives are not retained.
+        """
+        step = len(chain_balances)
+        # overridden values are compared too, as the last balance may have been made in another thread
+        args = (chain.name, product_qty, kwargs,
+                tuple(process.override_key() for process in chain.process_dict.values()))
+
+        if (isinstance(product_qty, calc.Dual)
+                or any(process.derivative_vars for process in chain.process_dict.values())):
+            chain_balances.append(None)
+            return self.balance_chain(chain, product_qty, **kwargs)
+
+        if (retained is not None and chain.name not in rebalance_chains and step < len(retained)
+                and retained[step] is not None and retained[step][0] == args):
+            chain_balances.append(retained[step])
+            logger.debug(f"{self.name.upper()}: reusing the last balance of {chain.name}")
+            return self.copy_chain_balance(retained[step][1])
+
+        chain_balance = self.balance_chain(chain, product_qty, **kwargs)
+        chain_balances.append((args, self.copy_chain_balance(chain_balance)))
+        return chain_balance
+
+    def copy_chain_balance(self, chain_balance):
+        """returns a copy of a chain balance (as returned by ProductChain.balance), 
+            which is not changed by changes to the original's flow dictionaries
+            Used in self.balance_chain_step() (above)
+        """
+        i_dict, o_dict, intermediates, internal_flows = chain_balance
+        copies = []
+        for io_dict in [i_dict, o_dict]:
+            io_copy = iof.nested_dicts(2, float)
+            io_copy.update({unit_name: unit_flows.copy() for unit_name, unit_flows in io_dict.items()})
+            copies.append(io_copy)
+        return copies[0], copies[1], intermediates.copy(), list(internal_flows)
+
+    def scale_chain_balance(self, chain, chain_balance, product_qty):
+        """returns a copy of a chain balance (as returned by ProductChain.balance) on one unit
+            of product, scaled to the product quantity. Used in self.balance_chain() (above)
+
+        The unit processes' mass and energy imbalances are checked again on the scaled flows
+        (see scale_chain_flows).
+        """
+        calc.check_qty(product_qty)
+        i_dict, o_dict, intermediates, internal_flows = chain_balance
+
+        io_dicts = self.scale_chain_flows(chain, dict(i=i_dict, o=o_dict), product_qty,
+                                          dict(i=intermediates, o=intermediates))
+        scaled_intermediates = defaultdict(float, {s: q * product_qty for s, q in intermediates.items()})
+        scaled_internal_flows = [row[:3] + [row[3] * product_qty] + row[4:] for row in internal_flows]
+
+        return io_dicts['i'], io_dicts['o'], scaled_intermediates, scaled_internal_flows
+
+    def scale_chain_flows(self, chain, chain_dicts, scale, chain_intermediates, recycled_units=()):
+        """returns the inflows and outflows of a chain's unit processes (chain_dicts[i_o][unit]),
+            scaled, with their chain totals. Used in self.scale_chain_balance() and 
+            self.scale_factory_balance() (above and below)
+
+        Each unit process's flows are scaled with UnitProcess.scale_balance, which checks their
+        imbalances again, except for unit processes rebalanced by recycle connections (in 
+        recycled_units, as (chain, unit)), whose imbalances were not checked after they were
+        rebalanced. The chain totals are the sum of the scaled flows less the scaled flows 
+        between the unit processes (chain_intermediates[i_o]).
+        """
+        processes = {process.name: process for process in chain.process_dict.values()}
+        io_dicts = dict(i=defaultdict(lambda: defaultdict(float)), o=defaultdict(lambda: defaultdict(float)))
+
+        for unit_name in dict.fromkeys([*chain_dicts['i'], *chain_dicts['o']]):
+            if unit_name == "chain totals":
+                continue
+            unit_dicts = dict(i=chain_dicts['i'].get(unit_name, {}), o=chain_dicts['o'].get(unit_name, {}))
+            if (chain.name, unit_name) in recycled_units:
+                unit_dicts = {io: defaultdict(float, {s: q * scale for s, q in unit_flows.items()})
+                              for io, unit_flows in unit_dicts.items()}
+            else:
+                unit_dicts = processes[unit_name].scale_balance(unit_dicts, scale)
+            io_dicts['i'][unit_name], io_dicts['o'][unit_name] = unit_dicts['i'], unit_dicts['o']
+
+        for io in io_dicts:
+            chain_totals = flows.total(unit_flows for unit_name, unit_flows in io_dicts[io].items())
+            chain_totals.add(chain_intermediates[io], scale=-scale)  # removes intra-chain flows
+            io_dicts[io]["chain totals"] = chain_totals
+
+        return io_dicts
+
+    def copy_factory_balance(self, io_dicts, intermediate_product_dict, internal_flows, recycled_units,
+                             product_qty):
+        """returns a copy of a factory balance (as returned by balance_chains), to be cached and 
+            scaled to other product quantities. Used in self.balance_factory_chains() (above)
+
+        Each chain's total flows are kept as the flows to subtract from the sum of its unit
+        processes' flows (i.e. the flows between its unit processes), which are the same 
+        however often the chain was balanced or rebalanced by recycle connections.
+        """
+        factory_balance = dict(product_qty=product_qty, units=dict(i={}, o={}), chain_intermediates=dict(i={}, o={}),
+                               intermediates=dict(intermediate_product_dict), internal_flows=list(internal_flows),
+                               recycled_units=set(recycled_units))
+
+        for io in io_dicts:
+            for chain_name, chain_dict in io_dicts[io].items():
+                units = {unit_name: dict(unit_flows) for unit_name, unit_flows in chain_dict.items()
+                         if unit_name != 'chain totals'}
+                chain_intermediates = flows.total(units.values())
+                chain_intermediates.subtract(chain_dict['chain totals'])
+                factory_balance['units'][io][chain_name] = units
+                factory_balance['chain_intermediates'][io][chain_name] = {
+                    s: q for s, q in chain_intermediates.items() if q != 0 and s not in uni.imbalance_flows}
+
+        return factory_balance
+
+    def scale_factory_balance(self, factory_balance, product_qty):
+        """returns a factory balance (as returned by balance_chains) scaled from a cached 
+            factory balance to the product quantity. Used in self.balance_factory_chains() (above)
+
+        As in scale_chain_balance, the unit processes' mass and energy imbalances are checked 
+        again on the scaled flows (see scale_chain_flows).
+        """
+        calc.check_qty(product_qty)
+        scale = product_qty / factory_balance['product_qty']
+
+        io_dicts = {
+            'i': iof.nested_dicts(3, float),
+            'o': iof.nested_dicts(3, float),
+        }
+        for chain_name in factory_balance['units']['i']:
+            chain_dicts = self.scale_chain_flows(self.chain_dict[chain_name]['chain'],
+                                                 {io: factory_balance['units'][io][chain_name] for io in io_dicts},
+                                                 scale,
+                                                 {io: factory_balance['chain_intermediates'][io][chain_name]
+                                                  for io in io_dicts},
+                                                 factory_balance['recycled_units'])
+            for io in io_dicts:
+                io_dicts[io][chain_name] = chain_dicts[io]
+
+        intermediate_product_dict = defaultdict(float, {s: q * scale for s, q in factory_balance['intermediates'].items()})
+        internal_flows = [row[:3] + [row[3] * scale] + row[4:] for row in factory_balance['internal_flows']]
+
+        return io_dicts, intermediate_product_dict, internal_flows
+
+    def clear_chain_cache(self):
+        """Clears the chain balances cached by balance_chain and the factory balances cached by
+        balance_factory_chains, and resets their hit and miss counts
+        """
+        self.chain_cache = OrderedDict()
+        self.chain_cache_stats = dict(hits=0, misses=0)
+        self.factory_cache = OrderedDict()
+        self.factory_cache_stats = dict(hits=0, misses=0)
+
+    def compile_connections(self, connections_df):
+        """compiles each row of the connections table into a Connection, with the chains 
+            and unit processes and the flags of the row resolved.
+            Used when connections_df is set.
+
+        Returns:
+            list of Connections, in the order of the table (and of balancing)
+        """
+        connections = []
+        if connections_df is None:
+            return connections
+
+        cols = bbcfg.columns
+        for dummy_index, row in connections_df.iterrows():
+            orig_chain = self.chain_dict[row[cols.origin_chain]]['chain']
+            dest_chain = self.chain_dict[row[cols.dest_chain]]['chain']
+
+            connect_all = row[cols.origin_unit] == bbcfg.connect_all
+            orig_unit = False if connect_all else orig_chain.process_dict[row[cols.origin_unit]]
+
+            dest_unit = False
+            if cols.dest_unit in row and row[cols.dest_unit] in dest_chain.process_dict:
+                dest_unit = dest_chain.process_dict[row[cols.dest_unit]]
+
+            purge_fraction = 0.0
+            max_replace_fraction = 1.0
+            recycle = self.check_for_value(cols.replace, row) is True
+            if recycle is True:
+                purge_fraction = self.check_for_fraction(cols.purge_fraction, row, ifno=0.0)
+                max_replace_fraction = self.check_for_fraction(cols.max_replace_fraction, row, ifno=1.0)
+
+            connections.append(Connection(
+                origin_chain=orig_chain,
+                origin_unit=orig_unit,
+                origin_product=row[cols.origin_product],
+                origin_io=iof.clean_str(row[cols.origin_io][0]),
+                connect_all=connect_all,
+                dest_chain=dest_chain,
+                dest_unit=dest_unit,
+                dest_product=self.check_for_value(cols.dest_product, row, ifyes=row[cols.dest_product]),
+                dest_io=iof.clean_str(row[cols.dest_io][0]),
+                recycle=recycle,
+                replace=row[cols.replace] if recycle else None,
+                purge_fraction=purge_fraction,
+                max_replace_fraction=max_replace_fraction,
+            ))
+
+        logger.debug(f"{self.name.upper()}: compiled {len(connections)} connections")
+        return connections
+
     def check_origin_product(self, origin_product, orig_unit, scenario):
         """parses separators and lookup variables in product name
             Used in self.balance() (above)
@@ -860,19 +1555,11 @@ class Factory:
 
         if bbcfg.ignore_sep in origin_product:
             if origin_product.split(bbcfg.ignore_sep)[0] in fd.lookup_var_dict:
-                if scenario in orig_unit.var_df.index:
-                    lookup_substance = orig_unit.var_df.at[
-                        scenario, fd.lookup_var_dict[origin_product.split(bbcfg.ignore_sep)[0]]['lookup_var']]
-                else:
-                    lookup_substance = orig_unit.var_df.at[
-                        bbcfg.scenario_default, fd.lookup_var_dict[origin_product.split(bbcfg.ignore_sep)[0]]['lookup_var']]
+                lookup_substance = orig_unit.get_var(
+                    fd.lookup_var_dict[origin_product.split(bbcfg.ignore_sep)[0]]['lookup_var'], scenario)
                 origin_product = lookup_substance + bbcfg.ignore_sep + origin_product.split(bbcfg.ignore_sep)[1]
         elif origin_product in fd.lookup_var_dict:
-            if scenario in orig_unit.var_df.index:
-                origin_product = orig_unit.var_df.at[scenario, fd.lookup_var_dict[origin_product]['lookup_var']]
-            else:
-                origin_product = orig_unit.var_df.at[
-                    bbcfg.scenario_default, fd.lookup_var_dict[origin_product]['lookup_var']]
+            origin_product = orig_unit.get_var(fd.lookup_var_dict[origin_product]['lookup_var'], scenario)
         return origin_product
 
     def check_product_qty(self, product, product_io, chain_name, unit_name, io_dicts, remaining_product_dict):
@@ -900,67 +1587,63 @@ class Factory:
         else:
             return ifno
 
-    def check_for_recycle_fractions(self, qty, row):
-        """check whether a recycle flow has a purge fraction or maximum replace fraction.
+    def check_for_fraction(self, col, row, ifno):
+        """check whether a DataFrame row has a fraction in the column, and return it
+            (or ifno, if it does not).
+            Used in self.compile_connections() (above)
+        """
+
+        if col in row and row[col] not in bbcfg.no_var:
+            if type(row[col]) in [float, int] and not isnan(row[col]):
+                calc.check_qty(row[col], fraction=True)
+                return row[col]
+        return ifno
+
+    def check_for_recycle_fractions(self, qty, connection):
+        """applies the purge fraction of a recycle connection to the recycled quantity, and returns
+            it with the connection's maximum replace fraction.
             Used in self.connect_recycle_flow() (below)
         """
 
         purge = 0
-        max_replace_fraction = 1.0
-
-        if bbcfg.columns.purge_fraction in row:
-            if row[bbcfg.columns.purge_fraction] not in bbcfg.no_var:
-                if type(row[bbcfg.columns.purge_fraction]) in [float, int] and not isnan(row[bbcfg.columns.purge_fraction]):
-                    calc.check_qty(row[bbcfg.columns.purge_fraction], fraction=True)
-                    purge = qty * row[bbcfg.columns.purge_fraction]
-                    qty = qty - purge
-                    logger.debug(f"purge: {purge}, new qty: {qty}")
-
-        if bbcfg.columns.max_replace_fraction in row:
-            if row[bbcfg.columns.max_replace_fraction] not in bbcfg.no_var:
-                if type(row[bbcfg.columns.max_replace_fraction]) in [float, int] and not isnan(row[bbcfg.columns.max_replace_fraction]):
-                    calc.check_qty(row[bbcfg.columns.max_replace_fraction], fraction=True)
-                    max_replace_fraction = row[bbcfg.columns.max_replace_fraction]
+
+        if connection.purge_fraction:
+            purge = qty * connection.purge_fraction
+            qty = qty - purge
+            logger.debug(f"purge: {purge}, new qty: {qty}")
 
         if qty < 0:
             raise ValueError(f"{qty} < 0 after calculating purge ({purge})")
 
-        return qty, max_replace_fraction
+        return qty, connection.max_replace_fraction
 
-    def check_for_lookup(self, col, df, unit, scenario, check_if_in_list=False):
-        """check whether a dataframe value is a lookup value and/or in a list
+    def check_for_lookup(self, flow, unit, scenario, check_if_in_list=False):
+        """check whether a flow name is a lookup value and/or in a list
             Used in self.connect_recycle_flow() (below)
         """
 
         in_list = None
 
-        if df[col] in fd.lookup_var_dict:
-            if scenario in unit.var_df.index:
-                flow = unit.var_df.at[scenario, fd.lookup_var_dict[df[col]]['lookup_var']]
-            else:
-                flow = unit.var_df.at[bbcfg.scenario_default, fd.lookup_var_dict[df[col]]['lookup_var']]
+        if flow in fd.lookup_var_dict:
             if type(check_if_in_list) is list:
-                if df[col] in check_if_in_list:
+                if flow in check_if_in_list:
                     in_list = True
                 else:
                     in_list = False
-
-        else:
-            flow = df[col]
+            flow = unit.get_var(fd.lookup_var_dict[flow]['lookup_var'], scenario)
 
         return flow, in_list
 
-    def connect_recycle_flow(self, qty, row, scenario, orig_chain, orig_unit, orig_product, dest_chain, dest_unit,
+    def connect_recycle_flow(self, qty, connection, scenario, orig_chain, orig_unit, orig_product, dest_chain, dest_unit,
                              dest_product_io, io_dicts, chain_intermediates_dict):
         """recalculates chain flow data for a recycled flow connection
             used in self.balance() (above)
         """
 
-        qty, max_replace_fraction = self.check_for_recycle_fractions(qty, row)
+        qty, max_replace_fraction = self.check_for_recycle_fractions(qty, connection)
 
         # check if flow to be replaced is a lookup variable and/or a fuel
-        replace_flow, replace_fuel = self.check_for_lookup(col=bbcfg.columns.replace,
-                                                           df=row,
+        replace_flow, replace_fuel = self.check_for_lookup(flow=connection.replace,
                                                            unit=dest_unit,
                                                            scenario=scenario,
                                                            check_if_in_list=bbcfg.fuel_flows)
@@ -1025,24 +1708,13 @@ class Factory:
 
         # recalculate chain totals using rebalanced unit
         new_chain_totals = {
-            'i': defaultdict(float),
-            'o': defaultdict(float)
+            'i': flows.total(i_dict for process, i_dict in chain_in_dict.items() if process != 'chain totals'),
+            'o': flows.total(o_dict for process, o_dict in chain_out_dict.items() if process != 'chain totals')
         }
 
-        # resum total flows
-        for process, inflows_dict in chain_in_dict.items():
-            if process != 'chain totals':
-                for inflow, i_qty in inflows_dict.items():
-                    new_chain_totals['i'][inflow] += i_qty
-        for process, outflows_dict in chain_out_dict.items():
-            if process != 'chain totals':
-                for outflow, o_qty in outflows_dict.items():
-                    new_chain_totals['o'][outflow] += o_qty
-
         # re-remove intermediate products
         for io in new_chain_totals:
-            for intermediate_product, int_qty in chain_intermediates_dict[chain_name].items():
-                new_chain_totals[io][intermediate_product] -= int_qty
+            new_chain_totals[io].subtract(chain_intermediates_dict[chain_name])
 
         chain_in_dict["chain totals"].clear()
         chain_out_dict["chain totals"].clear()
@@ -1052,7 +1724,7 @@ class Factory:
 
         return chain_in_dict, chain_out_dict
 
-    def describe_internal_flow(self, row, qty, qty_remaining, orig_chain, orig_unit, orig_product, orig_product_io,
+    def describe_internal_flow(self, connection, qty, qty_remaining, orig_chain, orig_unit, orig_product, orig_product_io,
                                dest_chain, dest_unit, dest_product, dest_product_io, replace_flow):
         """formats data about an intra-factory flow for output to dataframe
             used in self.balance() (above)
@@ -1064,7 +1736,7 @@ class Factory:
 
         if orig_unit and orig_unit.name:
             orig_unit_name = orig_unit.name
-        elif row[bbcfg.columns.origin_unit] == bbcfg.connect_all:
+        elif connection.connect_all is True:
             orig_unit_name = 'all'
         else:
             orig_unit_name = 'unknown'
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+""" Flow vectors
+
+This module contains a registry of substance (flow) names, which assigns each
+substance an integer flow id, and the FlowVector class, a dictionary-like
+container of flow quantities that stores the quantities in an array indexed by
+flow id.
+
+FlowVectors are used for the chain and factory totals, which are summed from
+the flows of many unit processes: adding one FlowVector to another is a single
+array addition, rather than a loop over every substance name.
+
+Module Outline:
+
+- import statements and logger
+- module variable: substance_ids (dict)
+- module variable: substance_names (list)
+- function: flow_id
+- class: FlowVector
+- function: total
+- function: stack
+
+"""
+from collections import defaultdict
+from collections.abc import MutableMapping
+from threading import Lock
+
+import numpy as np
+
+from blackblox.bb_log import get_logger
+
+
+logger = get_logger("Flows")
+
+substance_ids = dict()
+"""dict: flow id of each registered substance name"""
+
+substance_names = []
+"""list: registered substance names, in order of flow id"""
+
+registry_lock = Lock()
+
+plain_numbers = (float, int, np.float64, np.float32, np.int64, np.int32)
+"""Types of quantities that are stored in a FlowVector's float array. Any other quantity
+(e.g. a calculators.Dual or an array) changes the FlowVector to an object array."""
+
+
+def flow_id(substance):
+    """returns the flow id of the substance, registering it if it is new
+    """
+    if substance not in substance_ids:
+        with registry_lock:
+            if substance not in substance_ids:
+                substance_ids[substance] = len(substance_names)
+                substance_names.append(substance)
+    return substance_ids[substance]
+
+
+class FlowVector(MutableMapping):
+    """Dictionary of flow quantities, stored in an array indexed by flow id.
+
+    Behaves like a defaultdict(float) with substance names as keys: looking up a
+    substance that is not in the FlowVector adds it with a quantity of 0.
+    Substances are iterated in order of flow id.
+
+    Args:
+        flows (dict or FlowVector): initial flow quantities
+            (Defaults to None)
+
+    Attributes:
+        values (ndarray): quantity of each substance, by flow id
+        present (ndarray): whether each substance is in the FlowVector, by flow id
+    """
+    __slots__ = ('values', 'present')
+
+    def __init__(self, flows=None):
+        self.values = np.zeros(len(substance_names))
+        self.present = np.zeros(len(substance_names), dtype=bool)
+        if flows:
+            self.add(flows)
+
+    def fit(self, size):
+        """extends the arrays to hold at least size flow ids (and all registered substances)
+        """
+        if size > len(self.values):
+            extra = max(size, len(substance_names)) - len(self.values)
+            self.values = np.concatenate([self.values, np.zeros(extra, dtype=self.values.dtype)])
+            self.present = np.concatenate([self.present, np.zeros(extra, dtype=bool)])
+
+    def __getitem__(self, substance):
+        i = flow_id(substance)
+        if i >= len(self.present) or not self.present[i]:
+            self[substance] = 0.0  # as with defaultdict(float)
+        return self.values[i]
+
+    def __setitem__(self, substance, qty):
+        i = flow_id(substance)
+        self.fit(i + 1)
+        if type(qty) not in plain_numbers and self.values.dtype != object:
+            self.values = self.values.astype(object)
+        self.values[i] = qty
+        self.present[i] = True
+
+    def __delitem__(self, substance):
+        if substance not in self:
+            raise KeyError(substance)
+        i = substance_ids[substance]
+        self.values[i] = 0.0
+        self.present[i] = False
+
+    def __contains__(self, substance):
+        i = substance_ids.get(substance)
+        return i is not None and i < len(self.present) and bool(self.present[i])
+
+    def __iter__(self):
+        for i in np.flatnonzero(self.present):
+            yield substance_names[i]
+
+    def __len__(self):
+        return int(self.present.sum())
+
+    def __reduce__(self):
+        # flow ids differ between processes, so FlowVectors are pickled by substance name
+        return FlowVector, (dict(self.items()),)
+
+    def __repr__(self):
+        return f"FlowVector({dict(self.items())})"
+
+    def copy(self):
+        """returns a copy of the FlowVector"""
+        flow_vector = FlowVector()
+        flow_vector.values = self.values.copy()
+        flow_vector.present = self.present.copy()
+        return flow_vector
+
+    def scaled(self, qty):
+        """returns a copy of the FlowVector with every quantity multiplied by qty"""
+        flow_vector = FlowVector()
+        flow_vector.values = self.values * qty
+        flow_vector.present = self.present.copy()
+        return flow_vector
+
+    def to_dict(self):
+        """returns the flows as a defaultdict(float)"""
+        return defaultdict(float, self.items())
+
+    def add(self, flows, scale=1.0):
+        """adds the quantities of another FlowVector or dictionary of flows, optionally
+        multiplied by scale (e.g. -1.0 to subtract them)
+        """
+        if isinstance(flows, FlowVector):
+            n = len(flows.values)
+            self.fit(n)
+            if flows.values.dtype == object and self.values.dtype != object:
+                self.values = self.values.astype(object)
+            self.values[:n] += flows.values * scale
+            self.present[:n] |= flows.present
+            return
+
+        ids = [flow_id(substance) for substance in flows]
+        if not ids:
+            return
+        self.fit(max(ids) + 1)
+        qtys = list(flows.values())
+        if self.values.dtype != object and all(type(qty) in plain_numbers for qty in qtys):
+            np.add.at(self.values, ids, np.asarray(qtys, dtype=float) * scale)
+        else:
+            self.values = self.values.astype(object)
+            for i, qty in zip(ids, qtys):
+                self.values[i] += qty * scale
+        self.present[ids] = True
+
+    def subtract(self, flows):
+        """subtracts the quantities of another FlowVector or dictionary of flows
+        """
+        self.add(flows, scale=-1.0)
+
+
+def total(flow_dicts):
+    """returns a FlowVector of the sum of several FlowVectors or dictionaries of flows
+    """
+    flow_vector = FlowVector()
+    for flows in flow_dicts:
+        flow_vector.add(flows)
+    return flow_vector
+
+
+def stack(flow_dicts):
+    """returns an array of the quantities of several FlowVectors or dictionaries of flows,
+    with one row for each and one column for each flow id, and an array of whether each 
+    substance is in each of them
+    """
+    flow_vectors = [flows if isinstance(flows, FlowVector) else FlowVector(flows) for flows in flow_dicts]
+    values = np.zeros((len(flow_vectors), len(substance_names)))
+    present = np.zeros((len(flow_vectors), len(substance_names)), dtype=bool)
+    for row, flow_vector in enumerate(flow_vectors):
+        values[row, :len(flow_vector.values)] = flow_vector.values
+        present[row, :len(flow_vector.present)] = flow_vector.present
+    return values, present
@@ -1,5 +1,6 @@
 from copy import copy
-from pandas import ExcelFile
+import numpy as np
+from pandas import ExcelFile, to_numeric
 from os.path import exists
 
 from blackblox.dataconfig import bbcfg
@@ -26,6 +27,15 @@ intalized from a spreadsheet including fuel name, fuel LHV, and fuel emission ra
 Generated if 'fuel' is in bbcfg.shared_var.lookup_var_dict
 """
 
+fuel_table = None
+"""df_fuels compiled for combustion calculations, generated with df_fuels.
+
+A dictionary with the keys 'index' (fuel name: row number), 'columns' (column
+name: column number), 'values' (2D float array of the dataframe's values, with
+non-numeric values as NaN), 'emissions' (cache of emission column numbers for
+each emissions list) and 'data_frame' (the dataframe it was compiled from).
+"""
+
 lookup_var_dict = None
 
 df_upstream_outflows = None
@@ -66,6 +76,7 @@ def __attempt_initialize():
         if exists(bbcfg.shared_var.fuel_dict['filepath']):
             df_fuels = iof.make_df(bbcfg.shared_var.fuel_dict['filepath'], sheet=bbcfg.shared_var.fuel_dict['sheet'])
             logger.info("df_fuels created")
+            get_fuel_table()
         else:
             logger.info(f"ALERT: Fuels DataFrame not created (no valid filepath specified (defaults to {bbcfg.shared_var.fuel_dict['filepath']}")
 
@@ -113,3 +124,33 @@ def __attempt_initialize():
             df_downstream_inflows = lookup_var_dict['downstream inflows']['data_frame']
 
         logger.info("df_downstream_inflows created")
+
+
+def compile_fuels(fuels_df):
+    """Compiles a fuels dataframe into a fuel table (see fuel_table) so that the
+    heating values and emission factors of a fuel are one contiguous row of floats.
+    """
+    values = fuels_df.apply(to_numeric, errors='coerce').to_numpy(dtype=float)
+    return dict(index={fuel: row for row, fuel in enumerate(fuels_df.index)},
+                columns={col: n for n, col in enumerate(fuels_df.columns)},
+                values=np.ascontiguousarray(values),
+                emissions=dict(),
+                data_frame=fuels_df)
+
+
+def get_fuel_table(fuels_df=None):
+    """returns the compiled fuel table of the fuels dataframe, compiling it if needed
+
+    Args:
+        fuels_df (DataFrame): fuels dataframe to compile. Only the table of df_fuels
+            is kept, and is recompiled if df_fuels is replaced.
+            (Defaults to df_fuels)
+    """
+    global fuel_table
+
+    if fuels_df is not None and fuels_df is not df_fuels:
+        return compile_fuels(fuels_df)
+    if fuel_table is None or fuel_table['data_frame'] is not df_fuels:
+        fuel_table = compile_fuels(df_fuels)
+        logger.info("fuel_table compiled")
+    return fuel_table
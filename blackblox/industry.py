@@ -3,13 +3,20 @@
 """
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List
 
+import numpy as np
+import pandas as pan
+
 import blackblox.calculators as calc
 from blackblox.dataconfig import bbcfg
 import blackblox.factory as fac
+import blackblox.flows as flows
 import blackblox.io_functions as iof
+import blackblox.parallel as parallel
+from blackblox.results import ResultCube
 from blackblox.bb_log import get_logger
 import blackblox.frames_default as fd
 
@@ -41,6 +48,8 @@ class Industry:
         product_list (set[str]): list of unique main output products of the factories
         factory_dict (dict): dictionary with the factory names, main products
             and Fac.Factory objects
+        unit_pool (dict): the UnitProcess objects shared by the factories, keyed by
+            unit process ID and units_df (see unitprocess.pooled_unit_process)
 
     """
 
@@ -52,17 +61,28 @@ class Industry:
         self.factories_df = iof.make_df(factory_list_file, factory_list_sheet, index=None)
         self.product_list = None
         self.factory_dict = None
+        self.unit_pool = None
 
         fd.initialize()
         self.units_df = units_df if units_df is not None else fd.df_unit_library
 
-    def build(self):
+    def build(self, workers=1):
         """ generates the factory, chain, and process objects in the industry
+
+        Unit processes are shared by every factory in the industry that uses them
+        (see self.unit_pool), so each unit process is only created, and its variable
+        and calculation tables only read, once.
+
+        Args:
+            workers (int): The number of factories to build at once, using a pool
+                of threads. If 1, builds the factories one at a time.
+                (Defaults to 1)
         """
         logger.debug(f"initializing industry for {self.name}")
 
-        factory_dict = defaultdict(dict)
-        product_list = set()
+        fd.initialize()
+        self.unit_pool = dict()
+        factory_kwargs = []
 
         for i, f in self.factories_df.iterrows():
             name = f[bbcfg.columns.factory_name]
@@ -81,32 +101,45 @@ class Industry:
             f_chains_sheet = iof.check_for_col(self.factories_df, bbcfg.columns.f_chains_sheet, i)
             f_connections_sheet = iof.check_for_col(self.factories_df, bbcfg.columns.f_connections_sheet, i)
 
-            factory = fac.Factory(
+            factory_kwargs.append(dict(
                 chain_list_file=f_chains_file,
                 connections_file=f_connections_file,
                 chain_list_sheet=f_chains_sheet,
                 connections_sheet=f_connections_sheet,
                 name=name,
                 units_df=self.units_df,
-            )
+                unit_pool=self.unit_pool,
+            ))
+
+        if workers > 1 and len(factory_kwargs) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                factories = list(executor.map(lambda kwargs: fac.Factory(**kwargs), factory_kwargs))
+        else:
+            factories = [fac.Factory(**kwargs) for kwargs in factory_kwargs]
+
+        factory_dict = defaultdict(dict)
+        product_list = set()
 
-            factory_dict[name] = dict(
+        for kwargs, factory in zip(factory_kwargs, factories):
+            factory_dict[kwargs['name']] = dict(
                 factory=factory,
                 product=factory.main_product,
-                name=name,
+                name=kwargs['name'],
             )
 
             product_list.add(factory.main_product)
 
-            self.factory_dict = factory_dict
-            self.product_list = product_list
+        self.factory_dict = factory_dict
+        self.product_list = product_list
+
+        logger.debug(f"{self.name}: built {len(factories)} factories using {len(self.unit_pool)} unit processes")
 
     def balance(self, production_data_file=None, production_data_sheet=None,
                 upstream_outflows=False, upstream_inflows=False,
                 aggregate_flows=False, mass_energy=True,
                 energy_flows=None, force_scenario=None,
                 write_to_xls=True, outdir=None,
-                file_id='', diagrams=True, **kwargs):
+                file_id='', diagrams=True, workers=1, mode='process', **kwargs):
         """Balances an industry using one scenario for each factory.
 
         Args:
@@ -133,6 +166,15 @@ class Industry:
                 (Defaults to True)
             diagrams (bool): If True, includes factory and chain diagrams in the
                 output files
+            workers (int): The number of factories to balance at once. If greater
+                than 1, the factories are balanced in a pool of worker processes
+                or threads (see blackblox.parallel). The industry totals are the
+                same as when the factories are balanced one after another.
+                (Defaults to 1)
+            mode (str): 'process' to balance the factories in worker processes, each
+                with its own copy of the factories, or 'thread' to balance them in
+                threads of this process.
+                (Defaults to 'process')
 
         """
         logger.debug(f"attempting to balance {self.name}industry")
@@ -190,13 +232,17 @@ class Industry:
                                             aggregate_flows=aggregate_flows,
                                             )
 
-        for f in f_production_dict:
-            factory = self.factory_dict[f]['factory']
-            f_kwargs = f_production_dict[f]
-            io_dicts['inflows'][f], io_dicts['outflows'][f], dummy_agg, dummy_net = factory.balance(**f_kwargs)
+        run_list = [(f, f_production_dict[f], outdir / 'pfd' if diagrams else None) for f in f_production_dict]
+        factories = {f: self.factory_dict[f]['factory'] for f in f_production_dict}
+
+        if workers > 1 and len(run_list) > 1:
+            results = parallel.balance_factories(factories, run_list, workers, mode=mode)
+        else:
+            results = [parallel.balance_factory(*run, factories=factories) for run in run_list]
 
-            if diagrams:
-                factory.diagram(outdir=outdir / 'pfd')
+        # factories are added in the order of the production data, so totals do not depend on workers
+        for f, (f_in, f_out) in zip(f_production_dict, results):
+            io_dicts['inflows'][f], io_dicts['outflows'][f] = f_in, f_out
 
         totals_in = defaultdict(float)
         totals_out = defaultdict(float)
@@ -238,7 +284,8 @@ class Industry:
 
     def run_scenarios(self, scenario_list: List[str], products_data=None, products_sheet=None,
                       write_to_xls=True, outdir=None, file_id='', diagrams=False,
-                      upstream_outflows=False, upstream_inflows=False, aggregate_flows=False, **kwargs):
+                      upstream_outflows=False, upstream_inflows=False, aggregate_flows=False,
+                      workers=1, mode='process', dtype='float64', **kwargs):
         """Balances an industry using one scenario for each factory.
 
         Args:
@@ -259,7 +306,18 @@ class Industry:
                 (Defaults to True)
             diagrams (bool): If True, includes factory and chain diagrams in the
                 output files
-
+            workers (int): The number of factories to balance at once (see balance)
+                (Defaults to 1)
+            mode (str): 'process' or 'thread' (see balance)
+                (Defaults to 'process')
+            dtype (str/type): storage type of the quantities of the returned ResultCube
+                (e.g. 'float32' to halve its memory)
+                (Defaults to 'float64')
+
+        Returns:
+            ResultCube of the inflows and outflows of each factory, by scenario. Its
+            step dimension has one label: products_sheet (or 0, if None), as an int
+            if it is a whole number (see results.step_label).
         """
 
         outdir_base = outdir if outdir else self.outdir
@@ -267,6 +325,8 @@ class Industry:
             outdir_base, subfolder=self.name, file_id_list=['multiscenario', file_id], time=True)
 
         scenario_dict = iof.nested_dicts(4)
+        balances = dict()  # [(scenario, step)] = io_dicts[flow i_o][factory][substance]
+        step = products_sheet if products_sheet is not None else 0
 
         for scenario in scenario_list:
             s_dict = self.balance(production_data_file=products_data,
@@ -278,9 +338,12 @@ class Industry:
                                   diagrams=diagrams,
                                   upstream_outflows=False,
                                   upstream_inflows=False,
-                                  aggregate_flows=False, )
+                                  aggregate_flows=False,
+                                  workers=workers,
+                                  mode=mode, )
             scenario_dict['i'][scenario] = s_dict['inflows']['industry totals']
             scenario_dict['o'][scenario] = s_dict['outflows']['industry totals']
+            balances[(scenario, step)] = s_dict
 
         inflows_df = iof.make_df(scenario_dict['i'], drop_zero=True)
         inflows_df = iof.mass_energy_df(inflows_df, aggregate_consumed=True)
@@ -301,6 +364,8 @@ class Industry:
                              outdir=outdir,
                              filename=f'{self.name}_multiscenario_{bbcfg.timestamp_str}')
 
+        return ResultCube.from_balances(balances, dtype=dtype)
+
     def evolve(self, start_data=None, start_sheet=None, end_data=None, end_sheet=None,
                start_step=0, end_step=1, mass_energy=True, energy_flows=None,
                write_to_xls=True, outdir=None, file_id='', diagrams=True, graph_outflows=False,
@@ -329,6 +394,12 @@ class Industry:
                 change over time, with one line for each factory
             graph_inflows (list/bool): list of inflows to graph with their
                 change over time, with one line for each factory
+
+        Returns:
+            dictionary of the annual flows of each factory (and the industry totals),
+                as annual_flows[flow i_o][factory] = DataFrame (timestep x substance)
+            dictionary of the cumulative flows of the factories (and the industry totals),
+                as cumulative_dict[flow i_o] = DataFrame (substance x factory)
         """
 
         energy_flows = energy_flows if energy_flows else bbcfg.energy_flows
@@ -361,40 +432,41 @@ class Industry:
         # io_dicts are in the form of:
         # io_dict['factory name' or 'industry totals']['inflows' or 'outflows']['substance'] = qty
 
-        # harmonize start_io and end_io dict keys:
-
-        to_harmonize = [(start_io, end_io), (end_io, start_io)]
-
-        for pair in to_harmonize:
-            for flow in pair[0]:
-                for factory in pair[0][flow]:
-                    for substance in pair[1][flow][factory]:
-                        if substance not in pair[0][flow][factory]:
-                            pair[0][flow][factory][substance] = 0
-
         stepcount = end_step - start_step
-        slope_dict = iof.nested_dicts(3)
-
-        for flow in end_io:
-            for factory in end_io[flow]:
-                for substance in end_io[flow][factory]:
-                    end_qty = end_io[flow][factory][substance]
-                    start_qty = start_io[flow][factory][substance]
-                    slope = ((end_qty - start_qty) / stepcount)  # m = (y-b)/x
-                    slope_dict[flow][factory][substance] = slope
-
-        annual_flows = iof.nested_dicts(4)  # [flow i_o][factory][substance][timestep] = float
-        cumulative_dict = iof.nested_dicts(3)  # [flow i_o][factory][substance] = float
-
-        for i in range(stepcount + 1):
-            step = str(start_step + i)
-            for flow in start_io:
-                for factory in start_io[flow]:
-                    for substance, qty in start_io[flow][factory].items():
-                        slope = slope_dict[flow][factory][substance]
-                        step_qty = qty + (i * slope)  # y = mx + b
-                        annual_flows[flow][factory][substance][step] = step_qty
-                        cumulative_dict[flow][factory][substance] += step_qty
+        step_index = [str(start_step + i) for i in range(stepcount + 1)]
+        step_vector = np.arange(stepcount + 1)
+
+        annual_flows = defaultdict(dict)  # [flow i_o][factory] = DataFrame of annual flows (timestep x substance)
+        cumulative_dict = dict()  # [flow i_o] = DataFrame of cumulative flows (substance x factory)
+
+        for flow in start_io:
+            factories = list(start_io[flow]) + [f for f in end_io[flow] if f not in start_io[flow]]
+
+            # (factory x substance) arrays of the start and end flows, with one column per flow id
+            qty, present = flows.stack([start_io[flow].get(f, {}) for f in factories] +
+                                       [end_io[flow].get(f, {}) for f in factories])
+            columns = np.flatnonzero(present.any(axis=0))
+            column_of = np.zeros(len(flows.substance_names), dtype=int)  # [flow id] = column
+            column_of[columns] = np.arange(len(columns))
+            start_qty = qty[:len(factories), columns]
+            end_qty = qty[len(factories):, columns]
+
+            slope = (end_qty - start_qty) / stepcount  # m = (y-b)/x
+            annual = start_qty[:, :, np.newaxis] + step_vector * slope[:, :, np.newaxis]  # y = mx + b
+            cumulative = np.zeros(slope.shape)
+            for i in step_vector:  # adds the steps in order, as a running total
+                cumulative += annual[:, :, i]
+
+            for f, factory in enumerate(factories):
+                # harmonizes start and end substances, in the order of the start flows
+                start_flows = start_io[flow].get(factory, {})
+                substances = list(start_flows)
+                substances.extend(s for s in end_io[flow].get(factory, {}) if s not in start_flows)
+                ids = column_of[[flows.flow_id(s) for s in substances]]
+                annual_flows[flow][factory] = pan.DataFrame(annual[f, ids].T, index=step_index, columns=substances)
+
+            cumulative_dict[flow] = pan.DataFrame(cumulative.T, columns=factories,
+                                                  index=[flows.substance_names[i] for i in columns])
 
         if write_to_xls is True:
 
@@ -442,7 +514,7 @@ class Industry:
         return annual_flows, cumulative_dict
 
     def evolve_multistep(self, steps=None, production_data_files=None, step_sheets=None,
-                         file_id='', outdir=None, write_to_xls=True,
+                         file_id='', outdir=None, write_to_xls=True, pathway=None, dtype='float64',
                          graph_inflows=False, graph_outflows=False,
                          upstream_outflows=False, upstream_inflows=False, aggregate_flows=False, **kwargs):
         """the same as evolve, but takes a list of an arbitrary number of steps
@@ -459,12 +531,25 @@ class Industry:
                 change over time, with one line for each factory
             graph_inflows (list/bool): list of inflows to graph with their
                 change over time, with one line for each factory
+            pathway (str/None): the label of the scenario dimension of the returned
+                ResultCube. If None, uses file_id, or the industry name if file_id is empty.
+                (Defaults to None)
+            dtype (str/type): storage type of the quantities of the returned ResultCube
+                (e.g. 'float32' to halve its memory)
+                (Defaults to 'float64')
+
+        Returns:
+            ResultCube of the annual inflows and outflows of each factory, by step
+            (e.g. year). ResultCubes of several pathways can be combined with 
+            ResultCube.concat.
         """
 
         outdir_base = outdir if outdir else self.outdir
         outdir = iof.build_filedir(
             outdir_base, subfolder=self.name, file_id_list=['evolve_multistep', steps[0], steps[-1], file_id], time=True)
 
+        pathway = pathway if pathway is not None else (file_id if file_id else self.name)
+
         step_annual_flows = []
         step_cumulative_flows = []
 
@@ -503,25 +588,27 @@ class Industry:
 
                 annual, cumulative = self.evolve(**s_kwargs)
                 if two_step is True:
-                    return annual, cumulative
+                    return ResultCube.from_annual_flows(annual, pathway, dtype=dtype)
                 step_annual_flows.append(annual)
                 step_cumulative_flows.append(cumulative)
             prev_step = step
 
-        merged_annual_flows = iof.nested_dicts(4)  # [flow i_o][factory][substance][timestep] = float
+        # later steps replace the flows of the timesteps (and factories and substances) they share
+        merged_annual_flows = defaultdict(dict)  # [flow i_o][factory] = DataFrame (timestep x substance)
+        merged_cumulative_flows = dict()  # [flow i_o] = DataFrame (substance x factory)
         for step_dict in step_annual_flows:
             for i_o, factory_dict in step_dict.items():
-                for factory, substance_dict in factory_dict.items():
-                    for substance, timestep_dict in substance_dict.items():
-                        for timestep, qty in timestep_dict.items():
-                            merged_annual_flows[i_o][factory][substance][timestep] = qty
+                for factory, annual_df in factory_dict.items():
+                    if factory in merged_annual_flows[i_o]:
+                        annual_df = pan.concat([merged_annual_flows[i_o][factory], annual_df]).fillna(0)
+                        annual_df = annual_df[~annual_df.index.duplicated(keep='last')]
+                    merged_annual_flows[i_o][factory] = annual_df
 
-        merged_cumulative_flows = iof.nested_dicts(3)  # [flow i_o][factory][substance] = float
         for step_dict in step_cumulative_flows:
-            for i_o, factory_dict in step_dict.items():
-                for factory, substance_dict in factory_dict.items():
-                    for substance, qty in substance_dict.items():
-                        merged_cumulative_flows[i_o][factory][substance] = qty
+            for i_o, cumulative_df in step_dict.items():
+                if i_o in merged_cumulative_flows:
+                    cumulative_df = cumulative_df.combine_first(merged_cumulative_flows[i_o]).fillna(0)
+                merged_cumulative_flows[i_o] = cumulative_df
 
         if write_to_xls is True:
 
@@ -566,4 +653,4 @@ class Industry:
             for flow in graph_inflows:
                 iof.plot_annual_flows(df_dict['i'], flow, outdir)
 
-        return merged_annual_flows, merged_cumulative_flows
+        return ResultCube.from_annual_flows(merged_annual_flows, pathway, dtype=dtype)
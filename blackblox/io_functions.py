@@ -12,6 +12,8 @@ Input Data Validators & Cleaners
 - function: if_str
 - function: check_for_col
 - function: is_energy
+- function: has_affix
+- module variable: flow_affixes
 
 Data Frame Constructors
 - function: make_df
@@ -29,10 +31,12 @@ Miscellaneous Functions
 
 """
 from collections import defaultdict
+from collections.abc import Mapping
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path, PosixPath
 import os
+import sys
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pan
@@ -160,13 +164,42 @@ def is_energy(string, energy_strings=bbcfg.energy_flows):
     
     """
 
-    clean_string = clean_str(string)
-    is_it_energy = False
-    for string in energy_strings:
-        if clean_string.startswith(string) or clean_string.endswith(string):
-            is_it_energy = True
+    return has_affix(string, energy_strings)
 
-    return is_it_energy
+
+flow_affixes = dict()
+"""Whether flow names start or end with any of a list of strings (e.g. energy
+flow markers), keyed by (flow name, tuple of strings, str_to_cut). 
+
+Filled by has_affix. Flow names do not change classification, so each is 
+only cleaned and checked once per list of strings.
+"""
+
+
+def has_affix(string, affixes, str_to_cut=False):
+    """checks if the cleaned string starts or ends with any of the affixes,
+    using the result stored in flow_affixes if previously checked.
+
+    Args:
+        string(str): the string (e.g. flow name) to check
+        affixes(list/tuple): strings to check for at the start or end of the string
+        str_to_cut(str/bool): string to remove from the string before checking,
+            as in clean_str
+            (Defaults to False)
+    Returns:
+        bool. True, if the string starts or ends with an affix. Otherwise, False.
+    """
+    if type(affixes) is not tuple:
+        affixes = tuple(affixes)
+    key = (string, affixes, str_to_cut)
+
+    if key not in flow_affixes:
+        clean_string = clean_str(string, str_to_cut=str_to_cut)
+        if type(string) is str:
+            key = (sys.intern(string), affixes, str_to_cut)
+        flow_affixes[key] = any(clean_string.startswith(a) or clean_string.endswith(a) for a in affixes)
+
+    return flow_affixes[key]
 
 
 def no_suf(str, separator=bbcfg.ignore_sep):
@@ -228,6 +261,9 @@ def make_df(data, sheet=None, sep='\t', index=0, metaprefix="meta",
     elif bool(data) is True:
         # Contains key-value data itself (turn it into pandas df)
         if isinstance(data, (dict, list)):
+            if isinstance(data, dict):  # e.g. FlowVectors, which pandas does not treat as dictionaries
+                data = {k: (dict(v) if isinstance(v, Mapping) and not isinstance(v, dict) else v)
+                        for k, v in data.items()}
             df = pan.DataFrame(data)
         # Contains file path
         elif isinstance(data, (Path, str, PosixPath)):
@@ -314,13 +350,7 @@ def mass_energy_df(df, energy_strings=bbcfg.energy_flows, totals=True, aggregate
             consumed = True
         else:
             consumed = False
-        clean_i = clean_str(i, str_to_cut=bbcfg.consumed_indicator)
-        energy_flow = False
-
-        for string in energy_strings:
-            if clean_i.startswith(string) or clean_i.endswith(string):
-                energy_flow = True
-                break
+        energy_flow = has_affix(i, energy_strings, str_to_cut=bbcfg.consumed_indicator)
 
         if energy_flow is True:
             if consumed is True and aggregate_consumed is True:
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+""" Parallel balancing
+
+This module contains the functions used to balance a factory on several
+scenarios (or with several sets of variable overrides) at once, using a pool
+of worker processes, and to balance the factories of an industry at once, 
+using a pool of worker processes or threads.
+
+Each worker process is given its own copy of the factory (and of the global
+configuration) when it starts, and keeps it for all of the scenarios it
+balances, so that the unit processes' variables, calculation plans and cached
+balances are only loaded once per worker. Results are returned to the main
+process as plain dictionaries and DataFrames, in the order of the scenarios.
+
+Module Outline:
+
+- import statements and logger
+- module variable: worker_factory
+- module variable: worker_factories
+- function: init_worker
+- function: init_industry_worker
+- function: balance_run
+- function: balance_runs
+- function: balance_scenarios
+- function: balance_factory
+- function: balance_factories
+
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from blackblox.dataconfig import bbcfg
+import blackblox.frames_default as fd
+from blackblox.bb_log import get_logger
+
+
+logger = get_logger("Parallel")
+
+worker_factory = None
+"""Factory: the worker process's copy of the factory being balanced"""
+
+worker_factories = None
+"""dict: the worker process's copy of each factory of the industry being balanced, by name"""
+
+
+def init_worker(factory, config):
+    """Stores the worker process's copy of the factory.
+
+    The configuration is copied into the worker's bbcfg, for worker processes
+    that are started fresh (spawned) rather than forked from the main process.
+    """
+    global worker_factory
+
+    bbcfg.__dict__.update(config.__dict__)
+    fd.initialize()
+    worker_factory = factory
+
+
+def init_industry_worker(factories, config):
+    """Stores the worker process's copy of the factories of an industry (see init_worker)
+    """
+    global worker_factories
+
+    bbcfg.__dict__.update(config.__dict__)
+    fd.initialize()
+    worker_factories = factories
+
+
+def balance_run(run_kwargs, kwargs):
+    """Balances the worker's factory with the arguments of the run and the
+    arguments common to all runs (see Factory.balance)
+
+    Returns:
+        dictionary of factory inflow substances and total quantities
+        dictionary of factory outflow substances and total quantities
+        DataFrame of aggregated flows
+        DataFrame of net flows
+    """
+    f_in, f_out, agg_df, net_df = worker_factory.balance(**run_kwargs, **kwargs)
+    return dict(f_in), dict(f_out), agg_df, net_df
+
+
+def balance_runs(factory, run_list, workers, **kwargs):
+    """Balances the factory once for each run, using a pool of worker processes.
+
+    Args:
+        factory (Factory): the factory to balance
+        run_list (list[dict]): the arguments of Factory.balance specific to each
+            run (e.g. scenario or overrides)
+        workers (int): the number of worker processes
+        **kwargs: other arguments passed to Factory.balance for every run
+
+    Returns:
+        list: the results of balance_run for each run, in the order of run_list
+    """
+    logger.info(f"{factory.name.upper()}: balancing {len(run_list)} runs using {workers} processes")
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(factory, bbcfg)) as executor:
+        return list(executor.map(balance_run, run_list, [kwargs] * len(run_list)))
+
+
+def balance_scenarios(factory, scenario_list, workers, **kwargs):
+    """Balances the factory on each scenario, using a pool of worker processes.
+
+    Args:
+        factory (Factory): the factory to balance
+        scenario_list (list[str]): the scenarios to balance the factory on
+        workers (int): the number of worker processes
+        **kwargs: other arguments passed to Factory.balance
+
+    Returns:
+        dict: the results of balance_run for each scenario
+    """
+    results = balance_runs(factory, [dict(scenario=scenario) for scenario in scenario_list], workers, **kwargs)
+    return dict(zip(scenario_list, results))
+
+
+def balance_factory(name, kwargs, diagram_outdir=None, factories=None):
+    """Balances one factory of an industry (see Factory.balance), and draws its
+    diagram if diagram_outdir is given.
+
+    Args:
+        name (str): the name of the factory
+        kwargs (dict): the arguments passed to Factory.balance
+        diagram_outdir (Path/None): the directory to save the factory diagram to,
+            or None to not draw it.
+            (Defaults to None)
+        factories (dict/None): the factories of the industry, by name. If None,
+            uses the worker process's copies.
+            (Defaults to None)
+
+    Returns:
+        inflows and outflows of the factory, as returned by Factory.balance
+    """
+    factory = (factories if factories is not None else worker_factories)[name]
+    f_in, f_out, dummy_agg, dummy_net = factory.balance(**kwargs)
+    if diagram_outdir is not None:
+        factory.diagram(outdir=diagram_outdir)
+    return f_in, f_out
+
+
+def balance_factories(factories, run_list, workers, mode='process'):
+    """Balances factories of an industry at once, using a pool of worker processes or threads.
+
+    In process mode, each worker process is given a copy of every factory when it 
+    starts, so balancing does not change the state (e.g. the cached balances) of the
+    factories themselves. In thread mode, the factories are balanced in place; each
+    factory should appear in run_list only once.
+
+    Args:
+        factories (dict): the factories of the industry, by name
+        run_list (list[tuple]): the name of the factory, the arguments passed to 
+            Factory.balance, and the diagram output directory (or None) of each run
+        workers (int): the number of worker processes or threads
+        mode (str): 'process' or 'thread'
+            (Defaults to 'process')
+
+    Returns:
+        list: the inflows and outflows of each run, in the order of run_list
+    """
+    logger.info(f"balancing {len(run_list)} factories using {workers} {mode}es")
+
+    names, kwargs_list, diagram_outdirs = zip(*run_list) if run_list else ([], [], [])
+
+    if mode == 'thread':
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(partial(balance_factory, factories=factories),
+                                     names, kwargs_list, diagram_outdirs))
+    elif mode == 'process':
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_industry_worker,
+                                 initargs=(factories, bbcfg)) as executor:
+            return list(executor.map(balance_factory, names, kwargs_list, diagram_outdirs))
+    else:
+        raise ValueError(f"{mode} is not a parallel mode. Use 'process' or 'thread'.")
@@ -167,6 +167,9 @@ def __build_bbcfgs_with_defaults(config_file_dir: Path, cfgs: dict) -> Tuple[Con
     built_scenario_default = cfgs.get('scenario_default', defcfgs.scenario_default)
     built_cfg.scenario_default = built_scenario_default
 
+    built_balance_cache_size = cfgs.get('balance_cache_size', defcfgs.balance_cache_size)
+    built_cfg.balance_cache_size = built_balance_cache_size
+
     # If paths_convention is present, build according to convention, otherwise the defaults from the source code
     built_cfg.paths = defcfgs.paths
 
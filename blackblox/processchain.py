@@ -13,7 +13,9 @@ Module Outline:
 - import statements and logger
 - class: ProductChain
     - class function: Build
+    - class function: check_links
     - class function: Balance
+    - class function: add_chain_totals
     - class function: Diagram
 
 """
@@ -28,6 +30,7 @@ import pandas as pan
 from blackblox.bb_log import get_logger
 
 import blackblox.io_functions as iof
+import blackblox.flows as flows
 from blackblox.dataconfig import bbcfg
 import blackblox.unitprocess as unit
 import blackblox.frames_default as fd
@@ -51,6 +54,10 @@ class ProductChain:
             (Defaults to "Product Chain.)
         xls_sheet (str/None): Excel sheetname for chain data. Optional.
             (Defaults to None)
+        unit_pool (dict/None): pool of UnitProcess objects to share with other 
+            chains (see unitprocess.pooled_unit_process). If None, the chain 
+            creates its own UnitProcess objects.
+            (Defaults to None)
 
     Attributes:
         name: the name of the chain
@@ -59,7 +66,8 @@ class ProductChain:
             the chain, this will be used. Determined by process_chain_df:
             if there is an outflow specified for the last process or an
             inflow specified for the first process. If both are specified,
-            the outflow is used by default.
+            the outflow is used by default. Determined, and the links of the
+            chain checked against the unit processes, on first use.
         process_list: list of unit process information generated using the
             process_chain_df.  The list is in order of the unit processes in 
             the chain, and each list item is a dictionary including the keys:
@@ -70,7 +78,7 @@ class ProductChain:
     """
 
     def __init__(self, chain_data, name=None, xls_sheet=None, outdir=None,
-                 units_df=None):
+                 units_df=None, unit_pool=None):
         self.name = "Product Chain" if name is None else name
         self.outdir = (outdir if outdir else bbcfg.paths.path_outdir) / f'{bbcfg.timestamp_str}__chain_{self.name}'
 
@@ -79,38 +87,61 @@ class ProductChain:
 
         logger.info(f"PROCESS CHAIN INIT - chain name: {self.name}, chain data: {chain_data}, xls sheet: {xls_sheet}")
         self.process_chain_df = iof.make_df(chain_data, sheet=xls_sheet, index=None)
-        self.default_product = False
         self.process_list = []  # list of UnitProcess objects, in order (used in Factory balance)
         self.process_names = []  # list of UnitProcess names, in order
         self.process_ids = []  # list of UnitProcess unique IDs, in order
         self.process_dict = dict()  # keys: unit process IDs, values: unit process objects. (used in Factory balance)
 
         # create UnitProcess objects for each unit in chain
+        # (their data, and the links between them, are checked on first use)
         for index, process_row in self.process_chain_df.iterrows():
-            process = unit.UnitProcess(process_row[bbcfg.columns.process_col], units_df=units_df)
+            if unit_pool is not None:
+                process = unit.pooled_unit_process(process_row[bbcfg.columns.process_col], unit_pool, units_df)
+            else:
+                process = unit.UnitProcess(process_row[bbcfg.columns.process_col], units_df=units_df)
             logger.debug(f"{self.name.upper()}: UnitProcess object created for {process.name}")
             inflow = process_row[bbcfg.columns.inflow_col]
             outflow = process_row[bbcfg.columns.outflow_col]
 
-            if inflow not in process.inflows and index != 0:
-                raise KeyError(f"{inflow} not found in {process.name} inflows")           
-            if (outflow not in process.outflows 
-                and index !=self.process_chain_df.index[-1]):
-                raise KeyError(f"{outflow} not found in {process.name} outflows")
- 
             self.process_list.append(dict(process=process, i=inflow, o=outflow))
             self.process_ids.append(process.u_id)
             self.process_names.append(process.name)
             self.process_dict[process.u_id] = process
-            
+
+        self._default_product = None
+
+    @property
+    def default_product(self):
+        if self._default_product is None:
+            self.check_links()
+        return self._default_product
+
+    def check_links(self):
+        """checks that the linking flows of the chain are flows of their unit processes
+        and sets the default product of the chain.
+
+        Requires the calculation tables of the unit processes, so is done on first use
+        of the chain rather than when it is created.
+        """
+        if self._default_product is not None:
+            return
+
+        for index, link in enumerate(self.process_list):
+            process = link['process']
+            if link['i'] not in process.inflows and index != 0:
+                raise KeyError(f"{link['i']} not found in {process.name} inflows")
+            if (link['o'] not in process.outflows
+                and index != len(self.process_list) - 1):
+                raise KeyError(f"{link['o']} not found in {process.name} outflows")
+
         # set deafult product
-        if not self.default_product:
-            if self.process_list[-1]['o'] in self.process_list[-1]['process'].outflows:
-                self.default_product = self.process_list[-1]['o']
-            elif self.process_list[0]['i'] in self.process_list[0]['process'].inflows:
-                self.default_product = self.process_list[-1]['i']
-            else:
-                logger.debug(f"{self.name.upper()}: No default product found for {self.name}.")
+        self._default_product = False
+        if self.process_list[-1]['o'] in self.process_list[-1]['process'].outflows:
+            self._default_product = self.process_list[-1]['o']
+        elif self.process_list[0]['i'] in self.process_list[0]['process'].inflows:
+            self._default_product = self.process_list[-1]['i']
+        else:
+            logger.debug(f"{self.name.upper()}: No default product found for {self.name}.")
 
     
     def balance(self, product_qty=1.0, product=False, i_o=False, unit_process=False,
@@ -153,6 +184,7 @@ class ProductChain:
 
         """
 
+        self.check_links()
         chain = self.process_list.copy() # to avoid manipulating self.process_list directly
         qty = product_qty
 
@@ -242,28 +274,8 @@ class ProductChain:
 
                     previous_process = process
 
-        totals = {
-            'i': defaultdict(float),
-            'o': defaultdict(float)
-            }
-
-        # aggregates inflows and outflows from all unit processes
-        for dummy_process, inflows_dict in io_dicts['i'].items():
-            for inflow, product_qty in inflows_dict.items():
-                totals['i'][inflow] += product_qty
-        
-        for dummy_process, outflows_dict in io_dicts['o'].items():
-            for outflow, product_qty in outflows_dict.items():
-                totals['o'][outflow] += product_qty
-
-        # removes intra-chain flows
-        for io_dict in totals:
-            for product, product_qty in intermediate_product_dict.items():
-                totals[io_dict][product] -= product_qty
-
         # adds to inflow/outflow dictionaries
-        io_dicts['i']["chain totals"] = totals['i']
-        io_dicts['o']["chain totals"] = totals['o']
+        self.add_chain_totals(io_dicts, intermediate_product_dict)
         
         logger.debug(f"{self.name.upper()}: successfully balanced {self.name} using {scenario} variables.")
 
@@ -304,6 +316,17 @@ class ProductChain:
                 
         return io_dicts['i'], io_dicts['o'], intermediate_product_dict, internal_flows
 
+    def add_chain_totals(self, io_dicts, intermediate_product_dict):
+        """sums the inflows and outflows of all unit processes, less the flows between them,
+            and adds them to the inflow and outflow dictionaries as "chain totals"
+            Used in self.balance() (above)
+        """
+        for io in ['i', 'o']:
+            totals = flows.total(unit_flows for process, unit_flows in io_dicts[io].items()
+                                 if process != "chain totals")  # aggregates flows from all unit processes
+            totals.subtract(intermediate_product_dict)  # removes intra-chain flows
+            io_dicts[io]["chain totals"] = totals
+
     def run_scenarios(self, scenario_list=[], product_qty=1.0, product=False, i_o=False, product_alt_name=False, 
                       write_to_xls=True, write_to_console=False,
                       outdir=None):
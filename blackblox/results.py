@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+""" Result cubes
+
+This module contains the ResultCube class, a labelled array of the inflows and
+outflows of the factories of an industry, over one or more scenarios and steps.
+ResultCubes are returned by Industry.run_scenarios and Industry.evolve_multistep,
+so that their results can be sliced, summed, and compared (e.g. the results of
+several pathways, combined with ResultCube.concat) without reading them back
+from the output workbooks.
+
+Module Outline:
+
+- import statements and logger
+- module variable: dimensions (tuple)
+- function: step_label
+- class: ResultCube
+    - class function: from_balances
+    - class function: from_annual_flows
+    - class function: concat
+    - class function: sel
+    - class function: sum
+    - class function: aggregate
+    - class function: reindex
+    - class function: astype
+    - class function: to_series
+    - class function: to_df
+
+"""
+import numpy as np
+import pandas as pan
+
+import blackblox.flows as flows
+from blackblox.bb_log import get_logger
+
+
+logger = get_logger("Results")
+
+dimensions = ('scenario', 'step', 'factory', 'io', 'substance')
+"""tuple: the dimensions of a ResultCube, in the order of the axes of its values"""
+
+io_labels = ['inflows', 'outflows']
+
+industry_totals = 'industry totals'  # not stored in ResultCubes; use ResultCube.sum('factory')
+
+
+def step_label(step):
+    """returns the label of a step: an int if the step is a whole number (e.g. the
+    production data sheet '2010', or the year 2010), otherwise the step unchanged
+    """
+    try:
+        number = float(step)
+    except (TypeError, ValueError):
+        return step
+    return int(number) if number.is_integer() else step
+
+
+class ResultCube:
+    """Labelled array of flow quantities, by scenario, step, factory,
+    flow type (inflows or outflows), and substance.
+
+    The quantities are stored in one dense array, with one axis for each dimension,
+    so the memory used is the product of the number of labels of each dimension
+    times the size of the storage type (8 bytes for float64, 4 for float32).
+    Substances that a factory does not have are stored as 0 (see to_series for the
+    non-zero quantities only). Industry totals are not stored; use sum('factory').
+
+    Selecting a single label of a dimension (see sel) removes that dimension, so
+    a ResultCube may have fewer dimensions than those of the module variable dimensions.
+
+    Steps are labelled with ints wherever they are whole numbers (see step_label), 
+    so that the steps of ResultCubes from Industry.run_scenarios (labelled by their 
+    production data sheet, e.g. '2010') and from Industry.evolve_multistep (labelled 
+    by year, e.g. 2010) match when they are combined with concat.
+
+    Args:
+        values (ndarray): quantities, with one axis for each dimension
+        coords (dict): the labels (list-like) of each dimension, by dimension name
+        dims (tuple[str]/None): names of the dimensions, in the order of the axes
+            of values. If None, uses all of the module variable dimensions.
+            (Defaults to None)
+        dtype (str/type): storage type of the quantities, e.g. 'float32' to halve
+            the memory used.
+            (Defaults to 'float64')
+
+    Attributes:
+        values (ndarray): quantities, with one axis for each dimension
+        dims (tuple[str]): names of the dimensions
+        coords (dict): pandas Index of the labels of each dimension, by dimension name
+    """
+
+    def __init__(self, values, coords, dims=None, dtype='float64'):
+        self.dims = tuple(dims) if dims is not None else dimensions
+        self.values = np.asarray(values, dtype=dtype)
+        self.coords = {dim: pan.Index(coords[dim], name=dim) for dim in self.dims}
+
+        if self.values.shape != tuple(len(self.coords[dim]) for dim in self.dims):
+            raise ValueError(f"values of shape {self.values.shape} do not match the labels of {self.dims}")
+
+    def __repr__(self):
+        sizes = ', '.join(f"{dim}: {len(self.coords[dim])}" for dim in self.dims)
+        return f"ResultCube({sizes}; {self.values.dtype})"
+
+    @property
+    def nbytes(self):
+        """int: memory used by the quantities, in bytes"""
+        return self.values.nbytes
+
+    @classmethod
+    def from_balances(cls, balances, dtype='float64'):
+        """Creates a ResultCube from industry balances.
+
+        Args:
+            balances (dict): industry balances, as returned by Industry.balance
+                (io_dicts[flow i_o][factory][substance] = qty), by (scenario, step)
+            dtype (str/type): storage type of the quantities
+                (Defaults to 'float64')
+        """
+        keys = [(scenario, step_label(step)) for scenario, step in balances]
+        scenarios = list(dict.fromkeys(scenario for scenario, step in keys))
+        steps = list(dict.fromkeys(step for scenario, step in keys))
+        factories = list(dict.fromkeys(factory for io_dicts in balances.values() for io in io_labels
+                                       for factory in io_dicts[io] if factory != industry_totals))
+
+        # one row of quantities (indexed by flow id) per balance, factory and flow type
+        qty, present = flows.stack([io_dicts[io].get(factory, {})
+                                    for io_dicts in balances.values() for factory in factories for io in io_labels])
+        columns = np.flatnonzero(present.any(axis=0))
+        qty = qty[:, columns].reshape(len(keys), len(factories), len(io_labels), len(columns))
+
+        values = np.zeros((len(scenarios), len(steps), len(factories), len(io_labels), len(columns)), dtype=dtype)
+        for k, (scenario, step) in enumerate(keys):
+            values[scenarios.index(scenario), steps.index(step)] = qty[k]
+
+        coords = dict(scenario=scenarios, step=steps, factory=factories, io=io_labels,
+                      substance=[flows.substance_names[i] for i in columns])
+        return cls(values, coords, dtype=dtype)
+
+    @classmethod
+    def from_annual_flows(cls, annual_flows, scenario, dtype='float64'):
+        """Creates a ResultCube of one scenario from annual flows.
+
+        Args:
+            annual_flows (dict): annual flows, as returned by Industry.evolve
+                (annual_flows[flow i_o][factory] = DataFrame (timestep x substance))
+            scenario (str): the label of the scenario
+            dtype (str/type): storage type of the quantities
+                (Defaults to 'float64')
+        """
+        tables = {(io, factory): annual_df for io in io_labels for factory, annual_df in annual_flows[io].items()
+                  if factory != industry_totals}
+
+        steps = pan.Index(list(dict.fromkeys(step for annual_df in tables.values() for step in annual_df.index)))
+        factories = pan.Index(list(dict.fromkeys(factory for io, factory in tables)))
+        substances = pan.Index(list(dict.fromkeys(s for annual_df in tables.values() for s in annual_df.columns)))
+
+        values = np.zeros((1, len(steps), len(factories), len(io_labels), len(substances)), dtype=dtype)
+        for (io, factory), annual_df in tables.items():
+            table = values[0, :, factories.get_loc(factory), io_labels.index(io)]
+            table[np.ix_(steps.get_indexer(annual_df.index), substances.get_indexer(annual_df.columns))] = annual_df.values
+
+        coords = dict(scenario=[scenario], step=[step_label(step) for step in steps], factory=factories, io=io_labels,
+                      substance=substances)
+        return cls(values, coords, dtype=dtype)
+
+    @classmethod
+    def concat(cls, cubes, dim='scenario'):
+        """Combines ResultCubes along one dimension (e.g. the results of several
+        pathways). The labels of the other dimensions are combined, with
+        quantities of 0 for the labels a ResultCube does not have.
+
+        Args:
+            cubes (list[ResultCube]): ResultCubes with the same dimensions
+            dim (str): the dimension to combine them along
+                (Defaults to 'scenario')
+        """
+        cubes = list(cubes)
+        cube_dims = cubes[0].dims
+        if any(cube.dims != cube_dims for cube in cubes):
+            raise ValueError("ResultCubes with different dimensions cannot be combined")
+        if dim not in cube_dims:
+            raise KeyError(f"{dim} is not a dimension of the ResultCubes ({cube_dims})")
+
+        coords = {d: list(dict.fromkeys(label for cube in cubes for label in cube.coords[d]))
+                  for d in cube_dims if d != dim}
+        aligned = [cube.reindex(**coords) for cube in cubes]
+        coords[dim] = [label for cube in cubes for label in cube.coords[dim]]
+
+        values = np.concatenate([cube.values for cube in aligned], axis=cube_dims.index(dim))
+        return cls(values, coords, dims=cube_dims, dtype=values.dtype)
+
+    def sel(self, **selections):
+        """Selects labels of one or more dimensions, e.g.
+        cube.sel(scenario='EU-2010', io='outflows', step=slice(2020, 2050))
+
+        Each selection can be a label, which removes that dimension; a list of labels;
+        or a slice of labels, which includes both the start and stop labels
+        (as in pandas .loc).
+
+        Returns:
+            ResultCube of the selected quantities, or the quantity if every
+            dimension was given a single label
+        """
+        unknown = [dim for dim in selections if dim not in self.dims]
+        if unknown:
+            raise KeyError(f"{unknown} are not dimensions of the ResultCube ({self.dims})")
+
+        values = self.values
+        new_dims = []
+        coords = dict()
+        axis = 0
+        for dim in self.dims:
+            labels = self.coords[dim]
+            if dim not in selections:
+                new_dims.append(dim)
+                coords[dim] = labels
+                axis += 1
+                continue
+
+            selection = selections[dim]
+            if isinstance(selection, slice):
+                positions = labels.slice_indexer(selection.start, selection.stop, selection.step)
+                values = values[(slice(None),) * axis + (positions,)]
+            elif isinstance(selection, (list, tuple, np.ndarray, pan.Index)):
+                positions = labels.get_indexer(selection)
+                if (positions < 0).any():
+                    raise KeyError(f"{[s for s, p in zip(selection, positions) if p < 0]} not found in {dim}")
+                values = np.take(values, positions, axis=axis)
+            else:
+                values = values[(slice(None),) * axis + (labels.get_loc(selection),)]
+                continue  # the dimension is removed
+
+            new_dims.append(dim)
+            coords[dim] = labels[positions]
+            axis += 1
+
+        if not new_dims:
+            return values.item()
+        return ResultCube(values, coords, dims=new_dims, dtype=values.dtype)
+
+    def sum(self, dims):
+        """Sums the quantities over one or more dimensions, e.g. cube.sum('factory')
+        for the industry totals.
+
+        Args:
+            dims (str/list[str]): the dimension(s) to sum over
+
+        Returns:
+            ResultCube without the summed dimensions, or the total quantity
+            if every dimension was summed
+        """
+        dims = [dims] if isinstance(dims, str) else list(dims)
+        unknown = [dim for dim in dims if dim not in self.dims]
+        if unknown:
+            raise KeyError(f"{unknown} are not dimensions of the ResultCube ({self.dims})")
+
+        values = self.values.sum(axis=tuple(self.dims.index(dim) for dim in dims))
+        new_dims = [dim for dim in self.dims if dim not in dims]
+        if not new_dims:
+            return float(values)
+        return ResultCube(values, {dim: self.coords[dim] for dim in new_dims}, dims=new_dims, dtype=self.values.dtype)
+
+    def aggregate(self, aggregate_flows):
+        """Sums the substances that start with each of a list of prefixes, as
+        Factory.aggregate_flows does (ignoring case). Substances that start with
+        more than one of the prefixes are included in each.
+
+        Args:
+            aggregate_flows (list[str]): the prefixes of the flows to aggregate
+
+        Returns:
+            ResultCube with the prefixes as the labels of its substance dimension
+        """
+        if 'substance' not in self.dims:
+            raise KeyError(f"the ResultCube has no substance dimension ({self.dims})")
+
+        substances = self.coords['substance']
+        matrix = np.array([[substance.lower().startswith(flow.lower()) for flow in aggregate_flows]
+                           for substance in substances], dtype=self.values.dtype).reshape(len(substances),
+                                                                                          len(aggregate_flows))
+
+        axis = self.dims.index('substance')
+        values = np.moveaxis(np.tensordot(self.values, matrix, axes=([axis], [0])), -1, axis)
+
+        coords = dict(self.coords)
+        coords['substance'] = list(aggregate_flows)
+        return ResultCube(values, coords, dims=self.dims, dtype=self.values.dtype)
+
+    def reindex(self, **coords):
+        """Changes the labels of one or more dimensions, e.g. to match those of
+        another ResultCube. Quantities of new labels are 0.
+
+        Returns:
+            ResultCube with the new labels
+        """
+        unknown = [dim for dim in coords if dim not in self.dims]
+        if unknown:
+            raise KeyError(f"{unknown} are not dimensions of the ResultCube ({self.dims})")
+
+        values = self.values
+        new_coords = dict(self.coords)
+        for axis, dim in enumerate(self.dims):
+            if dim not in coords:
+                continue
+            positions = self.coords[dim].get_indexer(coords[dim])
+            missing = positions < 0
+            shape = list(values.shape)
+            shape[axis] = len(positions)
+            new_values = np.zeros(shape, dtype=values.dtype)
+            new_values[(slice(None),) * axis + (~missing,)] = np.take(values, positions[~missing], axis=axis)
+            values = new_values
+            new_coords[dim] = coords[dim]
+
+        return ResultCube(values, new_coords, dims=self.dims, dtype=values.dtype)
+
+    def astype(self, dtype):
+        """returns a copy of the ResultCube with the quantities stored as dtype
+        """
+        return ResultCube(self.values, self.coords, dims=self.dims, dtype=dtype)
+
+    def to_series(self, drop_zero=True):
+        """Returns the quantities as a pandas Series, indexed by the labels of every dimension
+
+        Args:
+            drop_zero (bool): If True, only includes non-zero quantities
+                (Defaults to True)
+        """
+        index = pan.MultiIndex.from_product([self.coords[dim] for dim in self.dims], names=self.dims)
+        series = pan.Series(self.values.ravel(), index=index)
+        if drop_zero is True:
+            series = series[series != 0]
+        return series
+
+    def to_df(self, columns='substance'):
+        """Returns the quantities as a pandas DataFrame, with the labels of one
+        dimension as columns and the labels of the other dimensions as the index.
+
+        Args:
+            columns (str): the dimension to use as columns
+                (Defaults to 'substance')
+        """
+        if columns not in self.dims:
+            raise KeyError(f"{columns} is not a dimension of the ResultCube ({self.dims})")
+
+        axis = self.dims.index(columns)
+        rows = [dim for dim in self.dims if dim != columns]
+        values = np.moveaxis(self.values, axis, -1).reshape(-1, len(self.coords[columns]))
+
+        if len(rows) == 1:
+            index = self.coords[rows[0]]
+        elif rows:
+            index = pan.MultiIndex.from_product([self.coords[dim] for dim in rows], names=rows)
+        else:
+            index = None
+        return pan.DataFrame(values, index=index, columns=self.coords[columns])
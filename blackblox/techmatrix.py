@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+""" Technology matrix
+
+This module contains the TechnologyMatrix class, an alternative to the
+sequential connection-by-connection balance of Factory.balance.
+
+As in a life cycle assessment technology matrix, each column of the matrix is
+an activity (a balance of one product chain, normalized to one unit of the
+product it is balanced on) and each row is a flow that an activity must supply:
+the factory's main product, or the product of one of the factory's connections.
+Since every calculator used by the factory's unit processes is linear, the
+activity levels that balance all of the connections are the solution of one
+linear system, regardless of the order of the connections or of any loops
+between the chains.
+
+The activity levels solved for one unit of the main product are kept, so
+the balance for any quantity of the main product is found by scaling them.
+
+Recycling connections (which replace a flow up to a maximum fraction) are not
+linear, so they are not part of the linear system. They are applied afterwards,
+in the order of the connections, to the unit process flows of the solved
+activity levels, as Factory.balance does.
+
+Module Outline:
+
+- import statements and logger
+- class: TechnologyMatrix
+    - class function: build
+    - class function: check_recycles
+    - class function: activity_levels
+    - class function: unit_flows
+    - class function: recycle_flows
+    - class function: balance
+
+"""
+from collections import defaultdict
+
+import numpy as np
+import pandas as pan
+
+import blackblox.calculators as calc
+from blackblox.dataconfig import bbcfg
+import blackblox.flows as flows
+import blackblox.io_functions as iof
+from blackblox.bb_log import get_logger
+
+
+logger = get_logger("TechMatrix")
+
+
+class TechnologyMatrix:
+    """Linear system of the normalized chain balances and connections of a factory.
+
+    There is one activity for the main chain, balanced on the factory's product,
+    and one for each (non-recycling) connection of the factory, balancing the
+    destination chain on the connection's product. The quantity of each connection's
+    product is the sum of that product's flow in every activity of the origin chain.
+
+    Args:
+        factory (Factory): the factory to balance
+        scenario (str): The var_df index ID of the scenario of variable values to
+            use when balancing each UnitProcess.
+            (Defaults to bbcfg.scenario_default)
+        product (str/bool): product name. If False, uses the product of the main chain.
+            (Defaults to False)
+        product_unit (str/bool): The UnitProcess in the main ProductChain where the
+            factory product is located. If False, assumes the product is a final outflow
+            or inflow of the main ProductChain
+            (Defaults to False)
+        product_io (str/bool): The flow type of the factory product. If False, assumes
+            the product is a final outflow or inflow of the main ProductChain
+            (Defaults to False)
+
+    Attributes:
+        activities (list[dict]): for each activity, the chain name, balance arguments,
+            and the normalized inflow and outflow dictionaries (chain: unit: FlowVector)
+        connections (list[dict]): for each connection (see factory.Connection), its origin
+            and the activity it feeds
+        recycles (list[dict]): for each recycling connection, its origin
+        matrix (ndarray): the technology matrix, with one row per supplied flow and one
+            column per activity
+        levels (ndarray): activity levels for one unit of the factory product
+
+    Note:
+        Recycling connections (which replace a flow up to a maximum fraction) are
+        applied after the linear system is solved, so the recycled quantity is taken
+        from the origin unit's flows at the solved activity levels. Connections whose
+        origin flows would change with recycling (i.e. from a unit process rebalanced 
+        by a recycling connection, or of a product a recycling connection also uses)
+        cannot be solved this way and raise a ValueError; use Factory.balance for
+        factories with them.
+    """
+
+    def __init__(self, factory, scenario=None, product=False, product_unit=False, product_io=False):
+        self.factory = factory
+        self.scenario = scenario if scenario else bbcfg.scenario_default
+        self.product = product if product is not False else factory.chain_dict[factory.main_chain]['product']
+        self.product_unit = product_unit
+        self.product_io = product_io
+
+        self.activities = []
+        self.connections = []
+        self.recycles = []
+        self.matrix = None
+        self.levels = None
+
+        self.build()
+
+    def add_activity(self, chain_name, **balance_kwargs):
+        """balances the chain on one unit of product and adds it as an activity
+        """
+        chain = self.factory.chain_dict[chain_name]['chain']
+        i_dict, o_dict, intermediates, internal_flows = chain.balance(1.0, scenario=self.scenario,
+                                                                       **balance_kwargs)
+
+        for process in chain.process_dict.values():
+            for plan in process.calc_plans.values():
+                for step in plan:
+                    if step['calc_type'] not in calc.linear_calc_list:
+                        raise ValueError(f"{self.factory.name.upper()}: {process.name} in {chain_name} uses "
+                                         f"{step['calc_type']}, which is not a linear calculation")
+
+        self.activities.append(dict(
+            chain=chain_name,
+            kwargs=balance_kwargs,
+            i={unit_name: flows.FlowVector(unit_flows) for unit_name, unit_flows in i_dict.items()},
+            o={unit_name: flows.FlowVector(unit_flows) for unit_name, unit_flows in o_dict.items()},
+            intermediates=intermediates,
+            internal_flows=internal_flows,
+        ))
+        return len(self.activities) - 1
+
+    def build(self):
+        """Balances each activity on one unit of product, builds the technology matrix,
+        and solves it for the activity levels for one unit of the factory product.
+        """
+        factory = self.factory
+
+        self.add_activity(factory.main_chain, product=self.product, i_o=self.product_io,
+                          unit_process=self.product_unit)
+
+        for connection in factory.connections:
+            orig_product = connection.origin_product
+            if connection.connect_all is True:
+                orig_unit_name = 'chain totals'
+            else:
+                orig_unit_name = connection.origin_unit.name
+                orig_product = factory.check_origin_product(orig_product, connection.origin_unit, self.scenario)
+
+            if connection.recycle is True:  # applied to the solved flows (see recycle_flows)
+                self.recycles.append(dict(connection=connection, orig_chain=connection.origin_chain.name,
+                                          orig_unit=orig_unit_name, orig_product=orig_product,
+                                          orig_product_io=connection.origin_io))
+                continue
+
+            dest_unit_id = connection.dest_unit.u_id if connection.dest_unit else False
+            dest_product = connection.dest_product if connection.dest_product is not False else orig_product
+
+            activity = self.add_activity(connection.dest_chain.name, product=dest_product,
+                                         product_alt_name=orig_product, i_o=connection.dest_io,
+                                         unit_process=dest_unit_id)
+            self.connections.append(dict(connection=connection, orig_chain=connection.origin_chain.name,
+                                         orig_unit=orig_unit_name, orig_product=orig_product,
+                                         orig_product_io=connection.origin_io, activity=activity))
+
+        self.check_recycles()
+
+        # row 0 is the factory product, supplied by the main activity
+        # row n is the product of connection n-1, supplied by the origin chain's activities
+        n = len(self.activities)
+        self.matrix = np.identity(n)
+        for c, connection in enumerate(self.connections):
+            orig_activities = [a for a, activity in enumerate(self.activities)
+                               if activity['chain'] == connection['orig_chain']]
+            if not orig_activities:
+                raise KeyError(f"{connection['orig_chain']} is never balanced, so cannot supply "
+                               f"{connection['orig_product']}. Please check your connections.")
+            for a in orig_activities:
+                unit_flows = self.activities[a][connection['orig_product_io']].get(connection['orig_unit'], {})
+                if connection['orig_product'] in unit_flows:
+                    self.matrix[c + 1, a] -= unit_flows[connection['orig_product']]
+
+        demand = np.zeros(n)
+        demand[0] = 1.0
+        try:
+            self.levels = np.linalg.solve(self.matrix, demand) + 0.0  # avoids negative zeros
+        except np.linalg.LinAlgError:
+            raise ValueError(f"{self.factory.name.upper()}: the technology matrix is singular; check for "
+                             f"connections that loop back on themselves without losses.")
+
+        if (np.round(self.levels, bbcfg.float_tol) < 0).any():
+            raise ValueError(f"{self.factory.name.upper()}: negative activity levels {self.levels}")
+
+        logger.debug(f"{self.factory.name.upper()}: technology matrix solved for {self.product} "
+                     f"({len(self.activities)} activities)")
+
+    def check_recycles(self):
+        """checks that no connection uses flows that recycling connections change, as
+            recycling connections are only applied once the linear system is solved
+        """
+        rebalanced = {(recycle['connection'].dest_chain.name, recycle['connection'].dest_unit.name)
+                      for recycle in self.recycles}
+        recycled = {(recycle['orig_chain'], recycle['orig_unit'], recycle['orig_product'], recycle['orig_product_io'])
+                    for recycle in self.recycles}
+
+        for connection in self.connections:
+            origin = (connection['orig_chain'], connection['orig_unit'])
+            if (origin in rebalanced or (connection['orig_unit'] == 'chain totals' and
+                                         any(chain == connection['orig_chain'] for chain, unit in rebalanced))):
+                raise ValueError(f"{self.factory.name.upper()}: {connection['orig_product']} from "
+                                 f"{connection['orig_unit']} in {connection['orig_chain']} is changed by a "
+                                 f"recycling connection, so the factory cannot be solved as a technology matrix. "
+                                 f"Use Factory.balance instead.")
+            if (*origin, connection['orig_product'], connection['orig_product_io']) in recycled:
+                raise ValueError(f"{self.factory.name.upper()}: {connection['orig_product']} from "
+                                 f"{connection['orig_unit']} in {connection['orig_chain']} is also used by a "
+                                 f"recycling connection, so the factory cannot be solved as a technology matrix. "
+                                 f"Use Factory.balance instead.")
+
+    def activity_levels(self, product_qty=1.0):
+        """Returns a Series of the quantity each activity is balanced on, for the quantity of
+        factory product. Activities are indexed by their number (0 for the main chain, n for
+        connection n-1), chain, and the product the chain is balanced on.
+        """
+        index = pan.MultiIndex.from_tuples([(n, a['chain'], a['kwargs'].get('product_alt_name') or a['kwargs']['product'])
+                                            for n, a in enumerate(self.activities)],
+                                           names=['activity', 'chain', 'product'])
+        return pan.Series(self.levels * product_qty, index=index)
+
+    def unit_flows(self, product_qty=1.0):
+        """Returns the inflows and outflows of every unit process (and chain totals), for the
+        quantity of factory product, as io_dicts[i_o][chain][unit] = FlowVector
+        """
+        io_dicts = {'i': defaultdict(dict), 'o': defaultdict(dict)}
+        for activity, level in zip(self.activities, self.levels * product_qty):
+            for io in io_dicts:
+                for unit_name, unit_flows in activity[io].items():
+                    if unit_name not in io_dicts[io][activity['chain']]:
+                        io_dicts[io][activity['chain']][unit_name] = flows.FlowVector()
+                    io_dicts[io][activity['chain']][unit_name].add(unit_flows, scale=level)
+        return io_dicts
+
+    def recycle_flows(self, io_dicts, product_qty=1.0):
+        """Applies the recycling connections, in order, to the unit process flows of the
+        solved activity levels (as returned by unit_flows), as in Factory.balance
+
+        Returns:
+            dictionary of the quantity of each recycled product used within the factory
+        """
+        factory = self.factory
+
+        chain_intermediates_dict = defaultdict(flows.FlowVector)  # intra-chain flows, removed from chain totals
+        for activity, level in zip(self.activities, self.levels * product_qty):
+            chain_intermediates_dict[activity['chain']].add(activity['intermediates'], scale=level)
+
+        recycled_product_dict = defaultdict(float)
+        remaining_product_dict = iof.nested_dicts(4, float)  # products already used by recycle connections
+        for recycle in self.recycles:
+            connection = recycle['connection']
+            orig_chain, dest_chain = connection.origin_chain, connection.dest_chain
+            orig_product, orig_product_io = recycle['orig_product'], recycle['orig_product_io']
+
+            if connection.connect_all is True:
+                qty = io_dicts[orig_product_io][orig_chain.name]['chain totals'][orig_product]
+            else:
+                qty = factory.check_product_qty(orig_product, orig_product_io, orig_chain.name, recycle['orig_unit'],
+                                                io_dicts, remaining_product_dict)
+
+            (io_dicts['i'][dest_chain.name], io_dicts['o'][dest_chain.name],
+             qty_remaining, replace_flow) = factory.connect_recycle_flow(qty, connection, self.scenario, orig_chain,
+                                                                         connection.origin_unit, orig_product,
+                                                                         dest_chain, connection.dest_unit,
+                                                                         connection.dest_io, io_dicts,
+                                                                         chain_intermediates_dict)
+            remaining_product_dict[orig_product_io][orig_chain.name][recycle['orig_unit']][orig_product] = qty_remaining
+            recycled_product_dict[orig_product] += (qty - qty_remaining)
+
+        return recycled_product_dict
+
+    def balance(self, product_qty=1.0):
+        """Calculates the factory inflows and outflows for the quantity of factory product
+
+        Returns:
+            FlowVector of factory inflow substances and total quantities
+            FlowVector of factory outflow substances and total quantities
+        """
+        levels = self.levels * product_qty
+        totals = {'i': flows.FlowVector(), 'o': flows.FlowVector()}
+        if self.recycles:
+            io_dicts = self.unit_flows(product_qty)
+            intermediate_product_dict = self.recycle_flows(io_dicts, product_qty)
+            for io in totals:
+                for chain_name, chain_flows in io_dicts[io].items():
+                    totals[io].add(chain_flows['chain totals'])
+        else:
+            intermediate_product_dict = defaultdict(float)
+            for activity, level in zip(self.activities, levels):
+                for io in totals:
+                    totals[io].add(activity[io]['chain totals'], scale=level)
+
+        # remove the connection products, which are supplied within the factory
+        for connection in self.connections:
+            intermediate_product_dict[connection['orig_product']] += levels[connection['activity']]
+        for io in totals:
+            totals[io].subtract(intermediate_product_dict)
+
+        return totals['i'], totals['o']
@@ -13,35 +13,179 @@ Module Outline:
 
 - import statements and logger
 - module variable: df_units_library (dataframe)
+- module variable: cache_lock
+- module variable: load_lock
+- module variable: var_overrides (thread-local)
+- module variable: pool_lock
+- module variable: imbalance_flows
+- function: override_vars
+- function: pooled_unit_process
+- class: ReadOnlyIndexer
+- class: VariableTable
 - class: UnitProcess
     - class function: Balance
+    - class function: balance_many
     - class function: recycle_1to1
     - class function: recycle_energy_replacing_fuel
+    - class function: set_var
+    - class function: var_overrides
 
     subfunctions used in UnitProcess.balance():
+    - class subfunction: scale_balance
     - class subfunction: check_io
     - class subfunction: check_product
     - class subfunction: make_io_dicts
-    - class subfunction: check_attempt
+    - class subfunction: add_imbalance_flows
+    - class subfunction: calculate_flows
+    - class subfunction: calc_plan
+    - class subfunction: resolve_row_names
+    - class subfunction: build_calc_plan
+    - class subfunction: calc_rows
     - class subfunction: check_substance
+    - class subfunction: resolve_substance
     - class subfunction: check_lookup
     - class subfunction: check_calc
+    - class subfunction: check_known2
 """
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
 from copy import copy
 from datetime import datetime
+from threading import local, Lock, RLock
 
 import numpy as np
+import pandas as pan
 
 import blackblox.calculators as calc
 from blackblox.dataconfig import bbcfg
 import blackblox.io_functions as iof
 from blackblox.bb_log import get_logger
+import blackblox.bb_trace as trace
 import blackblox.frames_default as fd
 
 
 logger = get_logger("Unit Process")
 
+cache_lock = Lock()  # held while reading or updating the balance caches of any unit process
+load_lock = RLock()  # held while reading the variable or calculation table of any unit process
+pool_lock = Lock()  # held while finding or adding a unit process in a unit pool (see pooled_unit_process)
+
+imbalance_flows = ['UNKNOWN-mass', 'UNKNOWN-energy']
+"""list[str]: names of the flows added by UnitProcess.add_imbalance_flows, which are 
+removed from cached balances before they are scaled (see UnitProcess.scale_balance)"""
+
+var_overrides = local()
+"""thread-local: var_overrides.units is a dictionary of the overridden variable
+values of each UnitProcess (UnitProcess: {var_df column number: value}) in
+the current thread (see override_vars)"""
+
+
+@contextmanager
+def override_vars(overrides):
+    """Context manager that overrides variable values, in the current thread only.
+
+    Within the context, the overridden variables take the given value in every
+    scenario, without changing any UnitProcess's var_df, so balances in other
+    threads (or outside the context) still use the values in var_df. Contexts
+    can be nested; the inner context's values take precedence.
+
+    Args:
+        overrides (dict): the value of each overridden variable, keyed by
+            (UnitProcess, variable name)
+    """
+    outer = getattr(var_overrides, 'units', None)
+    units = {unit: dict(unit_overrides) for unit, unit_overrides in outer.items()} if outer else dict()
+    for (unit, var), value in overrides.items():
+        units.setdefault(unit, dict())[unit.var_col(var)] = value
+
+    var_overrides.units = units
+    try:
+        yield
+    finally:
+        var_overrides.units = outer
+
+
+def pooled_unit_process(u_id, unit_pool, units_df=None):
+    """Returns the UnitProcess of u_id in a pool of unit processes, creating it
+    (and adding it to the pool) if it is not already there.
+
+    Unit processes in a pool are keyed by their ID and the identity of the units_df
+    they are created from, so that every chain (e.g. of every factory of an industry)
+    that uses the pool shares one UnitProcess for each unit process, and its variable 
+    and calculation tables are only read once. Changes to a pooled UnitProcess (e.g.
+    with set_var) apply to every chain that uses it.
+
+    Args:
+        u_id (str): the unit process ID
+        unit_pool (dict): the pool of unit processes, keyed by (u_id, id(units_df))
+        units_df (DataFrame/None): the unit process library. If None, uses df_unit_library.
+            (Defaults to None)
+    """
+    fd.initialize()
+    units_df = units_df if units_df is not None else fd.df_unit_library
+
+    key = (u_id, id(units_df))
+    with pool_lock:
+        if key not in unit_pool:
+            unit_pool[key] = UnitProcess(u_id, units_df=units_df)
+        return unit_pool[key]
+
+
+class ReadOnlyIndexer:
+    """Wraps a DataFrame indexer (e.g. .loc or .at) of a VariableTable, 
+    reading values as usual but raising an error on assignment.
+    """
+
+    def __init__(self, indexer, unit_name):
+        self.indexer = indexer
+        self.unit_name = unit_name
+
+    def __getitem__(self, key):
+        return self.indexer[key]
+
+    def __setitem__(self, key, value):
+        raise VariableTable.read_only_error(self.unit_name)
+
+
+class VariableTable(pan.DataFrame):
+    """Read-only copy of a unit process's variable table, returned by UnitProcess.var_df.
+
+    Variable lookups use arrays compiled from the variable table when it is assigned,
+    so assigning values with .loc, .iloc, .at, .iat or [] raises a TypeError 
+    instead of having no effect. Use UnitProcess.set_var to change a variable, or 
+    assign a new dataframe to UnitProcess.var_df. Copies (and other dataframes derived
+    from a VariableTable) are ordinary, writable DataFrames.
+    """
+    _metadata = ['unit_name']
+
+    @property
+    def _constructor(self):
+        return pan.DataFrame  # derived dataframes are not read-only
+
+    @staticmethod
+    def read_only_error(unit_name):
+        return TypeError(f"{str(unit_name).upper()}: var_df is read-only. Use UnitProcess.set_var(var, value, "
+                         f"scenario) to change a variable, or assign a new dataframe to var_df.")
+
+    @property
+    def loc(self):
+        return ReadOnlyIndexer(super().loc, self.unit_name)
+
+    @property
+    def iloc(self):
+        return ReadOnlyIndexer(super().iloc, self.unit_name)
+
+    @property
+    def at(self):
+        return ReadOnlyIndexer(super().at, self.unit_name)
+
+    @property
+    def iat(self):
+        return ReadOnlyIndexer(super().iat, self.unit_name)
+
+    def __setitem__(self, key, value):
+        raise self.read_only_error(self.unit_name)
+
 
 class UnitProcess:
     """UnitProcess(u_id, display_name=False, var_df=False, calc_df=False, units_df=df_unit_library)
@@ -75,7 +219,8 @@ class UnitProcess:
         u_id (str): unique ID of the process
         display_name (str): Name of process
         var_df (dataframe): Dataframe of relationship variable values
-            indexed by scenario name.
+            indexed by scenario name. Returns a read-only copy (see VariableTable);
+            variables are changed with set_var, or by assigning a new dataframe.
         calc_df (dataframe): Dataframe of relationships between unit
             process flows.
         default_product (str): The primary "product" flow of the unit
@@ -86,6 +231,27 @@ class UnitProcess:
             from calc_df.
         outflows (set[str]): List of outflows to the unit process. Derived
             from calc_df.
+        calc_plans (dict): Calculation orders used by balance, keyed by
+            product, flow location, alternative product name and the substance
+            names the calculations resolve to. Built on first use and cleared
+            when calc_df is replaced.
+        plan_memo (dict): The calculation order used for each product, flow 
+            location, scenario and alternative product name (and any overridden 
+            variable values). Cleared when var_df or calc_df change.
+        substance_memo (dict): Substance names, proxies and lookup dataframes
+            resolved by check_substance and check_known2, keyed by the calc_df
+            substance name, scenario and any overridden variable values (and, for
+            check_substance, the product names). Cleared when var_df changes.
+        balance_cache (OrderedDict): Least recently used cache of balances
+            on one unit of product, keyed by product, flow location, scenario
+            and alternative product name (and any overridden variable values).
+            Cleared when var_df or calc_df are replaced or modified with set_var.
+        version (int): Incremented whenever the balance cache is cleared.
+
+    Note:
+        var_df and calc_df are read from their files on first use, rather than
+        when the unit process is created. The inflow and outflow sets are 
+        derived from calc_df on first use.
     """
 
     def __init__(self, u_id, display_name=False, var_df=False, calc_df=False,
@@ -94,6 +260,13 @@ class UnitProcess:
         logger.info(f"creating unit process object for {u_id} ({display_name})")
 
         self.u_id = u_id
+        self.calc_plans = dict()
+        self.plan_memo = dict()
+        self.balance_cache = OrderedDict()
+        self.version = 0  # incremented whenever balances may change (see clear_balance_cache)
+        self.calc_vars = dict()  # calc_df variable names, whether they are variables and their cleaned names
+        self.derivative_vars = dict()  # var_df column numbers of variables carrying derivatives, to gradient position
+        self.derivative_size = 0
 
         fd.initialize()
         units_df = units_df if units_df is not None else fd.df_unit_library
@@ -105,18 +278,24 @@ class UnitProcess:
         else:
             self.name = u_id
 
+        # variable and calculation tables are read on first use
+        self._var_df = None
+        self._calc_df = None
+        self._flow_sets = None
+        self._calc_rows = None
         if var_df is not False:
-            self.var_df = iof.make_df(var_df)
+            self._var_source = dict(data=var_df)
         else:
-            v_sheet = iof.check_for_col(units_df, bbcfg.columns.var_sheetname, u_id)
-            self.var_df = iof.make_df(units_df.at[u_id, bbcfg.columns.var_filepath]
-                                      , sheet=v_sheet, lower_cols=True, fillna=True)
+            self._var_source = dict(data=units_df.at[u_id, bbcfg.columns.var_filepath],
+                                    sheet=iof.check_for_col(units_df, bbcfg.columns.var_sheetname, u_id),
+                                    lower_cols=True, fillna=True)
 
         if calc_df is not False:
             self.calc_df = calc_df
         else:
-            c_sheet = iof.check_for_col(units_df, bbcfg.columns.calc_sheetname, u_id)
-            self.calc_df = iof.make_df(units_df.at[u_id, bbcfg.columns.calc_filepath], sheet=c_sheet, index=None)
+            self._calc_source = dict(data=units_df.at[u_id, bbcfg.columns.calc_filepath],
+                                     sheet=iof.check_for_col(units_df, bbcfg.columns.calc_sheetname, u_id),
+                                     index=None)
 
         self.outdir = (outdir if outdir else bbcfg.paths.path_outdir) / f'{bbcfg.timestamp_str}__unit_{self.name}'
 
@@ -125,12 +304,11 @@ class UnitProcess:
         # use default value if available, otherwise none
         self.default_io = iof.check_for_col(units_df, bbcfg.columns.unit_product_io, u_id)
 
-        self.inflows = set()
-        self.outflows = set()
-        self.mass_inflows = set()
-        self.mass_outflows = set()
-        self.energy_inflows = set()
-        self.energy_outflows = set()
+    def build_flow_sets(self):
+        """sorts the flows named in calc_df into inflows and outflows, and mass and energy flows
+        """
+        flow_sets = dict(inflows=set(), outflows=set(), mass_inflows=set(), mass_outflows=set(),
+                         energy_inflows=set(), energy_outflows=set())
 
         for i in self.calc_df.index:
             if type(self.calc_df.at[i, bbcfg.columns.known]) is str:  # removes blank rows
@@ -142,25 +320,183 @@ class UnitProcess:
             for product, i_o in products:
                 if not product.startswith(bbcfg.consumed_indicator):  # ignores flows that are specified as balance items
                     if i_o in ['i', 'c']:
-                        self.inflows.add(product)
+                        flow_sets['inflows'].add(product)
                         if iof.is_energy(product):  # sorts based on bbcfg.energy_flows
-                            self.energy_inflows.add(product)
+                            flow_sets['energy_inflows'].add(product)
                         else:
-                            self.mass_inflows.add(product)
+                            flow_sets['mass_inflows'].add(product)
                     elif i_o in ['o', 'e']:
-                        self.outflows.add(product)
+                        flow_sets['outflows'].add(product)
                         if iof.is_energy(product):
-                            self.energy_outflows.add(product)
+                            flow_sets['energy_outflows'].add(product)
                         else:
-                            self.mass_outflows.add(product)
+                            flow_sets['mass_outflows'].add(product)
 
                     if 'combustion' in self.calc_df.at[
                         i, bbcfg.columns.calc_type]:  # adds combustion emissions and balancing energy flows
                         for emission in bbcfg.emissions:
-                            self.outflows.add(emission)
-                            self.mass_outflows.add(emission)
-                        self.energy_inflows.add(f"energy embodied in fuels")
-                        self.energy_outflows.add("waste heat")
+                            flow_sets['outflows'].add(emission)
+                            flow_sets['mass_outflows'].add(emission)
+                        flow_sets['energy_inflows'].add(f"energy embodied in fuels")
+                        flow_sets['energy_outflows'].add("waste heat")
+
+        return flow_sets
+
+    def flow_set(self, name):
+        """returns one of the sets of flows derived from calc_df, building them on first use
+        """
+        if self._flow_sets is None:
+            self._flow_sets = self.build_flow_sets()
+        return self._flow_sets[name]
+
+    @property
+    def inflows(self):
+        return self.flow_set('inflows')
+
+    @property
+    def outflows(self):
+        return self.flow_set('outflows')
+
+    @property
+    def mass_inflows(self):
+        return self.flow_set('mass_inflows')
+
+    @property
+    def mass_outflows(self):
+        return self.flow_set('mass_outflows')
+
+    @property
+    def energy_inflows(self):
+        return self.flow_set('energy_inflows')
+
+    @property
+    def energy_outflows(self):
+        return self.flow_set('energy_outflows')
+
+    @property
+    def var_df(self):
+        """VariableTable: a read-only copy of the variable table. 
+        
+        Variable lookups use arrays compiled from the table, so assigning values 
+        to the returned table raises a TypeError. Use set_var to change a variable, 
+        or assign a new table to var_df.
+        """
+        if self._var_df is None:
+            self.load_vars()
+        var_table = VariableTable(self._var_df.copy())
+        var_table.unit_name = self.name
+        return var_table
+
+    def load_vars(self):
+        """reads the variable table, if not yet read
+        """
+        if self._var_df is None:
+            with load_lock:
+                if self._var_df is None:  # not read by another thread in the meantime
+                    logger.debug(f"{self.u_id}: reading variables from {self._var_source['data']}")
+                    self.var_df = iof.make_df(**self._var_source)
+
+    @var_df.setter
+    def var_df(self, var_df):
+        var_df = var_df.copy()  # so that later changes to the assigned dataframe cannot bypass compile_vars
+        self.compile_vars(var_df)
+        self._var_df = var_df  # only once compiled, as other threads may then use it
+        self.clear_balance_cache()  # cached balances depend on the variable values
+
+    def compile_vars(self, var_df=None):
+        """compiles var_df into arrays used for variable lookups during balancing
+
+        Creates an object array of the variable values (and a float array for 
+        numeric lookups over many scenarios), with dictionaries of the row of
+        each scenario and the column of each variable name. The row used for 
+        scenarios not in var_df (bbcfg.scenario_default) is found here once.
+
+        Args:
+            var_df (DataFrame/None): the variable table to compile. If None, 
+                compiles the unit process's var_df.
+                (Defaults to None)
+        """
+        var_df = self._var_df if var_df is None else var_df
+        self._var_values = var_df.to_numpy(dtype=object)
+        self._var_floats = var_df.apply(lambda col: pan.to_numeric(col, errors='coerce')).to_numpy(dtype=float)
+
+        self._var_rows = dict()
+        for row, scenario in enumerate(var_df.index):
+            self._var_rows.setdefault(scenario, row)
+        self._var_default_row = self._var_rows.get(bbcfg.scenario_default)
+
+        self._var_cols = dict()
+        for col, var in enumerate(var_df.columns):
+            self._var_cols.setdefault(var, col)
+        self._var_names = dict()  # variable names as written in calc_df, to column number
+        self.substance_memo = dict()  # resolved lookup substance names depend on the variable values
+        self.plan_memo = dict()  # as do the plans used for each scenario
+
+    @property
+    def calc_df(self):
+        if self._calc_df is None:
+            with load_lock:
+                if self._calc_df is None:  # not read by another thread in the meantime
+                    logger.debug(f"{self.u_id}: reading calculations from {self._calc_source['data']}")
+                    self.calc_df = iof.make_df(**self._calc_source)
+        return self._calc_df
+
+    @calc_df.setter
+    def calc_df(self, calc_df):
+        self._flow_sets = None
+        self._calc_rows = None
+        self.calc_plans = dict()  # plans depend on the calculation table
+        self.plan_memo = dict()
+        self._calc_df = calc_df
+        self.clear_balance_cache()
+
+    def clear_balance_cache(self):
+        """Clears the cached balances and increments the unit process's version,
+        so that balances cached elsewhere (e.g. by Factory) are not reused.
+        Called whenever var_df or calc_df change.
+        """
+        self.balance_cache = OrderedDict()
+        self.version += 1
+
+    def set_var(self, var, value, scenario=bbcfg.scenario_default):
+        """Sets the value of a variable in var_df and clears the balance cache.
+
+        This is the only way to change a variable of the existing variable table,
+        as var_df returns a read-only copy of it.
+
+        Args:
+            var (str): name of the variable (column of var_df)
+            value: the new value of the variable
+            scenario (str): the var_df index of the scenario to change. If not
+                in var_df, the default scenario is changed instead.
+                (Defaults to bbcfg.scenario_default)
+
+        Returns:
+            str: the scenario in which the variable was set
+        """
+        self.load_vars()
+        if scenario not in self._var_rows:
+            scenario = bbcfg.scenario_default
+        self._var_df.loc[scenario, iof.clean_str(var)] = value
+        self.compile_vars()
+        self.clear_balance_cache()
+        logger.debug(f"{self.name.upper()}: {var} ({scenario}) set to {value}")
+        return scenario
+
+    def var_overrides(self):
+        """returns the variable values overridden for the unit process in the current
+        thread (var_df column number: value; see override_vars)
+        """
+        units = getattr(var_overrides, 'units', None)
+        if not units:
+            return {}
+        return units.get(self, {})
+
+    def override_key(self):
+        """returns the overridden variable values as a tuple, for use in cache keys
+        """
+        overrides = self.var_overrides()
+        return tuple(sorted(overrides.items())) if overrides else ()
 
     def balance(self,
                 product_qty=1.0,
@@ -222,9 +558,10 @@ class UnitProcess:
         i_o = self.check_io(i_o)
         qty = product_qty
 
-        if scenario not in self.var_df.index.values:
-            logger.info(
-                f'ALERT! {self.name.upper()}: {scenario} not found in variables file. {bbcfg.scenario_default} values will be used instead')
+        self.load_vars()
+        if scenario not in self._var_rows:
+            logger.debug("ALERT! %s: %s not found in variables file. %s values will be used instead",
+                         self.name.upper(), scenario, bbcfg.scenario_default)
 
         product = self.check_product(product)
         if product in fd.lookup_var_dict:
@@ -234,56 +571,81 @@ class UnitProcess:
         else:
             lookup_product_key = False
 
-        # create flow dictionaries and seed with product qty
-        io_dicts = self.make_io_dicts(product, product_qty, i_o, product_alt_name)
+        calc_plan = self.calc_plan(product, i_o, scenario, product_alt_name, lookup_product_key)
+        logger.debug("%s: Attempting to balance on %s of %s (different name from origin: %s) (%s) using %s variables",
+                     self.name.upper(), qty, product, product_alt_name, i_o, scenario)
+
+        if bbcfg.balance_cache_size > 0 and trace.enabled is False and not self.derivative_vars and all(step['calc_type'] in calc.linear_calc_list for step in calc_plan):
+            # linear calculations: scale the balance on one unit of product
+            calc.check_qty(product_qty)
+            cache_key = (lookup_product_key if lookup_product_key else product, i_o, scenario, product_alt_name,
+                         self.override_key())
+            with cache_lock:
+                normalized = self.balance_cache.get(cache_key)
+                if normalized is not None:
+                    self.balance_cache.move_to_end(cache_key)
+            if normalized is None:
+                normalized = self.calculate_flows(1.0, product, i_o, scenario, product_alt_name,
+                                                  lookup_product_key, calc_plan)
+                with cache_lock:
+                    self.balance_cache[cache_key] = normalized
+                    while len(self.balance_cache) > bbcfg.balance_cache_size:
+                        self.balance_cache.popitem(last=False)
+            io_dicts = self.scale_balance(normalized, product_qty, raise_imbalance=raise_imbalance,
+                                          balance_energy=balance_energy)
+        else:
+            io_dicts = self.calculate_flows(product_qty, product, i_o, scenario, product_alt_name,
+                                            lookup_product_key, calc_plan)
+            self.add_imbalance_flows(io_dicts, raise_imbalance=raise_imbalance, balance_energy=balance_energy)
 
-        calc_df = self.calc_df
-        logger.info(
-            f"{self.name.upper()}: Attempting to balance on {qty} of {product} (different name from origin: {product_alt_name}) ({i_o}) using {scenario} variables")
+        logger.debug("%s process balanced on %s of %s", self.name, qty, product)
 
-        i = 0
-        attempt = 0
+        if write_to_console is True:
+            self.write_to_console(io_dicts, scenario, product_qty, product)
 
-        while len(calc_df) > 0:
-            i = self.check_attempt(i, attempt, calc_df)
+        if write_to_xls is True:
+            self.unit_write_to_xls(io_dicts, scenario, product_qty, product, self.outdir)
 
+        return io_dicts['i'], io_dicts['o']
+
+    def calculate_flows(self, product_qty, product, i_o, scenario, product_alt_name, lookup_product_key, calc_plan):
+        """performs the calculations of the calculation plan on the product quantity
+
+        Returns:
+            dictionary of the inflow ('i') and outflow ('o') defaultdicts, including
+            emissions and co-inflows, before checking for mass or energy imbalances.
+        """
+        # create flow dictionaries and seed with product qty
+        io_dicts = self.make_io_dicts(product, product_qty, i_o, product_alt_name)
+
+        for step in calc_plan:
             # get flow names and locations
-            # I don't remember exactly how this applies
-            logger.debug("if you get an error here, verify value types the var file (e.g. string, float")
-            known_substance, known_proxy, known_lookup = self.check_substance(calc_df.at[i, bbcfg.columns.known], scenario,
+            known_substance, known_proxy, known_lookup = self.check_substance(step['known'], scenario,
                                                                               product, product_alt_name,
                                                                               lookup_product_key)
-            unknown_substance, unknown_proxy, unknown_lookup = self.check_substance(calc_df.at[i, bbcfg.columns.unknown],
+            unknown_substance, unknown_proxy, unknown_lookup = self.check_substance(step['unknown'],
                                                                                     scenario, product, product_alt_name,
                                                                                     lookup_product_key)
-            known_io = iof.clean_str(calc_df.at[i, bbcfg.columns.known_io][0])
-            unknown_io = iof.clean_str(calc_df.at[i, bbcfg.columns.unknown_io][0])
+            known_io = step['known_io']
+            unknown_io = step['unknown_io']
 
             lookup_df = self.check_lookup(known_lookup, unknown_lookup)
 
-            calc_type = iof.clean_str(calc_df.at[i, bbcfg.columns.calc_type])
-            skip, invert, known2_qty, known2_proxy = self.check_calc(i, calc_type, calc_df, scenario, known_substance,
-                                                                     known_io, unknown_substance, unknown_io, io_dicts)
+            calc_type = step['calc_type']
+            invert = step['invert']
+            known2_qty, known2_proxy = self.check_calc(step, scenario, io_dicts)
 
-            logger.debug(f"{self.name.upper()}: current index: {i}, current product: {known_substance}")
-
-            var = self.check_var(calc_df.at[i, bbcfg.columns.calc_var], calc_type, scenario)
-
-            if skip is True:
-                i += 1
-                attempt += 1
-                logger.debug(
-                    f"{self.name.upper()}: neither {known_substance} nor {unknown_substance} found, skipping for now")
-                continue
+            var = self.check_var(step['var'], calc_type, scenario)
 
             # inverts when original unknown_substance is available but qty of known_substance is not
             if invert is True:
                 known_substance, unknown_substance = unknown_substance, known_substance
                 known_io, unknown_io = unknown_io, known_io
                 known_proxy, unknown_proxy = unknown_proxy, known_proxy
-                logger.debug(
-                    f"{self.name.upper()}: {known_substance} not found, but {unknown_substance} found. Inverting calculations")
 
+            if known_substance not in io_dicts[known_io]:
+                raise Exception(
+                    f"{self.name.upper()}: {known_substance} ({known_io}) not available for calculation {step['index']} using {scenario} variables")
             qty_known = io_dicts[known_io][known_substance]
 
             # set kwargs for calculation
@@ -303,8 +665,6 @@ class UnitProcess:
             kwargs = {**kwargs, **calc.calcs_dict[calc_type]['kwargs']}
 
             # calculate
-            logger.debug(
-                f"{self.name.upper()}: Attempting {calc_type} calculation for {unknown_substance} using {qty_known} of {known_substance}")
             qty_calculated = calc.calcs_dict[calc_type]['function'](**kwargs)
             qty_calculated = calc.no_nan(qty_calculated)
             if qty_calculated < 0:
@@ -319,12 +679,9 @@ class UnitProcess:
             else:
                 io_dicts[unknown_io][unknown_substance] = qty_calculated
 
-            # remove row of completed calculation from calc_df
-            calc_df = calc_df.drop(i)
-            calc_df = calc_df.reset_index(drop=True)
-            attempt = 0
-            logger.debug(
-                f"{self.name.upper()}: {qty_calculated} of {unknown_substance} calculated. {len(calc_df)} calculations remaining.")
+            if trace.enabled:
+                trace.record(self.u_id, scenario, step['index'], calc_type, known_substance, known_io, qty_known,
+                             unknown_substance, unknown_io, qty_calculated, var, invert)
 
         # After processing all rows in calc_df
         for substance, qty in io_dicts['e'].items():  # adds emissions dictionary to outflow dictionary
@@ -332,45 +689,8 @@ class UnitProcess:
         for substance, qty in io_dicts['c'].items():  # adds co-inflows dictionary to inflows dictionary
             io_dicts['i'][substance] += qty
 
-        # check if inflows and outflows balance
-        logger.debug(f"{self.name.upper()}: Balancing mass flows")
-        total_mass_in, total_mass_out = calc.check_balance(io_dicts['i'], io_dicts['o'],
-                                                           raise_imbalance=raise_imbalance,
-                                                           ignore_flows=bbcfg.energy_flows)
-
-        if total_mass_in > total_mass_out:
-            io_dicts['o']['UNKNOWN-mass'] = total_mass_in - total_mass_out
-            logger.info(
-                f"{self.name.upper()}: mass imbalance found {total_mass_in - total_mass_out} of UNKNOWN MASS added to outflows")
-        elif total_mass_out > total_mass_in:
-            io_dicts['i']['UNKNOWN-mass'] = total_mass_out - total_mass_in
-            logger.info(
-                f"{self.name.upper()}:mass imbalance found {total_mass_out - total_mass_in} of UNKNOWN MASS added to inflows")
-
-        if balance_energy is True:
-            logger.debug(f"{self.name.upper()}: Balancing energy flows")
-            total_energy_in, total_energy_out = calc.check_balance(io_dicts['i'], io_dicts['o'],
-                                                                   raise_imbalance=raise_imbalance,
-                                                                   ignore_flows=[],
-                                                                   only_these_flows=bbcfg.energy_flows)
-            if total_energy_in > total_energy_out:
-                io_dicts['o']['UNKNOWN-energy'] = total_energy_in - total_energy_out
-                logger.info(
-                    f"{self.name.upper()}: energy imbalance found {total_energy_in - total_energy_out} of UNKOWN ENERGY added to outflows")
-            elif total_mass_out > total_mass_in:
-                io_dicts['i']['UNKNOWN-energy'] = total_energy_out - total_energy_in
-                logger.info(
-                    f"{self.name.upper()}:energy imbalance found {total_energy_in - total_energy_out} of UNKOWN ENERGY added to inflows")
-
-        logger.info(f"{self.name} process balanced on {qty} of {product}")
 
-        if write_to_console is True:
-            self.write_to_console(io_dicts, scenario, product_qty, product)
-
-        if write_to_xls is True:
-            self.unit_write_to_xls(io_dicts, scenario, product_qty, product, self.outdir)
-
-        return io_dicts['i'], io_dicts['o']
+        return dict(i=io_dicts['i'], o=io_dicts['o'])
 
     def run_scenarios(self, scenario_list=[], product_qty=1.0, product=False, i_o=False, product_alt_name=False,
                       balance_energy=True, raise_imbalance=False, write_to_xls=True, write_to_console=False,
@@ -428,6 +748,152 @@ class UnitProcess:
 
         return inflows_df, outflows_df
 
+    def scale_balance(self, io_dicts, scale, raise_imbalance=False, balance_energy=True):
+        """returns a copy of the inflow ('i') and outflow ('o') dictionaries of a balance of the
+            unit process, with every quantity multiplied by scale. Any imbalance flows are
+            removed before scaling and checked again on the scaled flows (see add_imbalance_flows),
+            since whether a rounded imbalance is found depends on the quantities. 
+            Used to scale cached balances, in self.balance() (above) and by Factory.
+        """
+        scaled = {io: defaultdict(float, {substance: qty * scale for substance, qty in io_dicts[io].items()
+                                          if substance not in imbalance_flows})
+                  for io in ['i', 'o']}
+        self.add_imbalance_flows(scaled, raise_imbalance=raise_imbalance, balance_energy=balance_energy)
+        return scaled
+
+    def add_imbalance_flows(self, io_dicts, raise_imbalance=False, balance_energy=True):
+        """checks whether the inflows and outflows balance, and adds any difference
+            as UNKNOWN-mass or UNKNOWN-energy flows (see imbalance_flows). Used in 
+            self.balance() (above) and self.scale_balance() (above)
+        """
+        # check if inflows and outflows balance
+        logger.debug("%s: Balancing mass flows", self.name.upper())
+        total_mass_in, total_mass_out = calc.check_balance(io_dicts['i'], io_dicts['o'],
+                                                           raise_imbalance=raise_imbalance,
+                                                           ignore_flows=bbcfg.energy_flows)
+
+        if total_mass_in > total_mass_out:
+            io_dicts['o']['UNKNOWN-mass'] = total_mass_in - total_mass_out
+            logger.debug("%s: mass imbalance found %s of UNKNOWN MASS added to outflows",
+                         self.name.upper(), total_mass_in - total_mass_out)
+        elif total_mass_out > total_mass_in:
+            io_dicts['i']['UNKNOWN-mass'] = total_mass_out - total_mass_in
+            logger.debug("%s: mass imbalance found %s of UNKNOWN MASS added to inflows",
+                         self.name.upper(), total_mass_out - total_mass_in)
+
+        if balance_energy is True:
+            logger.debug("%s: Balancing energy flows", self.name.upper())
+            total_energy_in, total_energy_out = calc.check_balance(io_dicts['i'], io_dicts['o'],
+                                                                   raise_imbalance=raise_imbalance,
+                                                                   ignore_flows=[],
+                                                                   only_these_flows=bbcfg.energy_flows)
+            if total_energy_in > total_energy_out:
+                io_dicts['o']['UNKNOWN-energy'] = total_energy_in - total_energy_out
+                logger.debug("%s: energy imbalance found %s of UNKOWN ENERGY added to outflows",
+                             self.name.upper(), total_energy_in - total_energy_out)
+            elif total_mass_out > total_mass_in:
+                io_dicts['i']['UNKNOWN-energy'] = total_energy_out - total_energy_in
+                logger.debug("%s: energy imbalance found %s of UNKOWN ENERGY added to inflows",
+                             self.name.upper(), total_energy_out - total_energy_in)
+
+    def balance_many(self, scenario_list=[], product_qty=1.0, product=False, i_o=False, product_alt_name=False,
+                     balance_energy=True, raise_imbalance=False):
+        """Balances the unit process on multiple scenarios of variables at once.
+
+        Performs the same calculations as UnitProcess.balance, but on arrays
+        with one element per scenario, so that each calculation is done once for
+        all scenarios. Scenarios whose lookup substances resolve to different
+        substance names are calculated separately.
+
+        Args:
+            scenario_list (list[str]): row indices of var_df to balance. Scenarios
+                not in var_df use the default scenario's values.
+                (Defaults to [bbcfg.scenario_default])
+            product_qty (float/array): The quantity of the balancing flow, either
+                one quantity for all scenarios or one per scenario.
+                (Defaults to 1.0)
+            product, i_o, product_alt_name, balance_energy, raise_imbalance:
+                as in UnitProcess.balance
+
+        Returns:
+            DataFrame of inflows, with scenarios as the index and substance names as columns
+            DataFrame of outflows, with scenarios as the index and substance names as columns
+        """
+        iof.check_type(scenario_list, is_type=[list], not_not=True)
+        scenario_list = scenario_list if scenario_list else [bbcfg.scenario_default]
+        n_scenarios = len(scenario_list)
+
+        i_o = self.check_io(i_o)
+        product = self.check_product(product)
+        qtys = np.array(np.broadcast_to(np.asarray(product_qty, dtype=float), (n_scenarios,)))
+        calc.check_qty(qtys)
+
+        lookup_product_key = product if product in fd.lookup_var_dict else False
+
+        self.load_vars()
+        # group scenarios with the same substance names (which differ only due to lookup substances)
+        groups = dict()
+        for n, scenario in enumerate(scenario_list):
+            if scenario not in self._var_rows:
+                logger.info(
+                    f'ALERT! {self.name.upper()}: {scenario} not found in variables file. {bbcfg.scenario_default} values will be used instead')
+            scenario_product = self.get_var(fd.lookup_var_dict[product]['lookup_var'], scenario) if lookup_product_key else product
+            calc_plan = self.calc_plan(scenario_product, i_o, scenario, product_alt_name, lookup_product_key)
+            names = []
+            for step in calc_plan:
+                known = self.check_substance(step['known'], scenario, scenario_product, product_alt_name, lookup_product_key)
+                unknown = self.check_substance(step['unknown'], scenario, scenario_product, product_alt_name, lookup_product_key)
+                names.append((known[0], known[1], unknown[0], unknown[1], *self.check_known2(step, scenario)))
+            groups.setdefault((scenario_product, id(calc_plan), tuple(names)), (calc_plan, []))[1].append(n)
+
+        flows = dict(i=defaultdict(lambda: np.zeros(n_scenarios)), o=defaultdict(lambda: np.zeros(n_scenarios)))
+        for (scenario_product, plan_id, names), (calc_plan, positions) in groups.items():
+            scenarios = [scenario_list[n] for n in positions]
+            logger.info(
+                f"{self.name.upper()}: Attempting to balance on {product} ({scenario_product}) ({i_o}) for scenarios {scenarios}")
+            group_flows = self.calculate_flows_many(qtys[positions], scenario_product, i_o, scenarios, product_alt_name,
+                                                    lookup_product_key, calc_plan, names)
+            for io in ['i', 'o']:
+                for substance, qty in group_flows[io].items():
+                    flows[io][substance][positions] = qty
+
+        # check if inflows and outflows balance, for each scenario
+        def totals(flow_dict, only_these_flows=False, ignore_flows=[]):
+            total = np.zeros(n_scenarios)
+            for substance, qty in flow_dict.items():
+                if type(only_these_flows) is list and not iof.has_affix(substance, only_these_flows):
+                    continue
+                if iof.has_affix(substance, ignore_flows):
+                    continue
+                total = total + qty
+            return np.round(total, bbcfg.float_tol)
+
+        mass_in, mass_out = totals(flows['i'], ignore_flows=bbcfg.energy_flows), totals(flows['o'], ignore_flows=bbcfg.energy_flows)
+        if raise_imbalance is True and (mass_in != mass_out).any():
+            raise ValueError(f'IMBALANCED! Total In:  {mass_in} v Total Out: {mass_out}')
+        if (mass_in != mass_out).any():
+            flows['o']['UNKNOWN-mass'] = np.where(mass_in > mass_out, mass_in - mass_out, 0)
+            flows['i']['UNKNOWN-mass'] = np.where(mass_out > mass_in, mass_out - mass_in, 0)
+            logger.info(f"{self.name.upper()}: mass imbalance found, UNKNOWN MASS added to flows")
+
+        if balance_energy is True:
+            energy_in, energy_out = totals(flows['i'], only_these_flows=bbcfg.energy_flows), totals(flows['o'], only_these_flows=bbcfg.energy_flows)
+            if raise_imbalance is True and (energy_in != energy_out).any():
+                raise ValueError(f'IMBALANCED! Total In:  {energy_in} v Total Out: {energy_out}')
+            # as in UnitProcess.balance, energy added to inflows when the outflow mass exceeds the inflow mass
+            energy_to_out = energy_in > energy_out
+            energy_to_in = ~energy_to_out & (mass_out > mass_in)
+            if energy_to_out.any():
+                flows['o']['UNKNOWN-energy'] = np.where(energy_to_out, energy_in - energy_out, 0)
+            if energy_to_in.any():
+                flows['i']['UNKNOWN-energy'] = np.where(energy_to_in, energy_out - energy_in, 0)
+
+        logger.info(f"{self.name} process balanced on {product} for {n_scenarios} scenarios")
+
+        inflows_df = pan.DataFrame(dict(flows['i']), index=scenario_list)
+        outflows_df = pan.DataFrame(dict(flows['o']), index=scenario_list)
+        return inflows_df, outflows_df
+
     def recycle_1to1(self,
                      original_inflows_dict,
                      original_outflows_dict,
@@ -685,39 +1151,328 @@ class UnitProcess:
         # prime inflow or outflow dictionary with product quantity
         if product_alt_name is not False:
             io_dicts[i_o][product_alt_name] = qty
-            logger.debug(f"{self.name.upper()}: {qty} of {product_alt_name} added to {i_o} dict, in place of {product}")
+            logger.debug("%s: %s of %s added to %s dict, in place of %s", self.name.upper(), qty, product_alt_name,
+                         i_o, product)
         else:
             io_dicts[i_o][product] = qty
-            logger.debug(f"{self.name.upper()}: {qty} of {product} added to {i_o} dict")
+            logger.debug("%s: %s of %s added to %s dict", self.name.upper(), qty, product, i_o)
 
         return io_dicts
 
-    def check_attempt(self, i, attempt, calc_df):
-        """checks that the calculation attempt is valid
+    def calc_plan(self, product, i_o, scenario, product_alt_name=False, lookup_product_key=False):
+        """returns the calculation plan for balancing on the product in the scenario, building it on first use
+
+        The plan is ordered using the substance names that the calculation table's
+        names resolve to in the scenario (see check_substance), so that lookup 
+        substances are ordered by the substance they stand for. Plans are stored in
+        self.calc_plans, keyed by product, flow location, alternative product name
+        and resolved names, and are discarded whenever calc_df is replaced. The plan
+        used for each scenario is remembered in self.plan_memo, which is cleared
+        whenever var_df changes.
         """
-        if attempt >= len(calc_df):
-            raise Exception(
-                f"{self.name.upper()}: Cannot process {calc_df.iloc[i - 1]}. Try checking flow location and remember that substance names are case sensitive.")
-        if i >= len(calc_df):
-            return 0  # if at end of list, loop around
-        else:
-            return i
+        key = (product, i_o, scenario, product_alt_name, lookup_product_key, self.override_key())
+        plan = self.plan_memo.get(key)
+        if plan is None:
+            names = tuple(self.resolve_row_names(row, scenario, product, product_alt_name, lookup_product_key)
+                          for row in self.calc_rows())
+            plan_key = (product, i_o, product_alt_name, names)
+            if plan_key not in self.calc_plans:
+                self.calc_plans[plan_key] = self.build_calc_plan(product, i_o, product_alt_name, names)
+            plan = self.plan_memo[key] = self.calc_plans[plan_key]
+        return plan
+
+    def resolve_row_names(self, row, scenario, product, product_alt_name, lookup_product_key):
+        """returns the substance names that the known, unknown and second known
+            substances of a calculation resolve to in the scenario
+        """
+        known = self.check_substance(row['known'], scenario, product, product_alt_name, lookup_product_key)[0]
+        unknown = self.check_substance(row['unknown'], scenario, product, product_alt_name, lookup_product_key)[0]
+        known2 = self.check_known2(row, scenario)[0]
+        return known, unknown, known2
+
+    def build_calc_plan(self, product, i_o, product_alt_name, names):
+        """orders the rows of calc_df so that every calculation only uses known quantities
+
+        Simulates the row-by-row scan that balance originally performed (looping
+        over the remaining rows until one can be calculated) using the resolved 
+        substance names of the calculation table rather than their quantities, so
+        the resulting order matches the original one without needing to search
+        the table on every balance. Calculations that can never be performed are
+        reported here, before any of them are.
+
+        Args:
+            product (str): the (resolved) substance the process is balanced on
+            i_o (str): the flow location of the product
+            product_alt_name (str/bool): name used in place of the product name,
+                if any
+            names (tuple): the resolved known, unknown and second known substance
+                names of each row of calc_rows (see resolve_row_names)
+
+        Returns:
+            list of dictionaries, one per calculation, in the order they should be
+            performed, with the (unresolved) substance names, flow locations,
+            calculation type, variable and whether the calculation is inverted.
+        """
+        rows = [dict(row, names=row_names) for row, row_names in zip(self.calc_rows(), names)]
+
+        available = dict(i=set(), o=set(), t=set(), e=set(), c=set())
+        available[i_o].add(product_alt_name if product_alt_name is not False else product)
+
+        plan = []
+        i = 0
+        attempt = 0
+        while rows:
+            if attempt >= len(rows):
+                unresolved = "\n".join(f"{row['index']}: {row['known']} ({row['known_io']}) -> "
+                                       f"{row['unknown']} ({row['unknown_io']})" for row in rows)
+                raise Exception(
+                    f"{self.name.upper()}: Cannot process calculations (no known quantity for either substance):\n{unresolved}\n"
+                    f"Try checking flow location and remember that substance names are case sensitive.")
+            if i >= len(rows):
+                i = 0  # if at end of list, loop around
+
+            row = rows[i]
+            known, unknown, known2 = row['names']
+
+            if known in available[row['known_io']]:
+                invert = False
+            elif row['unknown_io'] not in ['c', 'e', 'd'] and unknown in available[row['unknown_io']]:
+                invert = True
+            else:
+                i += 1
+                attempt += 1
+                continue
+
+            if known2 is not None and known2 not in available[row['known2_io']]:
+                i += 1
+                attempt += 1
+                continue
+
+            if invert is True:
+                available[row['known_io']].add(known)
+            elif row['unknown_io'] != 'd':
+                available[row['unknown_io']].add(unknown)
+
+            if 'combustion' in row['calc_type']:  # combustion also writes emissions and co-inflows
+                for emission in bbcfg.emissions:
+                    if fd.df_fuels is None or emission.lower() in fd.df_fuels:
+                        available['e'].add(emission)
+                available['e'].add('waste heat')
+                available['c'].add(f'O2{bbcfg.ignore_sep}combustion')
+
+            row = dict(row, invert=invert)
+            del row['names']
+            plan.append(row)
+            rows.pop(i)
+            attempt = 0
+
+        logger.debug("%s: calculation plan built for %s (%s, alt name: %s)", self.name.upper(), product, i_o,
+                     product_alt_name)
+        return plan
+
+    def calc_rows(self):
+        """returns the non-blank rows of calc_df as dictionaries of the (unresolved) 
+            substance names, flow locations, calculation type and variable, reading
+            them on first use
+        """
+        if self._calc_rows is None:
+            self._calc_rows = self.build_calc_rows()
+        return self._calc_rows
+
+    def build_calc_rows(self):
+        """reads and checks the rows of calc_df used by build_calc_plan
+        """
+        cols = bbcfg.columns
+
+        rows = []
+        for i in self.calc_df.index:
+            if type(self.calc_df.at[i, cols.known]) is not str:  # removes blank rows
+                continue
+
+            calc_type = iof.clean_str(self.calc_df.at[i, cols.calc_type])
+            if calc_type not in calc.calcs_dict:
+                raise Exception(f"{self.name.upper()}: {calc_type} is an unknown calculation type in\n{self.calc_df.loc[i]}")
+
+            row = dict(
+                index=i,
+                calc_type=calc_type,
+                known=self.calc_df.at[i, cols.known],
+                known_io=iof.clean_str(self.calc_df.at[i, cols.known_io][0]),
+                unknown=self.calc_df.at[i, cols.unknown],
+                unknown_io=iof.clean_str(self.calc_df.at[i, cols.unknown_io][0]),
+                var=self.calc_df.at[i, cols.calc_var],
+                known2=None,
+                known2_io=None,
+                invert=False,
+            )
+            if row['unknown_io'] not in ['i', 'o', 't', 'e', 'c', 'd']:  # 'd' can be used for discarded substances
+                raise Exception(f"{self.name.upper()}: {row['unknown_io']} is an unknown destination")
+            if row['known_io'] not in ['i', 'o', 't', 'e', 'c']:
+                raise Exception(f"{self.name.upper()}: {row['known_io']} is an unknown flow location")
+
+            if calc_type in calc.twoQty_calc_list:  # e.g. addition or subtraction
+                row['known2'] = self.calc_df.at[i, cols.known2]
+                row['known2_io'] = iof.clean_str(self.calc_df.at[i, cols.known2_io][0])
+
+            rows.append(row)
+
+        return rows
+
+    def calculate_flows_many(self, qtys, product, i_o, scenarios, product_alt_name, lookup_product_key, calc_plan,
+                             names):
+        """performs the calculations of the calculation plan on arrays of product quantities
+            (one element per scenario), with substance names already resolved for the scenarios
+
+        Returns:
+            dictionary of the inflow ('i') and outflow ('o') dictionaries of arrays, including
+            emissions and co-inflows, before checking for mass or energy imbalances.
+        """
+        n_scenarios = len(scenarios)
+        io_dicts = {io: defaultdict(lambda: np.zeros(n_scenarios)) for io in ['i', 'o', 't', 'e', 'c']}
+        io_dicts[i_o][product_alt_name if product_alt_name is not False else product] = qtys
+
+        for step, (known_substance, known_proxy, unknown_substance, unknown_proxy, known2_substance,
+                   known2_proxy) in zip(calc_plan, names):
+            known_io = step['known_io']
+            unknown_io = step['unknown_io']
+            calc_type = step['calc_type']
+            invert = step['invert']
+
+            lookup_df = self.check_lookup(
+                self.check_substance(step['known'], scenarios[0], product, product_alt_name, lookup_product_key)[2],
+                self.check_substance(step['unknown'], scenarios[0], product, product_alt_name, lookup_product_key)[2])
+            var = self.check_var_many(step['var'], calc_type, scenarios)
+
+            if invert is True:
+                known_substance, unknown_substance = unknown_substance, known_substance
+                known_io, unknown_io = unknown_io, known_io
+                known_proxy, unknown_proxy = unknown_proxy, known_proxy
+
+            if known_substance not in io_dicts[known_io]:
+                raise Exception(
+                    f"{self.name.upper()}: {known_substance} ({known_io}) not available for calculation {step['index']} using {scenarios} variables")
+            known2_qty = None
+            if known2_substance is not None:
+                if known2_substance not in io_dicts[step['known2_io']]:
+                    raise Exception(
+                        f"{self.name.upper()}: {known2_substance} ({step['known2_io']}) not available for calculation {step['index']} using {scenarios} variables")
+                known2_qty = io_dicts[step['known2_io']][known2_substance]
+
+            kwargs = dict(
+                qty=calc.no_nan(io_dicts[known_io][known_substance]),
+                var=calc.no_nan(var),
+                known_substance=known_proxy,
+                unknown_substance=unknown_proxy,
+                known2_substance=known2_proxy,
+                qty2=calc.no_nan(known2_qty),
+                invert=invert,
+                emissions_dict=io_dicts['e'],
+                inflows_dict=io_dicts['c'],
+                lookup_df=lookup_df,
+            )
+            kwargs = {**kwargs, **calc.calcs_dict[calc_type]['kwargs']}
+
+            if calc_type in calc.array_calc_list:
+                qty_calculated = calc.calcs_dict[calc_type]['function'](**kwargs)
+                qty_calculated = np.broadcast_to(np.asarray(qty_calculated, dtype=float), (n_scenarios,))
+            else:  # one scenario at a time, collecting any emissions and co-inflows
+                side_effects = calc.calcs_dict[calc_type]['side_effects']
+                qty_calculated = np.zeros(n_scenarios)
+                for n in range(n_scenarios):
+                    scenario_kwargs = {k: (v[n] if isinstance(v, np.ndarray) else v) for k, v in kwargs.items()}
+                    scenario_kwargs['emissions_dict'] = defaultdict(float)
+                    scenario_kwargs['inflows_dict'] = defaultdict(float)
+                    qty_calculated[n] = calc.calcs_dict[calc_type]['function'](**scenario_kwargs)
+                    for io in side_effects:
+                        for substance, qty in scenario_kwargs[f"{'emissions' if io == 'e' else 'inflows'}_dict"].items():
+                            io_dicts[io][substance][n] += qty
+
+            qty_calculated = calc.no_nan(qty_calculated)
+            qty_calculated = np.where(qty_calculated < 0, np.round(qty_calculated, bbcfg.float_tol), qty_calculated)
+            calc.check_qty(qty_calculated)
+
+            if unknown_io in ['c', 'e']:
+                io_dicts[unknown_io][unknown_substance] = io_dicts[unknown_io][unknown_substance] + qty_calculated
+            elif unknown_io != 'd':
+                io_dicts[unknown_io][unknown_substance] = qty_calculated
+
+            if trace.enabled:
+                for n, scenario in enumerate(scenarios):
+                    trace.record(self.u_id, scenario, step['index'], calc_type, known_substance, known_io,
+                                 kwargs['qty'][n], unknown_substance, unknown_io, qty_calculated[n],
+                                 var[n] if isinstance(var, np.ndarray) else var, invert)
+
+        for substance, qty in io_dicts['e'].items():  # adds emissions dictionary to outflow dictionary
+            io_dicts['o'][substance] = io_dicts['o'][substance] + qty
+        for substance, qty in io_dicts['c'].items():  # adds co-inflows dictionary to inflows dictionary
+            io_dicts['i'][substance] = io_dicts['i'][substance] + qty
+
+        return dict(i=io_dicts['i'], o=io_dicts['o'])
 
     def get_var(self, var, scenario):
-        if scenario in self.var_df.index:  # otherwise looks up the variable in the var df
-            return self.var_df.at[scenario, iof.clean_str(var)]  # from the relevant scenario
+        """returns the value of the variable for the scenario, or for the default scenario
+            if the scenario is not in var_df
+        """
+        col = self.var_col(var)
+        overrides = self.var_overrides()
+        if col in overrides:
+            value = overrides[col]
         else:
-            logger.debug(
-                f"using {self.var_df.at[bbcfg.scenario_default, iof.clean_str(var)]} from {bbcfg.scenario_default} for {var}")
-            return self.var_df.at[
-                bbcfg.scenario_default, iof.clean_str(var)]  # if not available, return from default string
+            row = self._var_rows.get(scenario, self._var_default_row)
+            if row is None:
+                raise KeyError(f"{self.name.upper()}: neither {scenario} nor {bbcfg.scenario_default} found in variables file")
+            value = self._var_values[row, col]
+        if col in self.derivative_vars:
+            return calc.Dual.seed(value, self.derivative_vars[col], self.derivative_size)
+        return value
+
+    def set_derivative_vars(self, var_indices, size=0):
+        """selects variables whose values carry derivatives through the balance
+
+        While set, get_var returns the selected variables as calculators.Dual
+        quantities, so that the flows calculated from them carry their derivatives
+        with respect to each selected variable, and balances are not cached.
+
+        Args:
+            var_indices (dict): variable names (columns of var_df) as keys, and the
+                position of the variable in the gradient as values. An empty
+                dictionary deselects all variables.
+            size (int): the total number of variables in the gradient
+                (Defaults to 0)
+        """
+        derivative_vars = dict()
+        for var, index in var_indices.items():
+            col = self.var_col(var)
+            if np.isnan(self._var_floats[:, col]).all():
+                raise ValueError(f"{self.name.upper()}: {var} is not a numeric variable")
+            derivative_vars[col] = index
+        self.derivative_vars = derivative_vars
+        self.derivative_size = size
+        self.clear_balance_cache()
+
+    def var_col(self, var):
+        """returns the column number of the variable in the compiled var_df
+        """
+        if self._var_df is None:
+            self.load_vars()
+        if var not in self._var_names:
+            clean_var = iof.clean_str(var)
+            if clean_var not in self._var_cols:
+                raise KeyError(f"{self.name.upper()}: {clean_var} not found in variables file")
+            self._var_names[var] = self._var_cols[clean_var]
+        return self._var_names[var]
 
     def check_var(self, var, calc_type, scenario):
         """checks that the variable is valid and returns the correct variable for the calc type
         """
-        if isinstance(var, str) and iof.clean_str(var) not in bbcfg.no_var:
+        if isinstance(var, str):
+            if var not in self.calc_vars:
+                self.calc_vars[var] = (iof.clean_str(var) not in bbcfg.no_var, iof.clean_str(var, lower=False))
+            is_var, var_name = self.calc_vars[var]
+            if is_var is False:
+                return None
             if calc_type in calc.lookup_var_calc_list:  # for lookup calculations the var specifies the column of the lookup df
-                return iof.clean_str(var, lower=False)  # which is given as the var in the calc df
+                return var_name  # which is given as the var in the calc df
             else:
                 return self.get_var(var, scenario)
         elif isinstance(var, (float, int, complex, np.integer, np.floating)):
@@ -725,6 +1480,35 @@ class UnitProcess:
         else:
             return None
 
+    def get_var_many(self, var, scenarios):
+        """returns an array of the variable's values for each scenario
+            (using the default scenario for scenarios not in var_df)
+        """
+        col = self.var_col(var)
+        overrides = self.var_overrides()
+        if col in overrides:
+            return np.full(len(scenarios), float(overrides[col]))
+        rows = [self._var_rows.get(scenario, self._var_default_row) for scenario in scenarios]
+        if None in rows:
+            raise KeyError(f"{self.name.upper()}: {bbcfg.scenario_default} not found in variables file")
+        values = self._var_floats[rows, col]
+        if np.isnan(values).any():  # raises if the variable is not numeric
+            values = np.asarray(self._var_values[rows, col], dtype=float)
+        return values
+
+    def check_var_many(self, var, calc_type, scenarios):
+        """as check_var, but returns an array of variable values (one per scenario)
+        """
+        if isinstance(var, str) and iof.clean_str(var) not in bbcfg.no_var:
+            if calc_type in calc.lookup_var_calc_list:
+                return iof.clean_str(var, lower=False)
+            else:
+                return self.get_var_many(var, scenarios)
+        elif isinstance(var, (float, int, complex, np.integer, np.floating)):
+            return var
+        else:
+            return None
+
     def check_substance(self, substance, scenario, product, product_alt_name, lookup_product_key):
         """checks that the substance name is valid and, if necesssary substitutes an alternative name 
         product_alt_name (str): from factory connection
@@ -733,6 +1517,15 @@ class UnitProcess:
         if a unique_identifier suffix is used, returns a proxy of the generic substance name for
             use in calculations
         """
+        key = (substance, scenario, product, product_alt_name, lookup_product_key, self.override_key())
+        if key not in self.substance_memo:
+            self.substance_memo[key] = self.resolve_substance(substance, scenario, product, product_alt_name,
+                                                              lookup_product_key)
+        return self.substance_memo[key]
+
+    def resolve_substance(self, substance, scenario, product, product_alt_name, lookup_product_key):
+        """resolves the substance name, proxy and lookup df as described in check_substance
+        """
         lookup_df = False
 
         if product_alt_name is not False:
@@ -781,57 +1574,51 @@ class UnitProcess:
         else:
             return known_lookup
 
-    def check_calc(self, i, calc_type, calc_df, scenario, known_substance, known_io, unknown_substance, unknown_io,
-                   io_dicts):
-        """checks whether inversion is needed, and whether all needed data is available
-            if qty of the unknown substance but not known substance is available, inverts
-            if neitehr qty is available, flags to skip to the next row
-            if the calc requires two quantities, checks whether both qtys are available
-                if not, flags to skip to the next row
-        """
-        skip = False
-        known2_qty = None
-        known2_proxy = None
-
-        if calc_type not in calc.calcs_dict:
-            raise Exception(f"{self.name.upper()}: {calc_type} is an unknown calculation type in\n{calc_df.iloc[i]}")
-
-        if known_substance in io_dicts[known_io]:
-            invert = False
-        elif unknown_io not in io_dicts and unknown_io != 'd':  # 'd' can be used for discarded substances
-            raise Exception(f"{self.name.upper()}: {unknown_io} is an unknown destination")
-        elif unknown_io not in ['c', 'e'] and unknown_substance in io_dicts[unknown_io]:
-            invert = True
-        else:  # when neither a qty of known or unknown substance is available
-            return True, False, False, False
-
-        if calc_type in calc.twoQty_calc_list:  # e.g. addition or subtraction
-            known2_substance = calc_df.at[i, bbcfg.columns.known2]
-            k2_io = iof.clean_str(calc_df.at[i, bbcfg.columns.known2_io][0])
-
-            if known2_substance in fd.lookup_var_dict:
-                known2_substance = self.get_var(fd.lookup_var_dict[known2_substance]['lookup_var'], scenario)
-
-            if bbcfg.ignore_sep in known2_substance:
-                if known2_substance.split(bbcfg.ignore_sep)[0] in fd.lookup_var_dict:
-                    known2_proxy = self.get_var(
-                        fd.lookup_var_dict[known2_substance.split(bbcfg.ignore_sep)[0]]['lookup_var'], scenario)
-                    known2_substance = known2_proxy + bbcfg.ignore_sep + known2_substance.split(bbcfg.ignore_sep)[1]
-                else:
-                    known2_proxy = known2_substance.split(bbcfg.ignore_sep)[0]
-                logger.debug(
-                    f"{self.name.upper()}: {bbcfg.ignore_sep} separator found in {known2_substance}. Using {known2_proxy} for calculations.")
-            else:
-                known2_proxy = known2_substance
+    def check_calc(self, step, scenario, io_dicts):
+        """returns the quantity and proxy name of the second known substance
+            for calculations that require two quantities (e.g. addition or subtraction)
+            otherwise returns None for both
+        """
+        known2_substance, known2_proxy = self.check_known2(step, scenario)
+        if known2_substance is None:
+            return None, None
+
+        if known2_substance not in io_dicts[step['known2_io']]:
+            raise Exception(
+                f"{self.name.upper()}: {known2_substance} ({step['known2_io']}) not available for calculation {step['index']} using {scenario} variables")
 
-            if known2_substance in io_dicts[k2_io]:
-                known2_qty = io_dicts[k2_io][known2_substance]
+        return io_dicts[step['known2_io']][known2_substance], known2_proxy
+
+    def check_known2(self, step, scenario):
+        """returns the substance and proxy names of the second known substance of a calculation
+            substituting lookup substance names from the scenario (None for both if not needed)
+        """
+        if step['known2'] is None:
+            return None, None
+
+        key = (step['known2'], scenario, self.override_key())
+        if key in self.substance_memo:
+            return self.substance_memo[key]
+
+        known2_substance = step['known2']
+
+        if known2_substance in fd.lookup_var_dict:
+            known2_substance = self.get_var(fd.lookup_var_dict[known2_substance]['lookup_var'], scenario)
+
+        if bbcfg.ignore_sep in known2_substance:
+            if known2_substance.split(bbcfg.ignore_sep)[0] in fd.lookup_var_dict:
+                known2_proxy = self.get_var(
+                    fd.lookup_var_dict[known2_substance.split(bbcfg.ignore_sep)[0]]['lookup_var'], scenario)
+                known2_substance = known2_proxy + bbcfg.ignore_sep + known2_substance.split(bbcfg.ignore_sep)[1]
             else:
-                logger.debug(
-                    f"{self.name.upper()}: {known2_substance} not found (both {known_substance} ({known_io}) and {known2_substance} ({k2_io}) required), skipping for now")
-                return True, False, False, False
+                known2_proxy = known2_substance.split(bbcfg.ignore_sep)[0]
+            logger.debug(
+                f"{self.name.upper()}: {bbcfg.ignore_sep} separator found in {known2_substance}. Using {known2_proxy} for calculations.")
+        else:
+            known2_proxy = known2_substance
 
-        return skip, invert, known2_qty, known2_proxy
+        self.substance_memo[key] = known2_substance, known2_proxy
+        return known2_substance, known2_proxy
 
     def write_to_console(self, io_dicts, scenario, qty, product, replacing=False):
         if type(replacing) is str: